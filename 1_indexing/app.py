@@ -1,43 +1,172 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
+import json
+import os
+import queue
+import re
 import sqlite3
+import threading
+
+# CONSTANTS
+DB_PATH = os.getenv('SQLITE_DB_PATH', 'adventureworks.db')
+POOL_SIZE = 4 # Conexiones de solo lectura reutilizadas por el proceso (una por petición en curso)
+FETCH_SIZE = 500 # Filas leídas de SQLite y enviadas al cliente en cada bloque
+CACHED_STATEMENTS = 256 # Sentencias preparadas que SQLite guarda en cada conexión
+MAX_PAGE_SIZE = 10000
 
 app = Flask(__name__)
 
+# Pool de conexiones de solo lectura: se crean la primera vez que se necesitan y se reutilizan en las siguientes peticiones,
+# así la caché de sentencias preparadas de cada conexión sirve para las consultas repetidas (por ejemplo las páginas)
+_pool = queue.LifoQueue()
+_pool_lock = threading.Lock()
+_pool_created = 0
+
+def get_connection():
+    global _pool_created
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        pass
+    with _pool_lock:
+        if _pool_created < POOL_SIZE:
+            _pool_created += 1
+            conn = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+            conn.execute('PRAGMA query_only = ON')
+            return conn
+    return _pool.get(timeout=30)
+
+def release_connection(conn):
+    _pool.put(conn)
+
+# Consulta con paginación por clave (keyset): las filas con la columna order_by mayor que after, ordenadas y limitadas
+def get_page_query(sql_query, order_by, after):
+    if not re.match(r'^\w+$', order_by):
+        raise ValueError(f'Invalid order_by column: {order_by}')
+    sql_query = sql_query.strip().rstrip(';')
+    where = f'WHERE q."{order_by}" > ? ' if after is not None else ''
+    params = [after] if after is not None else []
+    return f'SELECT * FROM ({sql_query}) AS q {where}ORDER BY q."{order_by}" LIMIT ?', params
+
+# Filas de un cursor en bloques de FETCH_SIZE
+def iter_batches(cursor, first_batch):
+    batch = first_batch
+    while len(batch) > 0:
+        yield batch
+        batch = cursor.fetchmany(FETCH_SIZE)
+
+def to_json(value):
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+# Tamaño de página de la petición: un entero positivo (o su texto), como máximo MAX_PAGE_SIZE
+def get_page_size(value):
+    if value is None:
+        return FETCH_SIZE
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise ValueError(f'page_size must be a positive integer: {value}')
+    return min(value, MAX_PAGE_SIZE)
+
 # Ruta para manejar las consultas SQL
+# Parámetros opcionales:
+# - format: 'json' (lista de filas, por defecto) o 'ndjson' (una fila por línea, para leerlas según llegan)
+# - order_by, page_size y after: paginación por clave (order_by es una columna única del resultado), devuelve las page_size
+#   filas siguientes a after ordenadas por order_by y el valor de next_after para pedir la página siguiente (None en la última)
+#   (en json: {"rows": [...], "next_after": ...}, en ndjson: una última línea {"next_after": ...})
+# Un error al leer las filas cuando la respuesta ya ha empezado se envía al final: en ndjson como última línea {"error": ...},
+# en json paginado como {"rows": [...], "error": ..., "next_after": null}. En json sin paginar (una lista) no hay donde
+# enviarlo y la respuesta termina sin cerrar la lista (JSON inválido, para que el cliente no la tome por completa): para
+# leer resultados grandes según llegan se recomienda ndjson
 @app.route('/sqlite-query', methods=['POST'])
 def sqlite_query():
+    conn = None
     try:
         # Obtén la consulta SQL del cuerpo de la solicitud
         data = request.get_json()
         sql_query = data.get('query')
         user = data.get('user')
         password = data.get('password')
+        output_format = data.get('format', 'json')
+        order_by = data.get('order_by')
 
         # Verifica las credenciales (esto es solo un ejemplo, en un entorno real deberías usar un método seguro)
         if user != 'admin' or password != 'Password123!':
             return jsonify({'error': 'Invalid credentials'}), 401
+        if output_format not in ('json', 'ndjson'):
+            return jsonify({'error': f'Invalid format: {output_format}'}), 400
 
-        # Conéctate a la base de datos SQLite
-        conn = sqlite3.connect('adventureworks.db')
-        cursor = conn.cursor()
+        params = []
+        page_size = None
+        if order_by is not None:
+            try:
+                page_size = get_page_size(data.get('page_size'))
+                sql_query, params = get_page_query(sql_query, order_by, data.get('after'))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            params.append(page_size)
 
-        # Ejecuta la consulta
-        cursor.execute(sql_query)
-        rows = cursor.fetchall()
-
-        # Procesa los resultados
-        results = []
-        for row in rows:
-            results.append(row)
+        # Ejecuta la consulta con una conexión del pool y lee el primer bloque, los errores de la consulta se devuelven con 500
+        conn = get_connection()
+        cursor = conn.execute(sql_query, params)
+        first_batch = cursor.fetchmany(FETCH_SIZE)
+        key_index = None
+        if order_by is not None:
+            columns = [column[0] for column in cursor.description]
+            if order_by not in columns:
+                cursor.close()
+                release_connection(conn)
+                return jsonify({'error': f'The column {order_by} is not in the results'}), 400
+            key_index = columns.index(order_by)
+    except Exception as e:
+        if conn is not None:
+            release_connection(conn)
+        return jsonify({'error': str(e)}), 500
 
-        # Cierra la conexión
-        cursor.close()
-        conn.close()
+    # Envía las filas según se leen, sin tener el resultado completo en memoria
+    def generate():
+        count = 0
+        last_key = None
+        if output_format == 'json':
+            yield '{"rows": [' if order_by is not None else '['
+        try:
+            for batch in iter_batches(cursor, first_batch):
+                if output_format == 'json':
+                    yield (',' if count > 0 else '') + ','.join(to_json(list(row)) for row in batch)
+                else:
+                    yield ''.join(to_json(list(row)) + '\n' for row in batch)
+                count += len(batch)
+                if key_index is not None:
+                    last_key = batch[-1][key_index]
+        except Exception as e:
+            # La respuesta ya ha empezado: el error se envía como última línea en ndjson
+            print(f'ERROR sqlite_query: {e}')
+            if output_format == 'ndjson':
+                yield to_json({'error': str(e)}) + '\n'
+                return
+            if order_by is not None:
+                # El objeto se cierra con el error, sin next_after: la página no está completa
+                yield f'], "error": {to_json(str(e))}, "next_after": null}}'
+                return
+            raise
+        finally:
+            close()
+        next_after = last_key if page_size is not None and count == page_size else None
+        if output_format == 'json':
+            yield f'], "next_after": {to_json(next_after)}}}' if order_by is not None else ']'
+        elif order_by is not None:
+            yield to_json({'next_after': next_after}) + '\n'
 
-        return jsonify(results)
+    # La conexión vuelve al pool al leer la última fila, o cuando se cierra la respuesta si el cliente se desconecta antes
+    closed = []
+    def close():
+        if len(closed) == 0:
+            closed.append(True)
+            cursor.close()
+            release_connection(conn)
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    response = Response(generate(), mimetype='application/x-ndjson' if output_format == 'ndjson' else 'application/json')
+    response.call_on_close(close)
+    return response
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,233 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common_utils import *
+from tracing import percentile
+from conversation_memory import ConversationMemory
+
+# CONSTANTS
+EVALUATION_WORKERS = 8 # Questions (or conversations) evaluated at the same time
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eval_results')
+
+# Evaluation runner of the questions of an Excel file (QUESTION, EXPECTED ANSWER and optionally CONVERSATION):
+# - independent mode: every question is searched, reranked, answered and evaluated on its own, several at the same time
+# - history mode: the conversations run at the same time, and the turns of every conversation in order with its history
+#   (the rows with the same CONVERSATION value, or the whole file as one conversation when the column does not exist)
+# Every row is appended to a JSONL checkpoint when it finishes, and a new run with the same output skips the rows done
+class EvaluationRunner:
+    def __init__(self, openai_config, ai_search_client, qa_eval, output_path, mode="independent", max_docs=10, workers=EVALUATION_WORKERS,
+                 rerank_mode=RERANK_MODE):
+        self.openai_config = openai_config
+        self.ai_search_client = ai_search_client
+        self.qa_eval = qa_eval
+        self.output_path = output_path
+        self.mode = mode
+        self.max_docs = max_docs
+        self.workers = workers
+        self.rerank_mode = rerank_mode
+        self.lock = threading.Lock()
+        self.completed = load_checkpoint(output_path)
+        self.done = 0
+        self.errors = 0
+        self.total = 0
+
+    # Evaluate the rows of a DataFrame and return the records of all of them (previous runs included)
+    def run(self, df):
+        conversations = get_conversations(df, self.mode)
+        self.total = sum(len(rows) for rows in conversations.values())
+        pending = sum(1 for rows in conversations.values() for row in rows if row["key"] not in self.completed)
+        print(f'Evaluating {self.total} questions in {len(conversations)} conversations ({self.mode} mode), '
+              f'{self.total - pending} already done in {self.output_path}, workers: {self.workers}')
+        start = time.perf_counter()
+        os.makedirs(os.path.dirname(os.path.abspath(self.output_path)), exist_ok=True)
+        with open(self.output_path, 'a', encoding='utf-8') as checkpoint:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(self.run_conversation, rows, checkpoint) for rows in conversations.values()]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+        elapsed = time.perf_counter() - start
+        print(f'Evaluated {self.done} questions in {elapsed:.1f} seconds ({self.done / elapsed if elapsed > 0 else 0.0:.2f} questions/sec), '
+              f'errors: {self.errors}')
+        return [self.completed[row["key"]] for rows in conversations.values() for row in rows if row["key"] in self.completed]
+
+    # Turns of a conversation in order: the history is rebuilt from the checkpoint for the turns already done
+    # In history mode the history is a ConversationMemory (last turns and a summary of the older ones)
+    def run_conversation(self, rows, checkpoint):
+        history = ConversationMemory(self.openai_config["openai_client"], self.openai_config["aoai_rerank_model"])
+        for row in rows:
+            record = self.completed.get(row["key"])
+            if record is None:
+                record = self.evaluate_row(row, history)
+                with self.lock:
+                    checkpoint.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                    checkpoint.flush()
+                    self.done += 1
+                    if record["error"] is None:
+                        self.completed[row["key"]] = record
+                    else:
+                        self.errors += 1
+                    print(f'[{len(self.completed)}/{self.total}] {record["timings"].get("total", 0):.1f}s '
+                          f'{"ERROR " + record["error"] if record["error"] else ""}question: {row["question"]}')
+                if record["error"] is not None and self.mode == "history":
+                    # The next turns depend on this answer, they run again in the next run
+                    return
+            if self.mode == "history":
+                history.add_turn(row["question"], record["answer"])
+
+    # Search, rerank, generate and evaluate one question
+    def evaluate_row(self, row, history):
+        openai_client = self.openai_config["openai_client"]
+        question = row["question"]
+        record = dict(row, mode=self.mode, rerank_mode=self.rerank_mode, query=None, answer=None, context=None, num_results=None, num_chunks=None,
+                      scores=None, timings={}, error=None,
+                      history_tokens=history.tokens() if self.mode == "history" else None)
+        start = time.perf_counter()
+        try:
+            # Rewrite the question with the history of the conversation
+            query = question
+            if self.mode == "history":
+                query = generate_search_query(openai_client, self.openai_config["aoai_deployment_name"], question, history) or question
+                record["timings"]["rewrite"] = round(time.perf_counter() - start, 3)
+            record["query"] = query
+
+            stage_start = time.perf_counter()
+            results, record["num_results"] = hybrid_search(self.ai_search_client, openai_client,
+                                                           self.openai_config["aoai_embedding_model"], query, self.max_docs)
+            record["timings"]["search"] = round(time.perf_counter() - stage_start, 3)
+
+            stage_start = time.perf_counter()
+            record["context"], record["num_chunks"] = get_filtered_chunks(openai_client, self.openai_config["aoai_rerank_model"], results, question,
+                                                                               mode=self.rerank_mode)
+            record["timings"]["rerank"] = round(time.perf_counter() - stage_start, 3)
+
+            stage_start = time.perf_counter()
+            if self.mode == "history":
+                answer = generate_answer_with_history(openai_client, self.openai_config["aoai_deployment_name"], record["context"], question, history)
+            else:
+                answer = generate_answer(openai_client, self.openai_config["aoai_deployment_name"], record["context"], question)
+            record["timings"]["generate"] = round(time.perf_counter() - stage_start, 3)
+            if answer is None or answer == 'ERROR':
+                raise Exception('the answer could not be generated')
+            record["answer"] = answer
+
+            if self.qa_eval is not None:
+                stage_start = time.perf_counter()
+                record["scores"] = json.loads(evaluate_answer(self.qa_eval, question, record["context"], answer, row["expected_answer"]))
+                record["timings"]["evaluate"] = round(time.perf_counter() - stage_start, 3)
+        except Exception as ex:
+            record["error"] = str(ex)
+        record["timings"]["total"] = round(time.perf_counter() - start, 3)
+        return record
+
+# Rows of the Excel file grouped by conversation, with a key that changes when the question or its position change
+def get_conversations(df, mode):
+    conversations = {}
+    for i, line in enumerate(df.to_dict(orient='records')):
+        if mode == "history":
+            conversation = str(line.get('CONVERSATION', 'default'))
+        else:
+            conversation = str(i)
+        question = str(line['QUESTION'])
+        turn = len(conversations.get(conversation, []))
+        conversations.setdefault(conversation, []).append({
+            "key": f'{conversation}-{turn}-{hashlib.sha1(question.encode("utf-8")).hexdigest()[:12]}',
+            "row": i,
+            "conversation": conversation,
+            "turn": turn,
+            "question": question,
+            "expected_answer": str(line.get('EXPECTED ANSWER', '')),
+        })
+    return conversations
+
+# Records of the rows finished without errors in a JSONL checkpoint (the last record of every row)
+def load_checkpoint(output_path):
+    completed = {}
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Last line of an interrupted run
+                continue
+            if record.get("error") is None:
+                completed[record["key"]] = record
+            else:
+                completed.pop(record["key"], None)
+    return completed
+
+# Mean of the numeric scores of the evaluator and percentiles of the timings
+def summarize_results(records):
+    scores = {}
+    timings = {}
+    for record in records:
+        for name, value in (record.get("scores") or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                scores.setdefault(name, []).append(value)
+        for stage, seconds in record["timings"].items():
+            timings.setdefault(stage, []).append(seconds)
+    return {
+        "questions": len(records),
+        "scores": {name: round(statistics.mean(values), 4) for name, values in scores.items()},
+        "timings": {stage: {"p50": percentile(values, 50), "p95": percentile(values, 95)} for stage, values in timings.items()},
+    }
+
+# Save the records as Parquet (requires pyarrow)
+def save_parquet(records, parquet_path):
+    try:
+        pd.DataFrame([dict(record, scores=json.dumps(record["scores"]), timings=json.dumps(record["timings"]))
+                      for record in records]).to_parquet(parquet_path, index=False)
+        print(f'Results saved in {parquet_path}')
+    except ImportError as ex:
+        print(f'ERROR save_parquet: {ex} (pip install pyarrow)')
+
+def get_qa_evaluator(openai_config):
+    from azure.ai.evaluation import QAEvaluator
+
+    model_config = {
+        "azure_endpoint": openai_config["aoai_endpoint"],
+        "api_key": openai_config["aoai_key"],
+        "azure_deployment": openai_config["aoai_rerank_model"],
+        "api_version": openai_config["api_version"]
+    }
+    return QAEvaluator(model_config=model_config)
+
+# python evaluation_runner.py [--input ground_truth.xlsx] [--mode independent|history] [--rerank-mode pointwise|listwise|cascade] [--workers 8] [--output results.jsonl]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel and resumable evaluation of the questions of an Excel file')
+    parser.add_argument('--input', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ground_truth.xlsx'))
+    parser.add_argument('--output', help='JSONL checkpoint (by default eval_results/<input>_<mode>[_<rerank mode>].jsonl), an existing file is resumed')
+    parser.add_argument('--mode', default='independent', choices=['independent', 'history'])
+    parser.add_argument('--workers', type=int, default=EVALUATION_WORKERS)
+    parser.add_argument('--max-docs', type=int, help='Documents retrieved (default 10 in independent mode and 50 in history mode)')
+    parser.add_argument('--index', default='docs', choices=['docs', 'regs', 'all'], help='all: both indexes at the same time with rank fusion')
+    parser.add_argument('--rerank-mode', default=RERANK_MODE, choices=['pointwise', 'listwise', 'cascade'])
+    parser.add_argument('--no-eval', action='store_true', help='Only generate the answers, without QAEvaluator')
+    parser.add_argument('--parquet', action='store_true', help='Also save the results as Parquet')
+    args = parser.parse_args()
+
+    rerank_suffix = f'_{args.rerank_mode}' if args.rerank_mode != RERANK_MODE else ''
+    output_path = args.output or os.path.join(RESULTS_DIR, f'{os.path.splitext(os.path.basename(args.input))[0]}_{args.mode}{rerank_suffix}.jsonl')
+    max_docs = args.max_docs or (50 if args.mode == 'history' else 10)
+    openai_config, ai_search_config = load_config()
+    qa_eval = None if args.no_eval else get_qa_evaluator(openai_config)
+    if args.index == 'all':
+        ai_search_client = {name: ai_search_config[f'ai_search_client_{name}'] for name in ('docs', 'regs')}
+    else:
+        ai_search_client = ai_search_config[f'ai_search_client_{args.index}']
+    runner = EvaluationRunner(openai_config, ai_search_client, qa_eval, output_path,
+                              args.mode, max_docs, args.workers, args.rerank_mode)
+    records = runner.run(pd.read_excel(args.input))
+    print(json.dumps(summarize_results(records), indent=2))
+    if args.parquet:
+        save_parquet(records, os.path.splitext(output_path)[0] + '.parquet')
@@ -0,0 +1,113 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common_utils import *
+
+# CONSTANTS
+TUNING_WORKERS = 8 # Questions searched and reranked at the same time
+MIN_RECALL = 0.95 # Minimum share of the chunks valid for the LLM re-ranker that the cascade must keep
+MIN_PRECISION = 0.9 # Minimum share of the chunks kept by the cascade that are valid for the LLM re-ranker
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eval_results')
+
+# Tuning of the thresholds of the cascade re-ranker with the questions of an Excel file:
+# 1. every question is searched and all its chunks are scored with the LLM re-ranker (pointwise), saving the semantic
+#    reranker score and the confidence of every chunk in a JSONL file (reused by the next runs)
+# 2. every pair of accept and reject scores is simulated over the saved chunks: the chunks over the accept score are kept,
+#    the ones under the reject score are dropped and the rest use the confidence of the LLM re-ranker. The result is compared
+#    with the LLM re-ranker alone (recall and precision of the valid chunks) together with the share of calls avoided
+# The early stop after MAX_GENERATE chunks is not simulated, it only avoids more calls
+def collect_scores(openai_config, ai_search_client, questions, output_path, max_docs, workers=TUNING_WORKERS):
+    def score_question(question):
+        results, _ = hybrid_search(ai_search_client, openai_config["openai_client"], openai_config["aoai_embedding_model"], question, max_docs)
+        ranks = rank_chunks(openai_config["openai_client"], openai_config["aoai_rerank_model"], results, question, mode="pointwise")
+        scores = {result['id']: get_reranker_score(result) for result in results}
+        return [{"question": question, "id": id, "reranker_score": scores.get(id), "confidence": int(confidence)}
+                for id, title, content, confidence, answer in ranks]
+
+    records = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, question_records in enumerate(executor.map(score_question, questions)):
+            print(f'[{i + 1}/{len(questions)}] {len(question_records)} chunks, question: {questions[i]}')
+            records += question_records
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return records
+
+def load_scores(output_path):
+    with open(output_path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# Recall, precision and calls avoided of a pair of thresholds compared with the LLM re-ranker alone
+def simulate_cascade(records, accept_score, reject_score):
+    valid = kept = kept_valid = avoided = 0
+    for record in records:
+        score = record["reranker_score"]
+        is_valid = record["confidence"] >= THRESHOLD_CONFIDENCE
+        if score is not None and score >= accept_score:
+            keep = True
+            avoided += 1
+        elif score is not None and score < reject_score:
+            keep = False
+            avoided += 1
+        else:
+            keep = is_valid
+        valid += is_valid
+        kept += keep
+        kept_valid += keep and is_valid
+    return {
+        "accept_score": accept_score,
+        "reject_score": reject_score,
+        "recall": round(kept_valid / valid, 4) if valid > 0 else 1.0,
+        "precision": round(kept_valid / kept, 4) if kept > 0 else 1.0,
+        "avoided_calls": round(avoided / len(records), 4) if len(records) > 0 else 0.0,
+    }
+
+# Every pair of thresholds in steps of 0.25, and the one that avoids more calls with the minimum recall and precision
+def tune_thresholds(records, min_recall=MIN_RECALL, min_precision=MIN_PRECISION):
+    steps = [i / 4 for i in range(17)]
+    grid = [simulate_cascade(records, accept, reject) for accept in steps for reject in steps if reject <= accept]
+    candidates = [result for result in grid if result["recall"] >= min_recall and result["precision"] >= min_precision]
+    best = max(candidates, key=lambda result: (result["avoided_calls"], result["recall"], result["precision"]), default=None)
+    return grid, best
+
+# python tune_cascade.py [--input ground_truth.xlsx] [--index docs|regs|all] [--refresh] [--min-recall 0.95] [--min-precision 0.9]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tuning of CASCADE_ACCEPT_SCORE and CASCADE_REJECT_SCORE with the questions of an Excel file')
+    parser.add_argument('--input', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ground_truth.xlsx'))
+    parser.add_argument('--output', help='JSONL file of the scores of the chunks (by default eval_results/<input>_cascade_scores.jsonl)')
+    parser.add_argument('--refresh', action='store_true', help='Search and rerank again even if the scores file exists')
+    parser.add_argument('--index', default='docs', choices=['docs', 'regs', 'all'])
+    parser.add_argument('--max-docs', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=TUNING_WORKERS)
+    parser.add_argument('--min-recall', type=float, default=MIN_RECALL)
+    parser.add_argument('--min-precision', type=float, default=MIN_PRECISION)
+    args = parser.parse_args()
+
+    output_path = args.output or os.path.join(RESULTS_DIR, f'{os.path.splitext(os.path.basename(args.input))[0]}_cascade_scores.jsonl')
+    if os.path.exists(output_path) and not args.refresh:
+        records = load_scores(output_path)
+        print(f'{len(records)} chunk scores loaded from {output_path}')
+    else:
+        openai_config, ai_search_config = load_config()
+        if args.index == 'all':
+            ai_search_client = {name: ai_search_config[f'ai_search_client_{name}'] for name in ('docs', 'regs')}
+        else:
+            ai_search_client = ai_search_config[f'ai_search_client_{args.index}']
+        questions = [str(question) for question in pd.read_excel(args.input)['QUESTION']]
+        records = collect_scores(openai_config, ai_search_client, questions, output_path, args.max_docs, args.workers)
+
+    grid, best = tune_thresholds(records, args.min_recall, args.min_precision)
+    current = simulate_cascade(records, CASCADE_ACCEPT_SCORE, CASCADE_REJECT_SCORE)
+    print(f'Current thresholds: {json.dumps(current)}')
+    if best is None:
+        print(f'No thresholds with recall >= {args.min_recall} and precision >= {args.min_precision}, use the pointwise re-ranker')
+    else:
+        print(f'Best thresholds: {json.dumps(best)}')
+        print(f'Set CASCADE_ACCEPT_SCORE = {best["accept_score"]} and CASCADE_REJECT_SCORE = {best["reject_score"]} in common_utils.py')
@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+import numpy as np
+
+# CONSTANTS
+ANSWER_CACHE_THRESHOLD = 0.97 # Minimum cosine similarity between rewritten queries to reuse an answer
+ANSWER_CACHE_MAX_ITEMS = 1000
+ANSWER_CACHE_TTL_SECONDS = 3600
+ANSWER_CACHE_VERSION_CHECK_SECONDS = 60 # Seconds between checks of the version of the index
+INDEX_MANIFESTS_DIR = os.getenv('INDEX_MANIFESTS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index_manifests'))
+
+# Semantic answer cache: the embedding of the rewritten query is the key, and the context and the answer are the value
+# The lookup is a vectorized nearest neighbour search over the embeddings of all the cached queries
+class SemanticAnswerCache:
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, max_items=ANSWER_CACHE_MAX_ITEMS, ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+                 version_check_seconds=ANSWER_CACHE_VERSION_CHECK_SECONDS):
+        self.threshold = threshold
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.version_check_seconds = version_check_seconds
+        self.lock = threading.Lock()
+        self.embeddings = None # Normalized embeddings, one row per slot
+        self.entries = [None] * max_items
+        self.created = np.zeros(max_items)
+        self.last_used = np.zeros(max_items)
+        self.used = np.zeros(max_items, dtype=bool)
+        self.index_version = None
+        self.version_checked = 0.0
+        self.counters = {"lookups": 0, "hits": 0, "expired": 0, "evictions": 0, "invalidations": 0, "saved_seconds": 0.0}
+
+    # Return the cached entry of the most similar query over the threshold, or None
+    def lookup(self, embedding):
+        start = time.perf_counter()
+        query = normalize(embedding)
+        with self.lock:
+            self.counters["lookups"] += 1
+            if self.embeddings is None or not self.used.any():
+                return None
+            now = time.time()
+            expired = self.used & (now - self.created > self.ttl_seconds)
+            if expired.any():
+                self.counters["expired"] += int(expired.sum())
+                self.remove(expired)
+            similarities = np.where(self.used, self.embeddings @ query, -1.0)
+            slot = int(np.argmax(similarities))
+            if similarities[slot] < self.threshold:
+                return None
+            self.last_used[slot] = now
+            entry = dict(self.entries[slot])
+            entry["similarity"] = float(similarities[slot])
+            self.counters["hits"] += 1
+            self.counters["saved_seconds"] += max(0.0, entry["latency"] - (time.perf_counter() - start))
+            return entry
+
+    # Store the context and the answer of a query, replacing the least recently used entry when the cache is full
+    def add(self, embedding, query, valid_chunks, num_chunks, answer, latency):
+        vector = normalize(embedding)
+        with self.lock:
+            if self.embeddings is None:
+                self.embeddings = np.zeros((self.max_items, len(vector)), dtype=np.float32)
+            free = np.flatnonzero(~self.used)
+            if len(free) > 0:
+                slot = int(free[0])
+            else:
+                slot = int(np.argmin(self.last_used))
+                self.counters["evictions"] += 1
+            now = time.time()
+            self.embeddings[slot] = vector
+            self.entries[slot] = {"query": query, "valid_chunks": valid_chunks, "num_chunks": num_chunks,
+                                  "answer": answer, "latency": latency}
+            self.created[slot] = now
+            self.last_used[slot] = now
+            self.used[slot] = True
+
+    def remove(self, mask):
+        self.used[mask] = False
+        for slot in np.flatnonzero(mask):
+            self.entries[slot] = None
+
+    # Remove all the entries, for example after rebuilding the index
+    def invalidate(self):
+        with self.lock:
+            self.remove(self.used.copy())
+            self.counters["invalidations"] += 1
+
+    # Invalidate the cache when the version of the index changes (checked at most every version_check_seconds)
+    def check_index_version(self, get_version):
+        now = time.time()
+        with self.lock:
+            if now - self.version_checked < self.version_check_seconds:
+                return
+            self.version_checked = now
+        try:
+            version = get_version()
+        except Exception as ex:
+            print(f'ERROR check_index_version: {ex}')
+            return
+        if self.index_version is not None and version != self.index_version:
+            print(f'Index version changed ({self.index_version} -> {version}), invalidating the answer cache')
+            self.invalidate()
+        self.index_version = version
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["items"] = int(self.used.sum())
+            stats["hit_rate"] = round(stats["hits"] / stats["lookups"], 4) if stats["lookups"] > 0 else 0.0
+            stats["saved_seconds"] = round(stats["saved_seconds"], 3)
+        return stats
+
+# Normalize an embedding so the dot product is the cosine similarity
+def normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+# Version of an AI Search index: the number of documents and the version stamp written by index_documents
+# (indexing_utils.save_manifest) in INDEX_MANIFESTS_DIR, that changes with any added, changed or deleted chunk.
+# Without the stamp (an app not sharing the folder with the indexing), only the number of documents is compared
+def get_index_version(ai_search_client, index_name=None):
+    version = str(ai_search_client.get_document_count())
+    version_path = os.path.join(INDEX_MANIFESTS_DIR, f'{index_name}.version') if index_name is not None else None
+    if version_path is not None and os.path.exists(version_path):
+        with open(version_path, 'r', encoding='utf-8') as f:
+            version += f'-{f.read().strip()}'
+    return version
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+# Shared cache of the process, configured with ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_MAX_ITEMS and ANSWER_CACHE_TTL_SECONDS
+def get_answer_cache():
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = SemanticAnswerCache(threshold=float(os.getenv('ANSWER_CACHE_THRESHOLD', ANSWER_CACHE_THRESHOLD)),
+                                                max_items=int(os.getenv('ANSWER_CACHE_MAX_ITEMS', ANSWER_CACHE_MAX_ITEMS)),
+                                                ttl_seconds=float(os.getenv('ANSWER_CACHE_TTL_SECONDS', ANSWER_CACHE_TTL_SECONDS)))
+    return _answer_cache
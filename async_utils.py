@@ -0,0 +1,444 @@
+import asyncio
+import json
+import re
+import statistics
+import sys
+import threading
+import time
+import httpx
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+
+from common_utils import *
+from tracing import span, bind_context, create_with_retries_async, record_usage, percentile, configure_tracing, get_tracer, print_summary
+from resilience import create_chat_completion_async
+
+# Background event loop shared by the process: Streamlit runs every rerun of the script in a different thread,
+# and the async clients must always be used from the same loop to reuse their connections
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+def get_event_loop():
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(target=_event_loop.run_forever, name='rag-event-loop', daemon=True).start()
+    return _event_loop
+
+# Run a coroutine in the background event loop and wait for its result
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(bind_context(coro), get_event_loop()).result()
+
+# Copy of the configuration returned by load_config with async Azure OpenAI and AI Search clients
+def get_async_config(openai_config, ai_search_config):
+    async_openai_config = dict(openai_config)
+    limits = httpx.Limits(max_connections=AOAI_MAX_CONNECTIONS, max_keepalive_connections=AOAI_KEEPALIVE_CONNECTIONS,
+                          keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS)
+    async_openai_config["openai_client"] = AsyncAzureOpenAI(azure_endpoint=openai_config["aoai_endpoint"],
+                                                            api_key=openai_config["aoai_key"],
+                                                            api_version=openai_config["api_version"],
+                                                            http_client=DefaultAsyncHttpxClient(limits=limits))
+    async_ai_search_config = dict(ai_search_config)
+    async_ai_search_config["ai_search_client_regs"] = AsyncSearchClient(endpoint=ai_search_config["ai_search_endpoint"],
+                                                                        index_name=ai_search_config["ai_search_index_name_regs"],
+                                                                        credential=ai_search_config["ai_search_credential"])
+    async_ai_search_config["ai_search_client_docs"] = AsyncSearchClient(endpoint=ai_search_config["ai_search_endpoint"],
+                                                                        index_name=ai_search_config["ai_search_index_name_docs"],
+                                                                        credential=ai_search_config["ai_search_credential"])
+    return async_openai_config, async_ai_search_config
+
+_shared_async_config = None
+_shared_async_config_lock = threading.Lock()
+_warm_up_future = None
+
+# Async configuration of get_shared_config shared by the process, its clients are used from the background event loop
+def get_shared_async_config():
+    global _shared_async_config
+    with _shared_async_config_lock:
+        if _shared_async_config is None:
+            _shared_async_config = get_async_config(*get_shared_config())
+    return _shared_async_config
+
+# Warm-up of the async clients in the background event loop, started only once (see warm_up)
+def start_warm_up_async(async_openai_config, async_ai_search_config):
+    global _warm_up_future
+    with _shared_async_config_lock:
+        if _warm_up_future is None:
+            _warm_up_future = asyncio.run_coroutine_threadsafe(warm_up_async(async_openai_config, async_ai_search_config), get_event_loop())
+    return _warm_up_future
+
+async def warm_up_async(async_openai_config, async_ai_search_config):
+    timings = {}
+    start = time.perf_counter()
+    responses = await asyncio.gather(async_ai_search_config["ai_search_client_docs"].get_document_count(),
+                                     async_ai_search_config["ai_search_client_regs"].get_document_count(),
+                                     async_openai_config["openai_client"].embeddings.create(model=async_openai_config["aoai_embedding_model"],
+                                                                                            input=["warm-up"]),
+                                     return_exceptions=True)
+    for response in responses:
+        if isinstance(response, Exception):
+            print(f'ERROR warm_up_async: {response}')
+    timings["total"] = round(time.perf_counter() - start, 3)
+    print(f'Warm-up (async clients): {timings}')
+    return timings
+
+# Create embedding from a text, using the embedding cache
+# The embedding cache (SQLite and a lock shared with other threads) is used in worker threads, not in the event loop
+async def create_embedding_async(openai_client, aoai_embedding_model, text):
+    with span("embedding", texts=1) as embedding_span:
+        cache = get_embedding_cache()
+        embedding = await asyncio.to_thread(cache.get, aoai_embedding_model, text) if cache is not None else None
+        embedding_span.set(cache_misses=int(embedding is None))
+        if embedding is None:
+            response = await create_with_retries_async(
+                openai_client.embeddings,
+                model=aoai_embedding_model,
+                input=[text]
+            )
+            record_usage(response)
+            embedding = response.data[0].embedding
+            if cache is not None:
+                # The answer does not wait for the write
+                save_task = asyncio.create_task(asyncio.to_thread(cache.put, aoai_embedding_model, text, embedding))
+                _background_tasks.add(save_task)
+                save_task.add_done_callback(_background_tasks.discard)
+    return embedding
+
+_background_tasks = set() # Running tasks nobody waits for, referenced until they finish
+
+# Semantic Hybrid Search in AI Search with the async client
+async def semantic_hybrid_search_async(ai_search_client, openai_client, aoai_embedding_model, query, max_docs):
+    with span("hybrid_search", max_docs=max_docs):
+        embedding = await create_embedding_async(openai_client, aoai_embedding_model, query)
+        documents, count = await search_index_async(ai_search_client, query, embedding, max_docs)
+
+    return documents, count
+
+async def search_index_async(ai_search_client, query, embedding, max_docs, index_name=None):
+    with span("search", index=index_name) as search_span:
+        results = await ai_search_client.search(**get_search_parameters(query, embedding, max_docs))
+        documents = [result async for result in results]
+        search_span.set(num_results=len(documents))
+    return documents, await results.get_count()
+
+# Search in one index, or in several at the same time when ai_search_client is a dict {index name: client}
+async def hybrid_search_async(ai_search_client, openai_client, aoai_embedding_model, query, max_docs):
+    if isinstance(ai_search_client, dict):
+        return await federated_search_async(ai_search_client, openai_client, aoai_embedding_model, query, max_docs)
+    return await semantic_hybrid_search_async(ai_search_client, openai_client, aoai_embedding_model, query, max_docs)
+
+# Federated Semantic Hybrid Search with the async clients (see federated_search), the search of an index is cancelled
+# when its timeout expires
+async def federated_search_async(ai_search_clients, openai_client, aoai_embedding_model, query, max_docs, timeout=FEDERATED_SEARCH_TIMEOUT):
+    with span("federated_search", indexes=len(ai_search_clients), max_docs=max_docs) as federated_span:
+        embedding = await create_embedding_async(openai_client, aoai_embedding_model, query)
+        searches = [asyncio.wait_for(search_index_async(client, query, embedding, max_docs, name), get_index_timeout(timeout, name))
+                    for name, client in ai_search_clients.items()]
+        responses = await asyncio.gather(*searches, return_exceptions=True)
+        documents, count, failed = merge_index_results(dict(zip(ai_search_clients, responses)), max_docs, timeout)
+        federated_span.set(num_results=len(documents), failed=failed)
+    return documents, count
+
+# Send a list of messages to the model deployed on Azure OpenAI with the async client (see call_aoai)
+async def call_aoai_messages_async(aoai_client, aoai_model_name, messages, temperature, max_tokens, response_format=None,
+                                   operation="chat", deadline=AOAI_DEADLINE_SECONDS):
+    response, _ = await call_aoai_completion_async(aoai_client, aoai_model_name, messages, temperature, max_tokens, response_format,
+                                                   operation, deadline)
+    return response
+
+# Content and finish reason of a call with the async client, (None, None) when it failed
+async def call_aoai_completion_async(aoai_client, aoai_model_name, messages, temperature, max_tokens, response_format=None,
+                                     operation="chat", deadline=AOAI_DEADLINE_SECONDS):
+    extra_parameters = {"response_format": response_format} if response_format is not None else {}
+    try:
+        with span("aoai", model=aoai_model_name):
+            response = await create_chat_completion_async(
+                aoai_client,
+                aoai_model_name,
+                operation,
+                deadline,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                **extra_parameters
+            )
+        json_response = json.loads(response.model_dump_json())
+        choice = json_response['choices'][0]
+        return choice['message']['content'], choice['finish_reason']
+    except Exception as ex:
+        print(f'ERROR call_aoai_async: {ex}')
+        return None, None
+
+async def call_aoai_async(aoai_client, aoai_model_name, system_prompt, user_prompt, temperature, max_tokens, response_format=None,
+                          operation="chat", deadline=AOAI_DEADLINE_SECONDS):
+    messages = [{'role': 'system', 'content': system_prompt},
+                {'role': 'user', 'content': user_prompt}]
+    return await call_aoai_messages_async(aoai_client, aoai_model_name, messages, temperature, max_tokens, response_format,
+                                          operation, deadline)
+
+# Calculate the confidence and generate the 'answer' from the content
+async def calculate_rank_async(aoai_client, aoai_model_name, id, title, content, question):
+    with span("rerank_chunk", chunk_id=id):
+        response = await call_aoai_async(aoai_client, aoai_model_name, SYSTEM_PROMPT_TO_CALCULATE_RANK,
+                                         get_rank_user_prompt(content, question), 0.0, RANK_MAX_TOKENS,
+                                         operation="rerank", deadline=RERANK_DEADLINE_SECONDS)
+    confidence, answer = parse_rank_response(response)
+    return id, title, content, confidence, answer
+
+# Calculate the confidence and the 'answer' of several chunks with one call (listwise re-ranker), scoring again the
+# chunks without a valid score in two concurrent batches, down to one call per chunk (see calculate_rank_batch)
+async def calculate_rank_batch_async(aoai_client, aoai_model_name, results, question):
+    messages = [{'role': 'system', 'content': SYSTEM_PROMPT_TO_CALCULATE_RANK_BATCH},
+                {'role': 'user', 'content': get_rank_batch_user_prompt(results, question)}]
+    with span("rerank_batch", chunks=len(results)):
+        response, finish_reason = await call_aoai_completion_async(aoai_client, aoai_model_name, messages, 0.0,
+                                                                   get_rank_batch_max_tokens(len(results)),
+                                                                   response_format=RANK_BATCH_RESPONSE_FORMAT,
+                                                                   operation="rerank_batch", deadline=RERANK_DEADLINE_SECONDS)
+    ranks = get_batch_ranks(results, response, finish_reason)
+    failed = get_failed_positions(ranks) if response is not None else []
+    if len(failed) == 1:
+        result = results[failed[0]]
+        ranks[failed[0]] = await calculate_rank_async(aoai_client, aoai_model_name, result['id'], result['title'], result['content'], question)
+    elif len(failed) > 1:
+        half = (len(failed) + 1) // 2
+        parts = (failed[:half], failed[half:])
+        retried = await asyncio.gather(*[calculate_rank_batch_async(aoai_client, aoai_model_name, [results[i] for i in positions], question)
+                                         for positions in parts])
+        for positions, part_ranks in zip(parts, retried):
+            for position, rank in zip(positions, part_ranks):
+                ranks[position] = rank
+    return ranks
+
+# Re-ranker: calculate concurrently the percentage of confidence and the answer comparing with the query
+async def get_filtered_chunks_async(aoai_client, aoai_model_name, results, query, mode=RERANK_MODE, batch_size=RERANK_BATCH_SIZE):
+    with span("rerank", mode=mode, chunks=len(results)) as rerank_span:
+        ranks = await rank_chunks_async(aoai_client, aoai_model_name, results, query, mode, batch_size)
+        valid_chunks, num_chunks = select_chunks(ranks)
+        rerank_span.set(selected=num_chunks)
+    return valid_chunks, num_chunks
+
+async def rank_chunks_async(aoai_client, aoai_model_name, results, query, mode=RERANK_MODE, batch_size=RERANK_BATCH_SIZE):
+    if mode == "cascade":
+        return await rank_chunks_cascade_async(aoai_client, aoai_model_name, results, query)
+    semaphore = asyncio.Semaphore(MAX_RETRIEVE)
+
+    async def rank(result):
+        async with semaphore:
+            return await calculate_rank_async(aoai_client, aoai_model_name, result['id'], result['title'], result['content'], query)
+
+    async def rank_batch(batch):
+        async with semaphore:
+            return await calculate_rank_batch_async(aoai_client, aoai_model_name, batch, query)
+
+    if mode == "listwise":
+        batches = await asyncio.gather(*[rank_batch(results[i:i + batch_size]) for i in range(0, len(results), batch_size)])
+        return fill_failed_ranks([rank for batch in batches for rank in batch], results)
+    return fill_failed_ranks(await asyncio.gather(*[rank(result) for result in results]), results)
+
+# Cascade re-ranker with the async client (see rank_chunks_cascade)
+async def rank_chunks_cascade_async(aoai_client, aoai_model_name, results, query, wave_size=CASCADE_WAVE_SIZE,
+                                    accept_score=CASCADE_ACCEPT_SCORE, reject_score=CASCADE_REJECT_SCORE):
+    ranks, uncertain, rejected = split_cascade(results, accept_score, reject_score)
+    accepted = len(ranks)
+    calls = 0
+    for i in range(0, len(uncertain), wave_size):
+        if count_valid_ranks(ranks) >= MAX_GENERATE:
+            break
+        wave = uncertain[i:i + wave_size]
+        ranks += fill_failed_ranks(await asyncio.gather(*[calculate_rank_async(aoai_client, aoai_model_name, result['id'], result['title'],
+                                                                               result['content'], query) for result in wave]), wave)
+        calls += len(wave)
+    report_cascade(len(results), accepted, rejected, calls)
+    return ranks
+
+# GENERATE THE ANSWER
+async def generate_answer_async(aoai_client, aoai_deployment_name, valid_chunks, question):
+    user_prompt = f"**Knowledge base:**\nSections: {valid_chunks}\n**Question:** {question}\nFinal Response:"
+    with span("generate"):
+        answer = await call_aoai_async(aoai_client, aoai_deployment_name, SYSTEM_PROMPT_GENERATE_ANSWER, user_prompt, 0.0, 1200,
+                                       operation="generate", deadline=GENERATE_DEADLINE_SECONDS)
+    if answer == None: answer = 'ERROR'
+    return answer
+
+async def generate_answer_with_history_async(aoai_client, aoai_deployment_name, valid_chunks, question, history):
+    messages = get_answer_messages(valid_chunks, question, history)
+    with span("generate"):
+        return await call_aoai_messages_async(aoai_client, aoai_deployment_name, messages, 0.0, 1200,
+                                              operation="generate", deadline=GENERATE_DEADLINE_SECONDS)
+
+# Generate the search query for the user question based on the conversation history
+async def generate_search_query_async(aoai_client, aoai_deployment_name, query, history):
+    curr_messages = get_search_query_messages(query, history)
+    with span("rewrite"):
+        return await call_aoai_messages_async(aoai_client, aoai_deployment_name, curr_messages, 0.0, 1200,
+                                              operation="rewrite", deadline=REWRITE_DEADLINE_SECONDS)
+
+# Normalize a query to compare the rewritten query with the original question
+def normalize_query(query):
+    query = re.sub(r'\s+', ' ', query.strip().strip('"\'').lower())
+    return query.rstrip('?.!¿¡ ')
+
+# Retrieval: rewrite, search and filter chunks
+# While the query is being rewritten the original question is embedded and searched, and that speculative
+# result is used when the rewritten query is the same question, so the answer does not change
+# With an answer_cache, the context and answer of a similar rewritten query are reused ("cache_hit": True). The cache is
+# only used for the first question of a conversation: the answers are generated with the history of their session
+async def retrieve_async(openai_config, ai_search_client, question, history, max_docs=10, answer_cache=None):
+    openai_client = openai_config["openai_client"]
+    start = time.perf_counter()
+    timings = {}
+    if has_history(history):
+        answer_cache = None
+
+    rewrite_task = asyncio.create_task(generate_search_query_async(openai_client, openai_config["aoai_deployment_name"], question, history))
+    speculative_task = asyncio.create_task(hybrid_search_async(ai_search_client, openai_client,
+                                                               openai_config["aoai_embedding_model"], question, max_docs))
+    query = await rewrite_task
+    timings["rewrite"] = time.perf_counter() - start
+
+    speculative_hit = query is None or normalize_query(query) == normalize_query(question)
+    if speculative_hit:
+        query = question
+
+    # Look up the rewritten query in the answer cache
+    query_embedding = None
+    if answer_cache is not None:
+        query_embedding = await create_embedding_async(openai_client, openai_config["aoai_embedding_model"], query)
+        cached = answer_cache.lookup(query_embedding)
+        timings["cache"] = time.perf_counter() - start - timings["rewrite"]
+        if cached is not None:
+            cancel_task(speculative_task)
+            return {
+                "query": query,
+                "num_results": 0,
+                "valid_chunks": cached["valid_chunks"],
+                "num_chunks": cached["num_chunks"],
+                "answer": cached["answer"],
+                "cache_hit": True,
+                "query_embedding": query_embedding,
+                "speculative_hit": False,
+                "timings": {stage: round(seconds, 3) for stage, seconds in timings.items()},
+            }
+
+    search_start = time.perf_counter()
+    if speculative_hit:
+        results, num_results = await speculative_task
+    else:
+        cancel_task(speculative_task)
+        results, num_results = await hybrid_search_async(ai_search_client, openai_client,
+                                                         openai_config["aoai_embedding_model"], query, max_docs)
+    timings["search"] = time.perf_counter() - search_start
+
+    rerank_start = time.perf_counter()
+    valid_chunks, num_chunks = await get_filtered_chunks_async(openai_client, openai_config["aoai_rerank_model"], results, question)
+    timings["rerank"] = time.perf_counter() - rerank_start
+
+    return {
+        "query": query,
+        "num_results": num_results,
+        "valid_chunks": valid_chunks,
+        "num_chunks": num_chunks,
+        "cache_hit": False,
+        "query_embedding": query_embedding,
+        "speculative_hit": speculative_hit,
+        "timings": {stage: round(seconds, 3) for stage, seconds in timings.items()},
+    }
+
+# History with turns or a summary of the earlier conversation (list of {"question", "answer"} or ConversationMemory)
+def has_history(history):
+    return history is not None and (len(history) > 0 or bool(getattr(history, 'summary', None)))
+
+# Cancel a task that is not needed anymore, ignoring its result
+def cancel_task(task):
+    task.cancel()
+    task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+# End-to-end process: retrieve the chunks and generate the answer, RuntimeError when the answer cannot be generated
+async def rag_answer_async(openai_config, ai_search_client, question, history, max_docs=10, answer_cache=None):
+    start = time.perf_counter()
+    with span("rag_answer", mode="async") as answer_span:
+        result = await retrieve_async(openai_config, ai_search_client, question, history, max_docs, answer_cache)
+        result["trace_id"] = answer_span.trace_id
+        answer_span.set(cache_hit=result["cache_hit"], speculative_hit=result["speculative_hit"], num_chunks=result["num_chunks"])
+        if result["cache_hit"]:
+            result["timings"]["total"] = round(time.perf_counter() - start, 3)
+            return result
+
+        generate_start = time.perf_counter()
+        result["answer"] = await generate_answer_with_history_async(openai_config["openai_client"], openai_config["aoai_deployment_name"],
+                                                                    result["valid_chunks"], question, history)
+        if result["answer"] is None:
+            raise RuntimeError('The answer could not be generated')
+        result["timings"]["generate"] = round(time.perf_counter() - generate_start, 3)
+        result["timings"]["total"] = round(time.perf_counter() - start, 3)
+    if answer_cache is not None:
+        add_to_answer_cache(answer_cache, result, result["timings"]["total"])
+    return result
+
+# Store an answer in the answer cache, only when it was generated with some context
+def add_to_answer_cache(answer_cache, result, latency):
+    if result["num_chunks"] > 0 and result["answer"] and result["query_embedding"] is not None:
+        answer_cache.add(result["query_embedding"], result["query"], result["valid_chunks"], result["num_chunks"], result["answer"], latency)
+
+# Same end-to-end process with the sync functions of common_utils
+def rag_answer(openai_config, ai_search_client, question, history, max_docs=10):
+    openai_client = openai_config["openai_client"]
+    start = time.perf_counter()
+    with span("rag_answer", mode="sync") as answer_span:
+        # Without a rewritten query (failed call) the question is searched, as in retrieve_async
+        query = generate_search_query(openai_client, openai_config["aoai_deployment_name"], question, history) or question
+        results, num_results = hybrid_search(ai_search_client, openai_client, openai_config["aoai_embedding_model"], query, max_docs)
+        valid_chunks, num_chunks = get_filtered_chunks(openai_client, openai_config["aoai_rerank_model"], results, question)
+        answer = generate_answer_with_history(openai_client, openai_config["aoai_deployment_name"], valid_chunks, question, history)
+        answer_span.set(num_chunks=num_chunks)
+        if answer is None:
+            raise RuntimeError('The answer could not be generated')
+    return {
+        "query": query,
+        "num_results": num_results,
+        "valid_chunks": valid_chunks,
+        "num_chunks": num_chunks,
+        "answer": answer,
+        "trace_id": answer_span.trace_id,
+        "timings": {"total": round(time.perf_counter() - start, 3)},
+    }
+
+# Side by side latency of the sync and async end-to-end processes for a list of questions
+def compare_latency(openai_config, ai_search_config, questions, max_docs=10):
+    async_openai_config, async_ai_search_config = get_async_config(openai_config, ai_search_config)
+    latencies = {"sync": [], "async": []}
+    speculative_hits = 0
+    for i, question in enumerate(questions):
+        sync_result = rag_answer(openai_config, ai_search_config["ai_search_client_docs"], question, [], max_docs)
+        async_result = run_async(rag_answer_async(async_openai_config, async_ai_search_config["ai_search_client_docs"], question, [], max_docs))
+        latencies["sync"].append(sync_result["timings"]["total"])
+        latencies["async"].append(async_result["timings"]["total"])
+        speculative_hits += async_result["speculative_hit"]
+        print(f'[{i + 1}] sync: {sync_result["timings"]["total"]:.2f}s, async: {async_result["timings"]["total"]:.2f}s, '
+              f'same answer: {sync_result["answer"] == async_result["answer"]}, question: {question}')
+
+    summary = {}
+    for mode, values in latencies.items():
+        summary[mode] = {"p50": percentile(values, 50), "p95": percentile(values, 95), "mean": round(statistics.mean(values), 3) if values else 0.0}
+    summary["speculative_hits"] = speculative_hits
+    print(f'{"":>6} {"p50":>8} {"p95":>8} {"mean":>8}')
+    for mode in latencies:
+        print(f'{mode:>6} {summary[mode]["p50"]:>8.2f} {summary[mode]["p95"]:>8.2f} {summary[mode]["mean"]:>8.2f}')
+    print(f'Speculative search used in {speculative_hits} of {len(questions)} questions')
+    return summary
+
+# Compare the latency with the questions of the evaluation: python async_utils.py [ground_truth.xlsx] [max_questions]
+if __name__ == '__main__':
+    import pandas as pd
+
+    input_file = sys.argv[1] if len(sys.argv) > 1 else '5_evaluation/ground_truth.xlsx'
+    max_questions = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    questions = pd.read_excel(input_file)['QUESTION'].tolist()[:max_questions]
+    openai_config, ai_search_config = load_config()
+    # With RAG_TRACING=1 the latency and tokens of every stage are summarized at the end
+    configure_tracing()
+    print(json.dumps(compare_latency(openai_config, ai_search_config, questions), indent=2))
+    if get_tracer() is not None:
+        print_summary(get_tracer().summary())
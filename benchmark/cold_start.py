@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.abspath(os.path.join(BENCHMARK_DIR, '..')))
+
+# CONSTANTS
+COLD_START_QUESTION = 'What is included in my Northwind Health Plus plan that is not in standard?'
+RESULT_PREFIX = 'COLD_START_RESULT '
+
+# Measurement of the cold start of a new process of the chat app against the fake services: every run is a new Python
+# process (like a new container) that imports the modules, creates the clients with get_shared_config, optionally runs
+# the warm-up, and answers the same question twice (rewrite, search, rerank and generation, like the chat app).
+# The difference between the first and the second question is the cost that a new process adds to its first user.
+def run_child(warm):
+    timings = {"interpreter": round(time.time() - float(os.environ['COLD_START_T0']), 3)}
+    start = time.perf_counter()
+    from common_utils import (get_shared_config, warm_up, generate_search_query, semantic_hybrid_search,
+                              get_filtered_chunks, generate_answer_with_history)
+    timings["import"] = round(time.perf_counter() - start, 3)
+
+    step_start = time.perf_counter()
+    openai_config, ai_search_config = get_shared_config()
+    timings["config"] = round(time.perf_counter() - step_start, 3)
+    if warm:
+        step_start = time.perf_counter()
+        warm_up(openai_config, ai_search_config)
+        timings["warm_up"] = round(time.perf_counter() - step_start, 3)
+
+    openai_client = openai_config["openai_client"]
+    for name in ("first_question", "second_question"):
+        step_start = time.perf_counter()
+        query = generate_search_query(openai_client, openai_config["aoai_deployment_name"], COLD_START_QUESTION, [])
+        results, _ = semantic_hybrid_search(ai_search_config["ai_search_client_docs"], openai_client, openai_config["aoai_embedding_model"],
+                                            query or COLD_START_QUESTION, 10)
+        valid_chunks, _ = get_filtered_chunks(openai_client, openai_config["aoai_rerank_model"], results, COLD_START_QUESTION)
+        generate_answer_with_history(openai_client, openai_config["aoai_deployment_name"], valid_chunks, COLD_START_QUESTION, [])
+        timings[name] = round(time.perf_counter() - step_start, 3)
+    print(RESULT_PREFIX + json.dumps(timings))
+
+# Environment of a new process pointing the configuration of load_config to the fake services
+def get_child_env(services):
+    from run_benchmark import INDEX_NAME, API_VERSION, DEPLOYMENT_NAME, EMBEDDING_MODEL, RERANK_MODEL
+
+    env = dict(os.environ)
+    env.update({
+        "AZURE_OPENAI_ENDPOINT": services.endpoint,
+        "AZURE_OPENAI_API_KEY": "fake",
+        "AZURE_OPENAI_API_VERSION": API_VERSION,
+        "AZURE_OPENAI_DEPLOYMENT_NAME": DEPLOYMENT_NAME,
+        "AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME": EMBEDDING_MODEL,
+        "AZURE_OPENAI_RERANK_DEPLOYMENT_NAME": RERANK_MODEL,
+        "SEARCH_SERVICE_ENDPOINT": services.endpoint,
+        "SEARCH_SERVICE_QUERY_KEY": "fake",
+        "SEARCH_INDEX_NAME_REGS": INDEX_NAME,
+        "SEARCH_INDEX_NAME_DOCS": INDEX_NAME,
+        # Without the embedding cache, so the first question really calls the embedding model
+        "EMBEDDING_CACHE_PATH": "",
+        "RAG_TRACING": "0",
+    })
+    return env
+
+def run_process(env, warm):
+    env = dict(env, COLD_START_T0=str(time.time()))
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'] + (['--warm'] if warm else []),
+                            env=env, capture_output=True, text=True, check=True).stdout
+    timings = json.loads([line for line in output.splitlines() if line.startswith(RESULT_PREFIX)][-1][len(RESULT_PREFIX):])
+    timings["process"] = round(time.perf_counter() - start, 3)
+    return timings
+
+# Median of every step of several new processes, without and with the warm-up
+def run_cold_start(profile="azure", runs=3, seed=0):
+    from run_benchmark import load_corpus, load_index
+    from fake_services import FakeServices
+
+    report = {"profile": profile, "runs": runs}
+    with FakeServices(profile, seed) as services:
+        load_index(services, load_corpus())
+        env = get_child_env(services)
+        for warm in (False, True):
+            results = [run_process(env, warm) for _ in range(runs)]
+            report["warm_up" if warm else "no_warm_up"] = {step: round(statistics.median(result[step] for result in results), 3)
+                                                           for step in results[0]}
+    return report
+
+# python benchmark/cold_start.py [--profile azure] [--runs 3]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold start and first question latency of a new process of the chat app')
+    parser.add_argument('--profile', default='azure')
+    parser.add_argument('--runs', type=int, default=3, help='New processes measured with and without warm-up')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file of the results')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--warm', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.warm)
+        sys.exit(0)
+    report = run_cold_start(args.profile, args.runs, args.seed)
+    for mode in ("no_warm_up", "warm_up"):
+        print(f'{mode}: {json.dumps(report[mode])}')
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results saved in {args.output}')
@@ -0,0 +1,508 @@
+import base64
+import json
+import math
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.parse
+import uuid
+import zlib
+from array import array
+from email.utils import formatdate
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from prompts import SYSTEM_PROMPT_TO_CALCULATE_RANK, SYSTEM_PROMPT_TO_CALCULATE_RANK_BATCH, SYSTEM_PROMPT_REWRITE_QUERY
+from local_search import LocalSearchClient
+
+# CONSTANTS
+EMBEDDINGS_DIMENSIONS = 1536
+ANSWER_WORDS = 150 # Words of the generated answers
+RANK_ANSWER_WORDS = 60 # Words of the 'answer' of every chunk in the re-ranker responses
+BLOB_ACCOUNT = 'devstoreaccount1' # Account and key of the Azurite emulator, used in the connection string of the fake blob storage
+BLOB_ACCOUNT_KEY = 'Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw=='
+BLOB_LIST_MAX_RESULTS = 5000
+
+# Behaviour of every service: lognormal latency (median and sigma), latency per generated token,
+# rate limit (requests per second and burst, None for no limit) and probability of a random 429
+SERVICE_PROFILES = {
+    # No latency: measures the overhead of the client code
+    "local": {
+        "chat":       {"median_ms": 0, "sigma": 0.0, "per_token_ms": 0.0, "rps": None, "burst": None, "throttle_rate": 0.0},
+        "embeddings": {"median_ms": 0, "sigma": 0.0, "per_token_ms": 0.0, "rps": None, "burst": None, "throttle_rate": 0.0},
+        "search":     {"median_ms": 0, "sigma": 0.0, "per_token_ms": 0.0, "rps": None, "burst": None, "throttle_rate": 0.0},
+        "index":      {"median_ms": 0, "sigma": 0.0, "per_token_ms": 0.0, "rps": None, "burst": None, "throttle_rate": 0.0},
+        "analyze":    {"median_ms": 0, "sigma": 0.0, "per_token_ms": 0.0, "rps": None, "burst": None, "throttle_rate": 0.0},
+        "blob":       {"median_ms": 0, "sigma": 0.0, "per_token_ms": 0.0, "rps": None, "burst": None, "throttle_rate": 0.0},
+    },
+    # Latencies in the range of a standard Azure OpenAI deployment and a basic AI Search service, scaled down 10x
+    "azure": {
+        "chat":       {"median_ms": 40, "sigma": 0.4, "per_token_ms": 1.0, "rps": None, "burst": None, "throttle_rate": 0.0},
+        "embeddings": {"median_ms": 8, "sigma": 0.3, "per_token_ms": 0.0, "rps": None, "burst": None, "throttle_rate": 0.0},
+        "search":     {"median_ms": 12, "sigma": 0.3, "per_token_ms": 0.0, "rps": None, "burst": None, "throttle_rate": 0.0},
+        "index":      {"median_ms": 20, "sigma": 0.3, "per_token_ms": 0.0, "rps": None, "burst": None, "throttle_rate": 0.0},
+        "analyze":    {"median_ms": 500, "sigma": 0.4, "per_token_ms": 0.0, "rps": None, "burst": None, "throttle_rate": 0.0},
+        "blob":       {"median_ms": 5, "sigma": 0.3, "per_token_ms": 0.0, "rps": None, "burst": None, "throttle_rate": 0.0},
+    },
+    # Same latencies with rate limits and random 429 responses
+    "throttled": {
+        "chat":       {"median_ms": 40, "sigma": 0.4, "per_token_ms": 1.0, "rps": 100, "burst": 20, "throttle_rate": 0.02},
+        "embeddings": {"median_ms": 8, "sigma": 0.3, "per_token_ms": 0.0, "rps": 50, "burst": 10, "throttle_rate": 0.02},
+        "search":     {"median_ms": 12, "sigma": 0.3, "per_token_ms": 0.0, "rps": 50, "burst": 10, "throttle_rate": 0.0},
+        "index":      {"median_ms": 20, "sigma": 0.3, "per_token_ms": 0.0, "rps": 20, "burst": 5, "throttle_rate": 0.0},
+        "analyze":    {"median_ms": 500, "sigma": 0.4, "per_token_ms": 0.0, "rps": 15, "burst": 5, "throttle_rate": 0.0},
+        "blob":       {"median_ms": 5, "sigma": 0.3, "per_token_ms": 0.0, "rps": None, "burst": None, "throttle_rate": 0.0},
+    },
+}
+
+# Token bucket of a service: requests over the limit receive 429 with the time to wait in retry-after-ms
+class RateLimiter:
+    def __init__(self, rps, burst):
+        self.rps = rps
+        self.burst = burst or rps
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Return 0 when the request is accepted, or the seconds to wait
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rps)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rps
+
+# Local stand-ins of the Azure OpenAI (chat completions and embeddings), AI Search (search, index and count)
+# Document Intelligence (analyze operations, the latency of "analyze" is the time until the operation succeeds)
+# and Blob Storage (list and ranged download of the blobs of a container, like the Azurite emulator) REST APIs
+# The search indexes are LocalSearchClient instances in a temporary directory, and the containers are local directories
+class FakeServices:
+    def __init__(self, profile="azure", seed=0, index_dir=None):
+        self.profile = SERVICE_PROFILES[profile] if isinstance(profile, str) else profile
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.limiters = {service: RateLimiter(config["rps"], config["burst"])
+                         for service, config in self.profile.items() if config["rps"]}
+        self.index_dir = index_dir or tempfile.mkdtemp(prefix='fake_search_')
+        self.indexes = {}
+        self.indexes_lock = threading.Lock()
+        self.operations = {}
+        self.containers = {}
+        self.operations_lock = threading.Lock()
+        self.counters_lock = threading.Lock()
+        self.reset_counters()
+        self.server = None
+
+    def start(self):
+        services = self
+
+        class Handler(FakeServicesHandler):
+            pass
+        Handler.services = services
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='fake-services', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        for index in self.indexes.values():
+            index.close()
+        shutil.rmtree(self.index_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def endpoint(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def reset_counters(self):
+        with self.counters_lock:
+            self.counters = {"requests": {}, "throttled": {}, "tokens": {"prompt": 0, "completion": 0}}
+
+    def count(self, group, service, value=1):
+        with self.counters_lock:
+            self.counters[group][service] = self.counters[group].get(service, 0) + value
+
+    def get_counters(self):
+        with self.counters_lock:
+            return json.loads(json.dumps(self.counters))
+
+    # Serve the files of a local directory (and its subdirectories) as the blobs of a container
+    def add_container(self, name, directory):
+        self.containers[name] = directory
+
+    @property
+    def blob_connection_string(self):
+        return (f'DefaultEndpointsProtocol=http;AccountName={BLOB_ACCOUNT};AccountKey={BLOB_ACCOUNT_KEY};'
+                f'BlobEndpoint={self.endpoint}/{BLOB_ACCOUNT};')
+
+    def get_index(self, name):
+        with self.indexes_lock:
+            if name not in self.indexes:
+                self.indexes[name] = LocalSearchClient(os.path.join(self.index_dir, name))
+            return self.indexes[name]
+
+    # Seconds of latency of a request: lognormal around the median plus the time of the generated tokens
+    def latency(self, service, completion_tokens=0):
+        config = self.profile[service]
+        with self.random_lock:
+            noise = self.random.gauss(0, config["sigma"]) if config["sigma"] > 0 else 0.0
+            throttled = self.random.random() < config["throttle_rate"]
+        return config["median_ms"] / 1000 * math.exp(noise), config["per_token_ms"] / 1000 * completion_tokens, throttled
+
+    # Return 0 when the request is accepted, or the seconds to wait with a 429
+    def admit(self, service, throttled):
+        self.count("requests", service)
+        wait = self.limiters[service].acquire() if service in self.limiters else 0.0
+        if wait == 0.0 and throttled:
+            wait = 0.05
+        if wait > 0:
+            self.count("throttled", service)
+        return wait
+
+class FakeServicesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # Headers and body are written separately, avoid the delayed ACK of every response
+    services = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        path = self.path.split('?')[0]
+        data = self.rfile.read(int(self.headers.get('content-length', 0)))
+        try:
+            if re.match(r'^/documentintelligence/documentModels/[^/:]+:analyze$', path):
+                self.analyze(data)
+                return
+            body = json.loads(data or b'{}')
+            if re.match(r'^/openai/deployments/[^/]+/chat/completions$', path):
+                self.chat_completions(body)
+            elif re.match(r'^/openai/deployments/[^/]+/embeddings$', path):
+                self.embeddings(body)
+            elif re.match(r"^/indexes\('[^']+'\)/docs/search\.post\.search$", path):
+                self.search(index_name(path), body)
+            elif re.match(r"^/indexes\('[^']+'\)/docs/search\.index$", path):
+                self.index(index_name(path), body)
+            else:
+                self.send_json(404, {"error": {"message": f"Not found: {path}"}})
+        except Exception as ex:
+            print(f'ERROR fake services {path}: {ex}')
+            self.send_json(500, {"error": {"message": str(ex)}})
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path.startswith(f'/{BLOB_ACCOUNT}/'):
+            self.blob(urllib.parse.unquote(path[len(BLOB_ACCOUNT) + 2:]), urllib.parse.parse_qs(self.path.partition('?')[2]))
+        elif re.match(r"^/indexes\('[^']+'\)/docs/\$count$", path):
+            count = str(self.services.get_index(index_name(path)).get_document_count()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('content-type', 'text/plain')
+            self.send_header('content-length', str(len(count)))
+            self.end_headers()
+            self.wfile.write(count)
+        elif re.match(r'^/documentintelligence/documentModels/[^/]+/analyzeResults/[^/]+$', path):
+            self.analyze_result(path.rsplit('/', 1)[1])
+        else:
+            self.send_json(404, {"error": {"message": f"Not found: {path}"}})
+
+    def send_json(self, status, data, headers=None):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    # Wait the latency of the service, answering 429 when the request is throttled
+    def wait(self, service, completion_tokens=0):
+        base, generation, throttled = self.services.latency(service, completion_tokens)
+        retry_after = self.services.admit(service, throttled)
+        if retry_after > 0:
+            self.send_throttled(retry_after)
+            return None
+        time.sleep(base)
+        return generation
+
+    def send_throttled(self, retry_after):
+        self.send_json(429, {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                       {"retry-after-ms": str(int(retry_after * 1000) + 1), "retry-after": str(math.ceil(retry_after))})
+
+    def chat_completions(self, body):
+        messages = body["messages"]
+        content = fake_completion(messages)
+        prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+        completion_tokens = count_tokens(content)
+        generation = self.wait("chat", completion_tokens)
+        if generation is None:
+            return
+        self.services.count("tokens", "prompt", prompt_tokens)
+        self.services.count("tokens", "completion", completion_tokens)
+        if body.get("stream"):
+            self.stream_completion(content, generation)
+            return
+        time.sleep(generation)
+        self.send_json(200, {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    # Server-sent events with one word per chunk, the first chunk only has the prompt filter results like Azure OpenAI
+    def stream_completion(self, content, generation):
+        self.send_response(200)
+        self.send_header('content-type', 'text/event-stream')
+        self.send_header('connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        self.wfile.write(b'data: {"id": "", "object": "", "created": 0, "model": "", "choices": [], "prompt_filter_results": []}\n\n')
+        words = re.findall(r'\S+\s*', content)
+        for word in words:
+            time.sleep(generation / max(len(words), 1))
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": "fake",
+                     "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+            self.wfile.flush()
+        # Last chunk without content, with the finish_reason of the completion
+        chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": "fake",
+                 "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def embeddings(self, body):
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        if self.wait("embeddings") is None:
+            return
+        prompt_tokens = sum(count_tokens(text) for text in texts)
+        self.services.count("tokens", "prompt", prompt_tokens)
+        self.send_json(200, {
+            "object": "list",
+            "model": body.get("model", "fake"),
+            "data": [{"object": "embedding", "index": i, "embedding": encode_embedding(fake_embedding(text), body.get("encoding_format"))}
+                     for i, text in enumerate(texts)],
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        })
+
+    # Hybrid search in the local index, with a semantic reranker score (0-4) from the terms of the query in the document
+    def search(self, name, body):
+        if self.wait("search") is None:
+            return
+        vector_queries = [types.SimpleNamespace(vector=query["vector"], fields=query["fields"], k_nearest_neighbors=query.get("k"))
+                          for query in body.get("vectorQueries", [])]
+        select = body["select"].split(',') if body.get("select") else None
+        results = self.services.get_index(name).search(search_text=body.get("search"), vector_queries=vector_queries,
+                                                       select=select, top=body.get("top", 50))
+        values = []
+        for result in results:
+            result.pop("@search.reranker_score", None)
+            result["@search.rerankerScore"] = round(4 * term_overlap(body.get("search") or '', f'{result.get("title", "")} {result.get("content", "")}'), 4)
+            values.append(result)
+        values.sort(key=lambda value: value["@search.rerankerScore"], reverse=True)
+        data = {"value": values}
+        if body.get("count"):
+            data["@odata.count"] = results.get_count()
+        self.send_json(200, data)
+
+    def index(self, name, body):
+        if self.wait("index") is None:
+            return
+        index = self.services.get_index(name)
+        uploads = [action for action in body["value"] if action.get("@search.action", "upload") in ("upload", "merge", "mergeOrUpload")]
+        deletes = [action for action in body["value"] if action.get("@search.action") == "delete"]
+        if len(uploads) > 0:
+            index.merge_or_upload_documents([{key: value for key, value in action.items() if not key.startswith('@')} for action in uploads])
+        if len(deletes) > 0:
+            index.delete_documents([{"id": action["id"]} for action in deletes])
+        self.send_json(200, {"value": [{"key": action["id"], "status": True, "errorMessage": None, "statusCode": 200}
+                                       for action in body["value"]]})
+
+    # Start an analyze operation: 202 with the Operation-Location polled by the SDK, the result is ready after the latency
+    # A document with FAKE-FAIL in its content fails, like a corrupted PDF
+    def analyze(self, data):
+        base, _, throttled = self.services.latency("analyze")
+        retry_after = self.services.admit("analyze", throttled)
+        if retry_after > 0:
+            self.send_throttled(retry_after)
+            return
+        operation_id = uuid.uuid4().hex
+        with self.services.operations_lock:
+            self.services.operations[operation_id] = {"ready": time.monotonic() + base, "content": fake_markdown(data),
+                                                      "failed": b'FAKE-FAIL' in data}
+        model_id = re.search(r'/documentModels/([^/:]+):analyze', self.path).group(1)
+        self.send_json(202, {}, {"operation-location": f'{self.services.endpoint}/documentintelligence/documentModels/{model_id}'
+                                                       f'/analyzeResults/{operation_id}?api-version=2024-11-30'})
+
+    def analyze_result(self, operation_id):
+        self.services.count("requests", "analyze_status")
+        with self.services.operations_lock:
+            operation = self.services.operations.get(operation_id)
+        if operation is None:
+            self.send_json(404, {"error": {"code": "NotFound", "message": f"Operation {operation_id} not found"}})
+        elif time.monotonic() < operation["ready"]:
+            self.send_json(200, {"status": "running"})
+        elif operation["failed"]:
+            self.send_json(200, {"status": "failed", "error": {"code": "InvalidContent", "message": "The file is corrupted or format is unsupported."}})
+        else:
+            self.send_json(200, {"status": "succeeded", "analyzeResult": {"apiVersion": "2024-11-30", "modelId": "prebuilt-layout",
+                                                                          "contentFormat": "markdown", "content": operation["content"]}})
+
+    # List the blobs of a container (restype=container&comp=list) or download a blob, with the range requested by the SDK
+    def blob(self, path, query):
+        container, _, blob_name = path.partition('/')
+        directory = self.services.containers.get(container)
+        if directory is None:
+            self.send_blob_error(404, 'ContainerNotFound', 'The specified container does not exist.')
+            return
+        if self.wait("blob") is None:
+            return
+        if blob_name == '' and query.get('comp') == ['list']:
+            self.list_blobs(container, directory, query)
+            return
+        file_path = os.path.join(directory, *blob_name.split('/'))
+        if blob_name == '' or not os.path.isfile(file_path):
+            self.send_blob_error(404, 'BlobNotFound', 'The specified blob does not exist.')
+            return
+        size = os.path.getsize(file_path)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('x-ms-range') or self.headers.get('range') or '')
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        with open(file_path, 'rb') as f:
+            f.seek(start)
+            data = f.read(max(0, end - start + 1))
+        self.send_response(206 if match else 200)
+        self.send_header('content-type', 'application/octet-stream')
+        self.send_header('content-length', str(len(data)))
+        if match:
+            self.send_header('content-range', f'bytes {start}-{start + len(data) - 1}/{size}')
+        self.send_header('etag', f'"0x{int(os.path.getmtime(file_path) * 1000):X}"')
+        self.send_header('last-modified', formatdate(os.path.getmtime(file_path), usegmt=True))
+        self.send_header('accept-ranges', 'bytes')
+        self.send_header('x-ms-blob-type', 'BlockBlob')
+        self.send_header('x-ms-version', self.headers.get('x-ms-version', '2025-01-05'))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def list_blobs(self, container, directory, query):
+        names = []
+        for root, _, filenames in os.walk(directory):
+            for filename in filenames:
+                names.append(os.path.relpath(os.path.join(root, filename), directory).replace(os.sep, '/'))
+        prefix = query.get('prefix', [''])[0]
+        marker = query.get('marker', [''])[0]
+        max_results = int(query.get('maxresults', [BLOB_LIST_MAX_RESULTS])[0])
+        names = [name for name in sorted(names) if name.startswith(prefix) and name >= marker]
+        page, next_marker = names[:max_results], names[max_results] if len(names) > max_results else ''
+        blobs = []
+        for name in page:
+            file_path = os.path.join(directory, *name.split('/'))
+            blobs.append(f'<Blob><Name>{escape(name)}</Name><Properties>'
+                         f'<Last-Modified>{formatdate(os.path.getmtime(file_path), usegmt=True)}</Last-Modified>'
+                         f'<Etag>0x{int(os.path.getmtime(file_path) * 1000):X}</Etag>'
+                         f'<Content-Length>{os.path.getsize(file_path)}</Content-Length>'
+                         f'<Content-Type>application/octet-stream</Content-Type><BlobType>BlockBlob</BlobType>'
+                         f'</Properties></Blob>')
+        payload = (f'<?xml version="1.0" encoding="utf-8"?><EnumerationResults ServiceEndpoint="{self.services.endpoint}/{BLOB_ACCOUNT}/" '
+                   f'ContainerName="{escape(container)}"><Prefix>{escape(prefix)}</Prefix><MaxResults>{max_results}</MaxResults>'
+                   f'<Blobs>{"".join(blobs)}</Blobs><NextMarker>{escape(next_marker)}</NextMarker></EnumerationResults>').encode('utf-8')
+        self.send_response(200)
+        self.send_header('content-type', 'application/xml')
+        self.send_header('content-length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_blob_error(self, status, code, message):
+        payload = f'<?xml version="1.0" encoding="utf-8"?><Error><Code>{code}</Code><Message>{message}</Message></Error>'.encode('utf-8')
+        self.send_response(status)
+        self.send_header('content-type', 'application/xml')
+        self.send_header('content-length', str(len(payload)))
+        self.send_header('x-ms-error-code', code)
+        self.end_headers()
+        self.wfile.write(payload)
+
+def index_name(path):
+    return re.match(r"^/indexes\('([^']+)'\)", path).group(1)
+
+# Markdown of an analyzed document: the text of a text file, or a heading with the hash of a binary file (PDF)
+def fake_markdown(data):
+    if not data.startswith(b'%PDF'):
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+    return f'# Document {zlib.crc32(data):08x}\n\n{len(data)} bytes\n'
+
+# Approximate number of tokens of a text (4 characters per token)
+def count_tokens(text):
+    return max(1, len(text or '') // 4)
+
+def terms(text):
+    return [term for term in re.findall(r'\w+', (text or '').lower()) if len(term) > 3]
+
+# Fraction of the terms of the query included in a text
+def term_overlap(query, text):
+    query_terms = set(terms(query))
+    if len(query_terms) == 0:
+        return 0.0
+    return len(query_terms & set(terms(text))) / len(query_terms)
+
+# Deterministic embedding: hashed bag of words, normalized
+def fake_embedding(text, dimensions=EMBEDDINGS_DIMENSIONS):
+    vector = [0.0] * dimensions
+    for term in re.findall(r'\w+', (text or '').lower()):
+        vector[zlib.crc32(term.encode('utf-8')) % dimensions] += 1.0
+    if not any(vector):
+        return [1.0 / math.sqrt(dimensions)] * dimensions
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector]
+
+# The OpenAI SDK requests the embeddings as base64 float32 by default, like the service
+def encode_embedding(embedding, encoding_format):
+    if encoding_format == "base64":
+        return base64.b64encode(array('f', embedding).tobytes()).decode('ascii')
+    return embedding
+
+# Response of the model for the prompts of the pipeline: rewrite, pointwise and listwise re-ranker and answer
+def fake_completion(messages):
+    system_prompt = messages[0]["content"]
+    user_prompt = messages[-1]["content"]
+    if system_prompt == SYSTEM_PROMPT_REWRITE_QUERY:
+        return user_prompt.replace('Generate search query for: ', '', 1)
+    if system_prompt == SYSTEM_PROMPT_TO_CALCULATE_RANK:
+        question = re.search(r'Search Query: (.*?)\n', user_prompt, re.DOTALL).group(1)
+        text = user_prompt.split('Text:', 1)[1].strip()
+        answer = ' '.join(text.split()[:RANK_ANSWER_WORDS]).replace('"', "'")
+        return '{\n "confidence": ' + str(round(100 * term_overlap(question, text))) + ',\n "answer": "' + answer + '"\n}'
+    if system_prompt == SYSTEM_PROMPT_TO_CALCULATE_RANK_BATCH:
+        question = re.search(r'Search Query: (.*?)\nTexts: ', user_prompt, re.DOTALL).group(1)
+        texts = json.loads(user_prompt.split('\nTexts: ', 1)[1])
+        return json.dumps({"chunks": [{"id": text["id"],
+                                       "confidence": round(100 * term_overlap(question, text["text"])),
+                                       "answer": ' '.join(text["text"].split()[:RANK_ANSWER_WORDS])} for text in texts]})
+    # Answer: the first words of the knowledge base
+    words = user_prompt.split()
+    return ' '.join((words * (ANSWER_WORDS // max(len(words), 1) + 1))[:ANSWER_WORDS])
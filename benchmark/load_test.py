@@ -0,0 +1,143 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import requests
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.abspath(os.path.join(BENCHMARK_DIR, '..')))
+from tracing import percentile
+
+# CONSTANTS
+API_SCRIPT = os.path.join(BENCHMARK_DIR, '..', 'rag_api.py')
+CONCURRENCY_LEVELS = [1, 2, 4, 8, 16, 32] # Concurrent clients of every step of the load test
+REQUESTS_PER_CLIENT = 4
+API_START_TIMEOUT = 60 # Seconds to wait for the health check of the API
+REQUEST_TIMEOUT = 120
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# New process of rag_api.py pointing to the fake services, ready when /health answers
+def start_api(env, port, workers, batching):
+    env = dict(env, RAG_API_EMBEDDING_BATCHING='1' if batching else '0')
+    process = subprocess.Popen([sys.executable, API_SCRIPT, '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers)],
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.perf_counter() + API_START_TIMEOUT
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'rag_api.py exited with code {process.returncode}')
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/health', timeout=1).ok:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'rag_api.py did not start in {API_START_TIMEOUT} seconds')
+
+# Requests of one client (its own connection) to /v1/answer, returns (latency, status) of every request
+def run_client(url, tenant, questions, rerank_mode):
+    results = []
+    with requests.Session() as session:
+        for question in questions:
+            start = time.perf_counter()
+            try:
+                status = session.post(url, json={"question": question, "rerank_mode": rerank_mode}, headers={"X-Tenant-Id": tenant},
+                                      timeout=REQUEST_TIMEOUT).status_code
+            except requests.RequestException as ex:
+                print(f'ERROR run_client: {ex}')
+                status = 0
+            results.append((time.perf_counter() - start, status))
+    return results
+
+# One step of the load test: concurrency clients spread over the tenants, every one sending requests_per_client questions
+def run_level(services, port, questions, concurrency, tenants, requests_per_client, rerank_mode):
+    url = f'http://127.0.0.1:{port}/v1/answer'
+    services.reset_counters()
+    results = []
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for client in range(concurrency):
+            client_questions = [questions[(client * requests_per_client + i) % len(questions)] for i in range(requests_per_client)]
+            futures.append(executor.submit(run_client, url, f'tenant-{client % tenants}', client_questions, rerank_mode))
+        for future in futures:
+            results += future.result()
+    elapsed = time.perf_counter() - start
+
+    answered = [latency * 1000 for latency, status in results if status == 200]
+    counters = services.get_counters()
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "answered": len(answered),
+        "rejected": sum(status == 429 for _, status in results),
+        "errors": sum(status not in (200, 429) for _, status in results),
+        "seconds": round(elapsed, 3),
+        "qps": round(len(answered) / elapsed, 3) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(answered, 50), 3),
+            "p95": round(percentile(answered, 95), 3),
+            "mean": round(statistics.mean(answered), 3) if answered else 0.0,
+        },
+        # Under 1 when the embeddings of concurrent requests are sent in the same call
+        "embedding_calls_per_request": round(counters["requests"].get("embeddings", 0) / len(answered), 3) if answered else 0.0,
+        "throttled": counters["throttled"],
+    }
+
+# Throughput of the API (QPS and latency) with a growing number of concurrent clients against the fake services
+def run_load_test(profile="azure", workers=2, tenants=4, levels=CONCURRENCY_LEVELS, requests_per_client=REQUESTS_PER_CLIENT,
+                  rerank_mode="pointwise", batching=True, seed=0):
+    from run_benchmark import load_corpus, load_questions, load_index
+    from fake_services import FakeServices
+    from cold_start import get_child_env
+
+    questions = [str(question) for question in load_questions()]
+    report = {"profile": profile, "workers": workers, "tenants": tenants, "rerank_mode": rerank_mode, "batching": batching, "levels": []}
+    with FakeServices(profile, seed) as services:
+        load_index(services, load_corpus())
+        port = get_free_port()
+        process = start_api(get_child_env(services), port, workers, batching)
+        try:
+            for concurrency in levels:
+                level = run_level(services, port, questions, concurrency, tenants, requests_per_client, rerank_mode)
+                print_level(level)
+                report["levels"].append(level)
+        finally:
+            process.terminate()
+            process.wait()
+    return report
+
+def print_level(level):
+    print(f'{level["concurrency"]:>4} clients: {level["qps"]:>7.2f} QPS, p50 {level["latency_ms"]["p50"]:>8.1f} ms, '
+          f'p95 {level["latency_ms"]["p95"]:>8.1f} ms, {level["answered"]}/{level["requests"]} answered, {level["rejected"]} 429, '
+          f'{level["errors"]} errors, {level["embedding_calls_per_request"]:.2f} embedding calls/request')
+
+# python benchmark/load_test.py [--profile azure] [--workers 2] [--tenants 4] [--levels 1,2,4,8,16,32] [--no-batching]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of rag_api.py with a growing number of concurrent clients')
+    parser.add_argument('--profile', default='azure')
+    parser.add_argument('--workers', type=int, default=2, help='Worker processes of the API')
+    parser.add_argument('--tenants', type=int, default=4, help='Tenants of the clients (X-Tenant-Id), assigned round robin')
+    parser.add_argument('--levels', default=','.join(str(level) for level in CONCURRENCY_LEVELS), help='Concurrent clients of every step')
+    parser.add_argument('--requests', type=int, default=REQUESTS_PER_CLIENT, help='Requests of every client in every step')
+    parser.add_argument('--rerank-mode', default='pointwise', choices=['pointwise', 'listwise', 'cascade'])
+    parser.add_argument('--no-batching', action='store_true', help='Without the micro-batcher of embeddings')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file of the results')
+    args = parser.parse_args()
+
+    report = run_load_test(args.profile, args.workers, args.tenants, [int(level) for level in args.levels.split(',')], args.requests,
+                           args.rerank_mode, not args.no_batching, args.seed)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results saved in {args.output}')
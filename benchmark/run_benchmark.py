@@ -0,0 +1,279 @@
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from openai import AzureOpenAI
+from common_utils import *
+from indexing_utils import index_documents, convert_documents_to_markdown
+from tracing import enable_tracing, disable_tracing, percentile, print_summary
+from fake_services import FakeServices, SERVICE_PROFILES, fake_embedding
+from resilience import get_resilience_metrics
+
+# CONSTANTS
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIR = os.path.join(BENCHMARK_DIR, '..', '1_indexing', 'docs', 'markdown')
+DOCUMENTS_DIR = os.path.join(BENCHMARK_DIR, '..', '1_indexing', 'docs')
+GROUND_TRUTH_FILE = os.path.join(BENCHMARK_DIR, '..', '5_evaluation', 'ground_truth.xlsx')
+BASELINES_DIR = os.path.join(BENCHMARK_DIR, 'baselines')
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, 'results')
+INDEX_NAME = 'benchmark-docs'
+API_VERSION = '2024-12-01-preview'
+DEPLOYMENT_NAME = 'gpt-4o'
+EMBEDDING_MODEL = 'text-embedding-ada-002'
+RERANK_MODEL = 'gpt-4o-mini'
+REGRESSION_TOLERANCE = 0.2 # Relative change accepted before reporting a regression
+
+# Metrics compared with the baseline and the direction of the improvement
+REGRESSION_CHECKS = [
+    ("queries.qps", "higher"),
+    ("queries.latency_ms.p50", "lower"),
+    ("queries.latency_ms.p95", "lower"),
+    ("queries.latency_ms.p99", "lower"),
+    ("queries.calls_per_question.chat", "lower"),
+    ("queries.calls_per_question.embeddings", "lower"),
+    ("queries.calls_per_question.search", "lower"),
+    ("queries.tokens_per_question.prompt", "lower"),
+    ("indexing.chunks_per_sec", "higher"),
+    ("conversion.docs_per_sec", "higher"),
+]
+
+# Chunks of the markdown corpus, with the same chunker of the indexing notebook
+def load_corpus(input_dir=CORPUS_DIR):
+    return list(chunk_files(input_dir))
+
+def load_questions(input_file=GROUND_TRUTH_FILE):
+    import pandas as pd
+    return pd.read_excel(input_file)['QUESTION'].tolist()
+
+# Load the chunks directly in the fake index, with the fake embeddings
+def load_index(services, chunks, index_name=INDEX_NAME):
+    for i in range(0, len(chunks), 100):
+        services.get_index(index_name).merge_or_upload_documents(
+            [{"id": str(i + j), "title": chunk["title"], "content": chunk["content"],
+              "embeddingTitle": fake_embedding(chunk["title"]), "embeddingContent": fake_embedding(chunk["content"])}
+             for j, chunk in enumerate(chunks[i:i + 100])])
+
+# Convert the PDF documents with the fake Document Intelligence service, with an empty markdown cache
+def run_conversion(services, input_dir=DOCUMENTS_DIR):
+    from azure.ai.documentintelligence import DocumentIntelligenceClient
+
+    services.reset_counters()
+    doc_intel_client = DocumentIntelligenceClient(endpoint=services.endpoint, credential=AzureKeyCredential('fake'))
+    with tempfile.TemporaryDirectory(prefix='benchmark_markdown_') as output_dir:
+        start = time.perf_counter()
+        reports = convert_documents_to_markdown(doc_intel_client, input_dir, output_dir, cache_dir=os.path.join(output_dir, 'cache'),
+                                                polling_interval=0.05)
+        elapsed = time.perf_counter() - start
+    counters = services.get_counters()
+    return {
+        "documents": len(reports),
+        "failed": sum(1 for report in reports if report["status"] == "failed"),
+        "seconds": round(elapsed, 3),
+        "docs_per_sec": round(len(reports) / elapsed, 3) if elapsed > 0 else 0.0,
+        "requests": counters["requests"],
+        "throttled": counters["throttled"],
+    }
+
+# Index the corpus in the fake AI Search service
+def run_indexing(services, openai_client, chunks):
+    services.reset_counters()
+    stats = index_documents(services.endpoint, AzureKeyCredential('fake'), INDEX_NAME, openai_client, EMBEDDING_MODEL, chunks,
+                            manifest_path=os.path.join(services.index_dir, 'manifest.json'))
+    counters = services.get_counters()
+    return {
+        "chunks": stats["chunks"],
+        "errors": stats["errors"],
+        "seconds": stats["seconds"],
+        "chunks_per_sec": stats["chunks_per_sec"],
+        "requests": counters["requests"],
+        "throttled": counters["throttled"],
+    }
+
+# One question with the functions of the pipeline: rewrite, search, rerank and generation
+def run_question(openai_client, ai_search_client, question, rerank_mode, max_docs):
+    start = time.perf_counter()
+    query = generate_search_query(openai_client, DEPLOYMENT_NAME, question, [])
+    results, _ = semantic_hybrid_search(ai_search_client, openai_client, EMBEDDING_MODEL, query or question, max_docs)
+    valid_chunks, num_chunks = get_filtered_chunks(openai_client, RERANK_MODEL, results, question, mode=rerank_mode)
+    answer = generate_answer_with_history(openai_client, DEPLOYMENT_NAME, valid_chunks, question, [])
+    return time.perf_counter() - start, num_chunks, answer is not None
+
+# Replay the questions with a number of concurrent users
+def run_queries(services, openai_client, ai_search_client, questions, concurrency, rerank_mode, max_docs):
+    services.reset_counters()
+    get_resilience_metrics().reset()
+    tracer = enable_tracing()
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(run_question, openai_client, ai_search_client, question, rerank_mode, max_docs) for question in questions]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                latency, num_chunks, answered = future.result()
+                latencies.append(latency * 1000)
+                errors += not answered
+            except Exception as ex:
+                print(f'ERROR run_question: {ex}', file=sys.__stdout__)
+                errors += 1
+    elapsed = time.perf_counter() - start
+    stages = tracer.summary()
+    disable_tracing()
+
+    counters = services.get_counters()
+    num_questions = len(questions)
+    return {
+        "questions": num_questions,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "qps": round(num_questions / elapsed, 3) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "mean": round(statistics.mean(latencies), 3) if latencies else 0.0,
+        },
+        "calls_per_question": {service: round(counters["requests"].get(service, 0) / num_questions, 3)
+                               for service in ("chat", "embeddings", "search")},
+        "tokens_per_question": {kind: round(tokens / num_questions, 1) for kind, tokens in counters["tokens"].items()},
+        "throttled": counters["throttled"],
+        # Retries, hedges, timeouts and circuit breaker of the Azure OpenAI calls (resilience.py)
+        "aoai_calls": get_resilience_metrics().stats(),
+    }, stages
+
+def run_benchmark(profile="azure", num_questions=0, repeat=4, concurrency=4, rerank_mode=RERANK_MODE, max_docs=10,
+                  skip_indexing=False, seed=0, verbose=False, conversion=False):
+    chunks = load_corpus()
+    questions = load_questions()
+    if num_questions > 0:
+        questions = questions[:num_questions]
+    questions = questions * repeat
+
+    with FakeServices(profile, seed) as services:
+        openai_client = AzureOpenAI(azure_endpoint=services.endpoint, api_key='fake', api_version=API_VERSION)
+        ai_search_client = SearchClient(endpoint=services.endpoint, index_name=INDEX_NAME, credential=AzureKeyCredential('fake'))
+        # The pipeline prints the prompts of every call, only shown with --verbose
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+            conversion = run_conversion(services) if conversion else None
+            indexing = run_indexing(services, openai_client, chunks) if not skip_indexing else None
+            if skip_indexing:
+                load_index(services, chunks)
+            queries, stages = run_queries(services, openai_client, ai_search_client, questions, concurrency, rerank_mode, max_docs)
+
+    return {
+        "created": datetime.datetime.now().isoformat(timespec='seconds'),
+        "profile": profile,
+        "config": {
+            "questions": len(questions),
+            "repeat": repeat,
+            "concurrency": concurrency,
+            "rerank_mode": rerank_mode,
+            "max_docs": max_docs,
+            "corpus_chunks": len(chunks),
+            "seed": seed,
+        },
+        "conversion": conversion,
+        "indexing": indexing,
+        "queries": queries,
+        "stages": stages,
+    }
+
+def get_metric(report, path):
+    value = report
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+# Compare a report with a baseline, returning the metrics worse than the tolerance
+def compare_with_baseline(report, baseline, tolerance=REGRESSION_TOLERANCE):
+    regressions = []
+    print(f'{"metric":<40} {"baseline":>12} {"current":>12} {"change":>8}')
+    for path, better in REGRESSION_CHECKS:
+        old, new = get_metric(baseline, path), get_metric(report, path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old != 0 else 0.0
+        regression = change < -tolerance if better == "higher" else change > tolerance
+        print(f'{path:<40} {old:>12.3f} {new:>12.3f} {change:>+7.1%}{"  REGRESSION" if regression else ""}')
+        if regression:
+            regressions.append({"metric": path, "baseline": old, "current": new, "change": round(change, 4)})
+    return regressions
+
+def print_report(report):
+    queries = report["queries"]
+    print(f'Profile: {report["profile"]}, config: {report["config"]}')
+    if report.get("conversion") is not None:
+        conversion = report["conversion"]
+        print(f'Conversion: {conversion["documents"]} documents in {conversion["seconds"]}s ({conversion["docs_per_sec"]} docs/sec), '
+              f'failed: {conversion["failed"]}, requests: {conversion["requests"]}, throttled: {conversion["throttled"]}')
+    if report["indexing"] is not None:
+        indexing = report["indexing"]
+        print(f'Indexing: {indexing["chunks"]} chunks in {indexing["seconds"]}s ({indexing["chunks_per_sec"]} chunks/sec), '
+              f'requests: {indexing["requests"]}, throttled: {indexing["throttled"]}')
+    print(f'Queries: {queries["questions"]} questions in {queries["seconds"]}s ({queries["qps"]} QPS), errors: {queries["errors"]}')
+    print(f'Latency (ms): {queries["latency_ms"]}')
+    print(f'Calls per question: {queries["calls_per_question"]}, tokens per question: {queries["tokens_per_question"]}, '
+          f'throttled: {queries["throttled"]}')
+    if queries.get("aoai_calls") is not None:
+        print(f'Azure OpenAI calls: {queries["aoai_calls"]}')
+    print_summary(report["stages"])
+
+# python benchmark/run_benchmark.py [--profile azure] [--save-baseline] [--compare]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark of the RAG pipeline with local stand-ins of Azure OpenAI and AI Search')
+    parser.add_argument('--profile', default='azure', choices=sorted(SERVICE_PROFILES))
+    parser.add_argument('--questions', type=int, default=0, help='Questions of the ground truth to replay (0: all)')
+    parser.add_argument('--repeat', type=int, default=4, help='Times every question is replayed')
+    parser.add_argument('--concurrency', type=int, default=4, help='Concurrent users')
+    parser.add_argument('--rerank-mode', default=RERANK_MODE, choices=['pointwise', 'listwise', 'cascade'])
+    parser.add_argument('--max-docs', type=int, default=10)
+    parser.add_argument('--skip-indexing', action='store_true', help='Load the corpus directly in the fake index')
+    parser.add_argument('--conversion', action='store_true', help='Also convert the PDF documents with the fake Document Intelligence')
+    parser.add_argument('--embedding-cache', action='store_true', help='Use the embedding cache (disabled by default to measure the calls)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file of the results (by default benchmark/results/<date>_<profile>.json)')
+    parser.add_argument('--baseline', help='Baseline JSON file (by default benchmark/baselines/<profile>_<rerank mode>.json)')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='Compare with the baseline and exit with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if not args.embedding_cache:
+        os.environ['EMBEDDING_CACHE_PATH'] = ''
+    report = run_benchmark(args.profile, args.questions, args.repeat, args.concurrency, args.rerank_mode, args.max_docs,
+                           args.skip_indexing, args.seed, args.verbose, args.conversion)
+    print_report(report)
+
+    output = args.output or os.path.join(RESULTS_DIR, f'{datetime.datetime.now():%Y%m%d_%H%M%S}_{args.profile}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results saved in {output}')
+
+    baseline_path = args.baseline or os.path.join(BASELINES_DIR, f'{args.profile}_{args.rerank_mode}.json')
+    if args.compare:
+        if not os.path.exists(baseline_path):
+            print(f'Baseline {baseline_path} not found, run with --save-baseline first')
+            sys.exit(2)
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            regressions = compare_with_baseline(report, json.load(f), args.tolerance)
+        if len(regressions) > 0:
+            print(f'{len(regressions)} regressions over the {args.tolerance:.0%} tolerance')
+            sys.exit(1)
+        print('No regressions')
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f'Baseline saved in {baseline_path}')
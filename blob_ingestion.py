@@ -0,0 +1,235 @@
+import hashlib
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from azure.storage.blob import ContainerClient
+
+from common_utils import chunk_markdown, MAX_TOKENS, TOKENS_OVERLAP
+from indexing_utils import (index_documents, begin_markdown_analysis, write_markdown, EMBEDDING_MAX_WORKERS, MARKDOWN_CACHE_DIR,
+                            CONVERSION_MAX_IN_FLIGHT, CONVERSION_POLLING_INTERVAL, CONVERSION_TIMEOUT)
+
+# CONSTANTS
+DOWNLOAD_WORKERS = 4 # Blobs downloaded at the same time
+DOWNLOAD_CHUNK_BYTES = 4 * 1024 * 1024 # Bytes of every ranged request of a download, the only part of a blob in memory
+PIPELINE_QUEUE_SIZE = 8 # Items waiting between two stages of the pipeline
+STOP_CHECK_SECONDS = 1.0 # Maximum seconds a conversion waits for its analysis before checking if the pipeline was stopped
+DONE = object() # End of the items of a queue
+
+# Streaming ingestion of the documents of a blob container: list -> download -> convert -> chunk -> embed -> upload
+# The stages run at the same time connected by bounded queues, so the memory and the disk used do not depend on the
+# size of the container: a blob is downloaded in ranged requests to a spool file, deleted once it is converted, and at most
+# download_workers + convert_workers + 2 * queue_size documents are between the listing and the chunker.
+# The chunks are consumed by index_documents while the next blobs are downloaded, so the first documents are searchable
+# before the last blobs are listed. The markdown is cached by the SHA-256 of the blob like convert_documents_to_markdown
+class BlobIngestionPipeline:
+    def __init__(self, container_client, doc_intel_client, extension='.pdf', prefix=None, download_workers=DOWNLOAD_WORKERS,
+                 convert_workers=CONVERSION_MAX_IN_FLIGHT, queue_size=PIPELINE_QUEUE_SIZE, cache_dir=MARKDOWN_CACHE_DIR,
+                 polling_interval=CONVERSION_POLLING_INTERVAL, timeout=CONVERSION_TIMEOUT):
+        self.container_client = container_client
+        self.doc_intel_client = doc_intel_client
+        self.extension = extension
+        self.prefix = prefix
+        self.download_workers = download_workers
+        self.convert_workers = convert_workers
+        self.cache_dir = cache_dir
+        self.polling_interval = polling_interval
+        self.timeout = timeout
+        self.blobs = queue.Queue(maxsize=queue_size)
+        self.files = queue.Queue(maxsize=queue_size)
+        self.documents = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.spool_dir = None
+        self.spooled_files = 0
+        self.stats = {"blobs": 0, "downloaded_bytes": 0, "converted": 0, "cached": 0, "failed": 0, "chunked": 0,
+                      "max_spooled_files": 0, "first_document_seconds": None}
+        self.failures = []
+
+    # Chunks of the documents of the container, produced while the next blobs are downloaded and converted
+    def chunks(self, max_tokens=MAX_TOKENS, overlap_tokens=TOKENS_OVERLAP):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.spool_dir = tempfile.mkdtemp(prefix='blob_spool_')
+        start = time.perf_counter()
+        self.start_thread(self.list_blobs, 'blob-list')
+        self.start_stage('blob-download', self.download, self.blobs, self.files, self.download_workers)
+        self.start_stage('blob-convert', self.convert, self.files, self.documents, self.convert_workers)
+        try:
+            while True:
+                document = self.get(self.documents)
+                if document is DONE:
+                    break
+                if self.stats["first_document_seconds"] is None:
+                    self.stats["first_document_seconds"] = round(time.perf_counter() - start, 3)
+                for chunk in chunk_markdown(document["title"], document["markdown"], max_tokens, overlap_tokens):
+                    chunk['source'] = document["source"]
+                    self.stats["chunked"] += 1
+                    yield chunk
+        finally:
+            # Also stops the stages when the consumer fails or closes the generator before the end. The spool directory is
+            # removed once the stages have finished, not while a download or a conversion is still using its files
+            self.stop.set()
+            for thread in self.threads:
+                thread.join()
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def start_thread(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    # Run a function over the items of a queue in several threads, sending DONE to the next queue when all of them finish
+    def start_stage(self, name, fn, in_queue, out_queue, workers):
+        def work():
+            while not self.stop.is_set():
+                item = self.get(in_queue)
+                if item is DONE:
+                    # The other workers of the stage also have to see it
+                    in_queue.put(DONE)
+                    return
+                result = fn(item)
+                if result is not None:
+                    self.put(out_queue, result)
+
+        def supervise():
+            threads = [threading.Thread(target=work, name=f'{name}-{i}', daemon=True) for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.put(out_queue, DONE)
+        # Joining the supervisor also waits for the workers of the stage
+        self.start_thread(supervise, name)
+
+    # Put and get that give up when the pipeline is stopped, so no thread waits forever on a full or empty queue
+    def put(self, out_queue, item):
+        while not self.stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, in_queue):
+        while not self.stop.is_set():
+            try:
+                return in_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return DONE
+
+    def list_blobs(self):
+        try:
+            for blob in self.container_client.list_blobs(name_starts_with=self.prefix):
+                if blob.name.lower().endswith(self.extension):
+                    with self.lock:
+                        self.stats["blobs"] += 1
+                    if not self.put(self.blobs, blob.name):
+                        return
+        except Exception as ex:
+            self.fail(None, ex)
+        self.put(self.blobs, DONE)
+
+    # Download a blob to a spool file in ranged requests, hashing it on the way
+    def download(self, blob_name):
+        file_path = os.path.join(self.spool_dir, hashlib.sha1(blob_name.encode('utf-8')).hexdigest())
+        try:
+            file_hash = hashlib.sha256()
+            size = 0
+            with self.lock:
+                self.spooled_files += 1
+                self.stats["max_spooled_files"] = max(self.stats["max_spooled_files"], self.spooled_files)
+            with open(file_path, 'wb') as f:
+                for chunk in self.container_client.download_blob(blob_name).chunks():
+                    if self.stop.is_set():
+                        break
+                    file_hash.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            if self.stop.is_set():
+                # Not a failure: the consumer stopped the pipeline
+                self.remove_spool_file(file_path)
+                return None
+            with self.lock:
+                self.stats["downloaded_bytes"] += size
+            print(f'\tDownloaded {blob_name} ({size} bytes)')
+            return {"name": blob_name, "path": file_path, "hash": file_hash.hexdigest()}
+        except Exception as ex:
+            self.remove_spool_file(file_path)
+            self.fail(blob_name, ex)
+            return None
+
+    # Convert a downloaded blob to markdown, or read it from the cache, and delete the spool file
+    def convert(self, item):
+        cache_path = os.path.join(self.cache_dir, f'{item["hash"]}.md')
+        try:
+            if os.path.exists(cache_path):
+                with open(cache_path, 'r', encoding='utf-8') as f:
+                    markdown = f.read()
+                status = "cached"
+            else:
+                start = time.perf_counter()
+                with open(item["path"], 'rb') as f:
+                    poller = begin_markdown_analysis(self.doc_intel_client, f, self.polling_interval)
+                deadline = time.perf_counter() + self.timeout
+                while not poller.done() and not self.stop.is_set() and time.perf_counter() < deadline:
+                    poller.wait(min(STOP_CHECK_SECONDS, max(0.0, deadline - time.perf_counter())))
+                if self.stop.is_set() and not poller.done():
+                    return None
+                if not poller.done():
+                    raise TimeoutError(f'analysis not finished in {self.timeout} seconds')
+                markdown = poller.result().content
+                write_markdown(cache_path, markdown)
+                status = "converted"
+                print(f'\tConverted {item["name"]} in {time.perf_counter() - start:.1f} seconds')
+            with self.lock:
+                self.stats[status] += 1
+        except Exception as ex:
+            self.fail(item["name"], ex)
+            return None
+        finally:
+            self.remove_spool_file(item["path"])
+        return {"source": f'{self.container_client.container_name}/{item["name"]}',
+                "title": os.path.splitext(os.path.basename(item["name"]))[0] + '.md',
+                "markdown": markdown}
+
+    def remove_spool_file(self, file_path):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        with self.lock:
+            self.spooled_files -= 1
+
+    def fail(self, blob_name, ex):
+        print(f'ERROR BlobIngestionPipeline {blob_name or "list"}: {ex}')
+        with self.lock:
+            self.stats["failed"] += 1
+            self.failures.append({"blob": blob_name, "error": f'{type(ex).__name__}: {ex}'})
+
+# Container client that downloads the blobs in requests of DOWNLOAD_CHUNK_BYTES
+def get_container_client(connection_string, container_name, chunk_bytes=DOWNLOAD_CHUNK_BYTES):
+    return ContainerClient.from_connection_string(connection_string, container_name,
+                                                  max_single_get_size=chunk_bytes, max_chunk_get_size=chunk_bytes)
+
+# Index the documents of a blob container with the streaming pipeline, returning the stats of index_documents and of the pipeline
+# The blobs removed from the container are not deleted from the index (delete_missing_sources of index_documents)
+def index_blob_container(container_client, doc_intel_client, ai_search_endpoint, ai_search_credential, index_name,
+                         embedding_client, embedding_model_name, extension='.pdf', prefix=None, download_workers=DOWNLOAD_WORKERS,
+                         convert_workers=CONVERSION_MAX_IN_FLIGHT, embedding_workers=EMBEDDING_MAX_WORKERS,
+                         queue_size=PIPELINE_QUEUE_SIZE, incremental=True, cache_dir=MARKDOWN_CACHE_DIR,
+                         polling_interval=CONVERSION_POLLING_INTERVAL, batch_client=None):
+    print(f'Ingesting the {extension} blobs of {container_client.container_name} in {index_name} '
+          f'(download: {download_workers}, convert: {convert_workers}, embedding: {embedding_workers})...')
+    pipeline = BlobIngestionPipeline(container_client, doc_intel_client, extension, prefix, download_workers, convert_workers,
+                                     queue_size, cache_dir, polling_interval)
+    stats = index_documents(ai_search_endpoint, ai_search_credential, index_name, embedding_client, embedding_model_name,
+                            pipeline.chunks(), max_workers=embedding_workers, incremental=incremental, batch_client=batch_client)
+    stats.update(pipeline.stats)
+    stats["failures"] = pipeline.failures
+    print(f'Blobs: {stats["blobs"]}, downloaded: {stats["downloaded_bytes"]} bytes, converted: {stats["converted"]}, '
+          f'cached: {stats["cached"]}, failed: {stats["failed"]}, first document after {stats["first_document_seconds"]} seconds, '
+          f'max spool files: {stats["max_spooled_files"]}')
+    return stats
@@ -2,21 +2,18 @@ import concurrent.futures
 import json
 import re
 import os
+import threading
+import time
+from collections import deque
 from dotenv import load_dotenv, find_dotenv
-import tiktoken
-encoding = tiktoken.get_encoding("cl100k_base")
-from openai import AzureOpenAI
 
 from azure.search.documents.models import VectorizedQuery, QueryType, QueryCaptionType, QueryAnswerType
 from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient, SearchIndexingBufferedSender
-from azure.search.documents.indexes import SearchIndexClient
-from azure.search.documents.indexes.models import (
-    SimpleField, SearchFieldDataType, SearchableField, SearchField, VectorSearch, HnswAlgorithmConfiguration,
-    VectorSearchProfile, SemanticConfiguration, SemanticPrioritizedFields, SemanticField, SemanticSearch,
-    SearchIndex, VectorSearchAlgorithmKind, HnswParameters, VectorSearchAlgorithmMetric
-)
+from azure.search.documents import SearchClient
 from prompts import *
+from embedding_cache import get_embedding_cache
+from tracing import span, current_span, submit_in_context, create_with_retries, record_usage
+from resilience import create_chat_completion, create_chat_completion_stream, set_fallback_deployments, AOAI_DEADLINE_SECONDS
 
 # CONSTANTS
 EMBEDDINGS_DIMENSIONS = 1536
@@ -25,6 +22,75 @@ MAX_RETRIEVE = 70
 MAX_GENERATE = 10
 MAX_TOKENS = 512
 TOKENS_OVERLAP = 128 # 25% of 512 tokens is 128 tokens
+RERANK_MODE = "pointwise" # "pointwise": one call per chunk, "listwise": RERANK_BATCH_SIZE chunks scored in every call,
+                          # "cascade": only the chunks with an uncertain semantic reranker score are scored with calls
+RERANK_BATCH_SIZE = 8
+RANK_MAX_TOKENS = 800 # Maximum tokens of the response of the re-ranker for one chunk
+RANK_BATCH_MAX_TOKENS = 16384 # Maximum output tokens of the model, for the response of the listwise re-ranker
+CASCADE_ACCEPT_SCORE = 3.0 # Semantic reranker score (0-4) from which a chunk is accepted without calling the re-ranker model
+CASCADE_REJECT_SCORE = 1.0 # Semantic reranker score under which a chunk is rejected without calling the re-ranker model
+CASCADE_WAVE_SIZE = 10 # Uncertain chunks scored at the same time, the next ones only when MAX_GENERATE chunks are still missing
+CONTEXT_MAX_TOKENS = 6000 # Token budget of the chunks in the prompt to generate the answer
+FEDERATED_SEARCH_TIMEOUT = 10.0 # Seconds to wait for every index in a federated search (a number or {index name: seconds})
+RRF_K = 60 # Constant of Reciprocal Rank Fusion, a higher value gives more weight to the results after the first ones
+MIN_OVERLAP_CHARS = 32 # Minimum text shared by the end of a chunk and the start of another to merge them
+MIN_SECTION_TOKENS = 64 # A section that does not fit in the budget is cut only when this many tokens are left
+MIN_CHUNK_TOKENS = 128 # A markdown heading starts a new chunk only when the current one has this many tokens
+WORD_BOUNDARY_TOKENS = 32 # Tokens searched back from a cut of a long paragraph for the start of a word
+CHUNK_MAX_WORKERS = min(8, os.cpu_count() or 1) # Processes chunking files at the same time
+AOAI_MAX_CONNECTIONS = 100 # Connections of an Azure OpenAI client (re-ranker calls of all the concurrent users)
+AOAI_KEEPALIVE_CONNECTIONS = 50 # Idle connections kept open by an Azure OpenAI client
+KEEPALIVE_EXPIRY_SECONDS = 120 # Idle seconds before closing a connection (Azure closes them after about 4 minutes)
+SEARCH_POOL_SIZE = 32 # Connections to the AI Search service shared by the clients of all the indexes
+REWRITE_DEADLINE_SECONDS = 15 # Maximum seconds to rewrite the question, with its retries (see resilience.py)
+RERANK_DEADLINE_SECONDS = 20 # Maximum seconds to score a chunk, then it falls back to its semantic reranker score
+GENERATE_DEADLINE_SECONDS = 60 # Maximum seconds to generate the answer, with its retries
+HEADING_PATTERN = re.compile(r'^#{1,6}\s')
+COMMENT_PATTERN = re.compile(r'^<!--.*-->$')
+TABLE_ROW_PATTERN = re.compile(r'(?<=</tr>)\s*')
+
+# Structured output of the listwise re-ranker
+RANK_BATCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "rank_batch",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "chunks": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "string"},
+                            "confidence": {"type": "integer"},
+                            "answer": {"type": "string"}
+                        },
+                        "required": ["id", "confidence", "answer"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["chunks"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Tokenizer loaded the first time it is needed and not when the module is imported: tiktoken reads the BPE file of the
+# encoding, and downloads it when it is not in TIKTOKEN_CACHE_DIR
+_encoding = None
+_encoding_lock = threading.Lock()
+
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                import tiktoken
+                _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding
 
 def load_config():
     # Load configuration variables from .env file
@@ -40,16 +106,17 @@ def load_config():
         "aoai_embedding_model": os.getenv('AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME'),
         "aoai_rerank_model": os.getenv('AZURE_OPENAI_RERANK_DEPLOYMENT_NAME'),
         "api_version": api_version,
+        # Deployments called when a deployment is throttled or failing: {"gpt-4o": ["gpt-4o-secondary"]}
+        "aoai_fallback_deployments": json.loads(os.getenv('AZURE_OPENAI_FALLBACK_DEPLOYMENTS') or '{}'),
         # Initialize Azure OpenAI client
-        "openai_client": AzureOpenAI(azure_endpoint=aoai_endpoint,
-                                     api_key=aoai_key,
-                                     api_version=api_version),
+        "openai_client": create_openai_client(aoai_endpoint, aoai_key, api_version),
     }
 
     print(f'aoai_endpoint: {openai_config["aoai_endpoint"]}')
     print(f'aoai_deployment_name: {openai_config["aoai_deployment_name"]}')
     print(f'oai_embedding_model: {openai_config["aoai_embedding_model"]}')
     print(f'aoai_rerank_model: {openai_config["aoai_rerank_model"]}')
+    set_fallback_deployments(openai_config["aoai_fallback_deployments"])
 
     # Azure AI Search configuration
     ai_search_endpoint = os.environ["SEARCH_SERVICE_ENDPOINT"]
@@ -57,6 +124,7 @@ def load_config():
     ai_search_index_name_regs = os.environ["SEARCH_INDEX_NAME_REGS"]
     ai_search_index_name_docs = os.environ["SEARCH_INDEX_NAME_DOCS"]
     ai_search_credential = AzureKeyCredential(ai_search_apikey)
+    ai_search_transport = create_search_transport()
     ai_search_config = {
         "ai_search_endpoint": ai_search_endpoint,
         "ai_search_apikey": ai_search_apikey,
@@ -66,10 +134,12 @@ def load_config():
         # Initialize AI Search clients
         "ai_search_client_regs": SearchClient(endpoint=ai_search_endpoint,
                                               index_name=ai_search_index_name_regs,
-                                              credential=ai_search_credential),
+                                              credential=ai_search_credential,
+                                              transport=ai_search_transport),
         "ai_search_client_docs": SearchClient(endpoint=ai_search_endpoint,
                                               index_name=ai_search_index_name_docs,
-                                              credential=ai_search_credential),
+                                              credential=ai_search_credential,
+                                              transport=ai_search_transport),
     }
 
     print(f'ai_search_index_name_regs: {ai_search_config["ai_search_index_name_regs"]}')
@@ -77,6 +147,75 @@ def load_config():
 
     return openai_config, ai_search_config
 
+# Azure OpenAI client with a connection pool for the concurrent calls and kept-alive connections
+# (openai is imported here: it is the slowest import of the module and the processes that only chunk do not need it)
+def create_openai_client(aoai_endpoint, aoai_key, api_version):
+    import httpx
+    from openai import AzureOpenAI, DefaultHttpxClient
+
+    limits = httpx.Limits(max_connections=AOAI_MAX_CONNECTIONS, max_keepalive_connections=AOAI_KEEPALIVE_CONNECTIONS,
+                          keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS)
+    return AzureOpenAI(azure_endpoint=aoai_endpoint, api_key=aoai_key, api_version=api_version,
+                       http_client=DefaultHttpxClient(limits=limits))
+
+# Transport of the AI Search clients: one requests session, and its connection pool, for all the indexes of the service
+# (the default pool of requests keeps 10 connections, fewer than the searches of the concurrent users)
+def create_search_transport(pool_size=SEARCH_POOL_SIZE):
+    import requests
+    from azure.core.pipeline.transport import RequestsTransport
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return RequestsTransport(session=session, session_owner=False)
+
+_shared_config = None
+_shared_config_lock = threading.Lock()
+_warm_up_thread = None
+
+# Configuration and clients of load_config shared by all the threads of the process (the clients are thread safe),
+# so every new session of the chat app reuses the open connections instead of new pools and TLS handshakes
+def get_shared_config():
+    global _shared_config
+    with _shared_config_lock:
+        if _shared_config is None:
+            _shared_config = load_config()
+    return _shared_config
+
+# Warm-up of the process in a background thread, started only once
+def start_warm_up(openai_config, ai_search_config):
+    global _warm_up_thread
+    with _shared_config_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(target=warm_up, args=(openai_config, ai_search_config), name='warm-up', daemon=True)
+            _warm_up_thread.start()
+    return _warm_up_thread
+
+# Load the tokenizer and open the connections to AI Search and Azure OpenAI with cheap requests (document count and the
+# embedding of one word), so the first question does not wait for them. Returns the seconds of every step
+def warm_up(openai_config, ai_search_config):
+    timings = {}
+    start = time.perf_counter()
+    get_encoding()
+    timings["tokenizer"] = round(time.perf_counter() - start, 3)
+    step_start = time.perf_counter()
+    for name in ("docs", "regs"):
+        try:
+            ai_search_config[f"ai_search_client_{name}"].get_document_count()
+        except Exception as ex:
+            print(f'ERROR warm_up: {ex}')
+    timings["search"] = round(time.perf_counter() - step_start, 3)
+    step_start = time.perf_counter()
+    try:
+        openai_config["openai_client"].embeddings.create(model=openai_config["aoai_embedding_model"], input=["warm-up"])
+    except Exception as ex:
+        print(f'ERROR warm_up: {ex}')
+    timings["openai"] = round(time.perf_counter() - step_start, 3)
+    timings["total"] = round(time.perf_counter() - start, 3)
+    print(f'Warm-up: {timings}')
+    return timings
+
 # Load in an array the content of every file in a directory
 def load_files(input_dir, ext):
     print(f'Loading files in {input_dir}...')
@@ -89,16 +228,293 @@ def load_files(input_dir, ext):
                 files_content.append(row)
     return files_content
 
+# Markdown chunker: every block (heading, paragraph or table of the Document Intelligence output) is encoded once,
+# and the chunks are yielded with their number of tokens while the file is read line by line
+# - a heading starts a new chunk when the current one has at least MIN_CHUNK_TOKENS tokens, without overlap
+# - inside a section the next chunk starts with the last overlap_tokens tokens of the previous one (from a word start)
+# - a table is kept in one chunk when it fits, otherwise it is split between rows repeating its header
+# - a longer paragraph is split at word starts, and its pieces (and the overlap that continues in the next chunk) are
+#   joined without separator, so the text of the chunks is the text of the document
+def chunk_markdown(title, text, max_tokens=MAX_TOKENS, overlap_tokens=TOKENS_OVERLAP):
+    lines = text.splitlines(keepends=True) if isinstance(text, str) else text
+    encoding = get_encoding()
+    separator_tokens = encoding.encode_ordinary('\n\n') # Between the blocks of a chunk
+    title_tokens = len(encoding.encode_ordinary(title))
+    parts = [] # Token lists of the blocks in the current chunk
+    size = 0 # Tokens of the current chunk, separators between blocks included
+    has_body = False
+    for kind, block in iter_markdown_blocks(lines):
+        tokens = encoding.encode_ordinary(block)
+        if kind == "heading" and has_body and size >= MIN_CHUNK_TOKENS:
+            yield make_chunk(title, parts, size, title_tokens)
+            parts, size, has_body = [], 0, False
+        if len(tokens) > max_tokens - overlap_tokens - len(separator_tokens):
+            pieces = split_block(kind, block, tokens, max_tokens - overlap_tokens - len(separator_tokens))
+        else:
+            pieces = [(tokens, False)]
+        for piece, continues in pieces:
+            if len(parts) > 0 and size + (0 if continues else len(separator_tokens)) + len(piece) > max_tokens:
+                yield make_chunk(title, parts, size, title_tokens)
+                tail = get_tail_tokens(parts, overlap_tokens)
+                parts = [tail] if len(tail) > 0 else []
+                size = len(tail)
+                # The tail ends where a continued piece starts
+                continues = continues and len(parts) > 0
+            if continues and len(parts) > 0:
+                parts[-1] = parts[-1] + piece
+                size += len(piece)
+            else:
+                size += len(piece) + (len(separator_tokens) if len(parts) > 0 else 0)
+                parts.append(piece)
+        has_body = has_body or kind != "heading"
+    if has_body:
+        yield make_chunk(title, parts, size, title_tokens)
+
+# Chunk with its text and number of tokens, so the embedding step does not tokenize it again
+# (without the space before the first word when the chunk starts inside a paragraph)
+def make_chunk(title, parts, size, title_tokens):
+    content = '\n\n'.join(get_encoding().decode(part) for part in parts if len(part) > 0).strip()
+    return {'title': title, 'content': content, 'tokens': size, 'title_tokens': title_tokens}
+
+# Last tokens of a chunk, the start of the next one, from the start of a word
+def get_tail_tokens(parts, overlap_tokens):
+    if overlap_tokens <= 0:
+        return []
+    encoding = get_encoding()
+    separator_tokens = encoding.encode_ordinary('\n\n')
+    tail = []
+    for part in reversed(parts):
+        if len(tail) >= overlap_tokens:
+            break
+        tail = part[-(overlap_tokens - len(tail)):] + (separator_tokens if len(tail) > 0 else []) + tail
+    tail = tail[-overlap_tokens:]
+    if len(tail) == 0:
+        return tail
+    start = next((i for i, token in enumerate(tail) if starts_word(encoding, token)), 0)
+    return tail[start:]
+
+# True when a token starts with a space or a line break (the start of a word in the BPE of tiktoken)
+def starts_word(encoding, token):
+    return encoding.decode([token])[:1].isspace()
+
+# Blocks of a markdown document read line by line: ("heading", text), ("table", text) or ("text", paragraph)
+# The comments of Document Intelligence (<!-- PageBreak -->, <!-- PageHeader="..." -->...) are skipped
+def iter_markdown_blocks(lines):
+    block = []
+    table = None # "html" inside <table>...</table>, "pipe" inside a markdown table
+    for line in lines:
+        stripped = line.strip()
+        if table == "html":
+            block.append(stripped)
+            if '</table>' in stripped:
+                yield "table", '\n'.join(block)
+                block, table = [], None
+            continue
+        if table == "pipe":
+            if stripped.startswith('|'):
+                block.append(stripped)
+                continue
+            yield "table", '\n'.join(block)
+            block, table = [], None
+        if stripped.startswith('<table') or stripped.startswith('|') or stripped == '' or \
+                HEADING_PATTERN.match(stripped) or COMMENT_PATTERN.match(stripped):
+            if len(block) > 0:
+                yield "text", '\n'.join(block)
+                block = []
+        if stripped.startswith('<table'):
+            block, table = [stripped], "html"
+            if '</table>' in stripped:
+                yield "table", stripped
+                block, table = [], None
+        elif stripped.startswith('|'):
+            block, table = [stripped], "pipe"
+        elif HEADING_PATTERN.match(stripped):
+            yield "heading", stripped
+        elif stripped != '' and not COMMENT_PATTERN.match(stripped):
+            block.append(stripped)
+    if len(block) > 0:
+        yield ("table" if table is not None else "text"), '\n'.join(block)
+
+# Split a block bigger than max_tokens in pieces (tokens, continues), continues=True when the piece is the continuation
+# of the text of the previous one: tables between rows repeating the header, text and longer rows by tokens
+def split_block(kind, block, tokens, max_tokens):
+    if kind == "table":
+        if block.startswith('<table'):
+            rows = [row for row in TABLE_ROW_PATTERN.split(block[:block.rfind('</table>')]) if row.strip() != '']
+            header, footer = rows.pop(0), '</table>'
+        else:
+            rows = block.split('\n')
+            header, footer = '\n'.join(rows[:2]), ''
+            rows = rows[2:]
+        encoding = get_encoding()
+        newline_token = encoding.encode_ordinary('\n')[0]
+        header_tokens = encoding.encode_ordinary(header + '\n')
+        footer_tokens = encoding.encode_ordinary('\n' + footer) if footer else []
+        pieces = []
+        piece = []
+        for row in rows:
+            row_tokens = encoding.encode_ordinary(row)
+            if len(header_tokens) + len(row_tokens) + len(footer_tokens) > max_tokens:
+                # A row that does not fit with the header is split by tokens
+                if len(piece) > 0:
+                    pieces.append((header_tokens + piece + footer_tokens, False))
+                    piece = []
+                pieces.extend((row_piece, i > 0) for i, row_piece in enumerate(split_tokens(row_tokens, max_tokens)))
+                continue
+            if len(piece) > 0 and len(header_tokens) + len(piece) + 1 + len(row_tokens) + len(footer_tokens) > max_tokens:
+                pieces.append((header_tokens + piece + footer_tokens, False))
+                piece = []
+            piece = piece + [newline_token] + row_tokens if len(piece) > 0 else row_tokens
+        if len(piece) > 0:
+            pieces.append((header_tokens + piece + footer_tokens, False))
+        return pieces
+    return [(piece, i > 0) for i, piece in enumerate(split_tokens(tokens, max_tokens))]
+
+# Split tokens in pieces of max_tokens, cutting before the start of a word when there is one in the last
+# WORD_BOUNDARY_TOKENS tokens of the piece
+def split_tokens(tokens, max_tokens):
+    encoding = get_encoding()
+    pieces = []
+    start = 0
+    while len(tokens) - start > max_tokens:
+        end = start + max_tokens
+        cut = next((i for i in range(end, max(start + 1, end - WORD_BOUNDARY_TOKENS), -1) if starts_word(encoding, tokens[i])), end)
+        pieces.append(tokens[start:cut])
+        start = cut
+    pieces.append(tokens[start:])
+    return pieces
+
+# Chunks of a markdown file, with the file path as source
+def chunk_file(file_path, max_tokens=MAX_TOKENS, overlap_tokens=TOKENS_OVERLAP):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for chunk in chunk_markdown(os.path.basename(file_path), f, max_tokens, overlap_tokens):
+            chunk['source'] = file_path
+            yield chunk
+
+# Worker of the process pool: the chunks of a file in a list (the file is read line by line, but all its chunks are
+# returned at once)
+def chunk_file_list(file_path, max_tokens=MAX_TOKENS, overlap_tokens=TOKENS_OVERLAP):
+    return list(chunk_file(file_path, max_tokens, overlap_tokens))
+
+# Chunk the files of a directory in a pool of processes, yielding the chunks in the order of the files
+# Only 2 * max_workers files are chunked ahead of the consumer, so the memory does not grow with the number of files,
+# but it holds all the chunks of those files: it grows with the size of the largest files. With max_workers=1 the files
+# are chunked in this process and the chunks are yielded while every file is read
+def chunk_files(input_dir, extension='.md', max_workers=CHUNK_MAX_WORKERS, max_tokens=MAX_TOKENS, overlap_tokens=TOKENS_OVERLAP):
+    file_paths = sorted(os.path.join(input_dir, filename) for filename in os.listdir(input_dir) if filename.endswith(extension))
+    print(f'Chunking {len(file_paths)} files in {input_dir} (workers: {max_workers})...')
+    if max_workers <= 1 or len(file_paths) <= 1:
+        for file_path in file_paths:
+            yield from chunk_file(file_path, max_tokens, overlap_tokens)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque()
+        for file_path in file_paths:
+            futures.append(executor.submit(chunk_file_list, file_path, max_tokens, overlap_tokens))
+            if len(futures) >= max_workers * 2:
+                yield from futures.popleft().result()
+        while len(futures) > 0:
+            yield from futures.popleft().result()
+
 # Semantic Hybrid Search in AI Search
 def semantic_hybrid_search(ai_search_client, openai_client, aoai_embedding_model, query, max_docs):
+    # Semantic Hybrid Search
+    with span("hybrid_search", max_docs=max_docs):
+        embedding = create_embedding(openai_client, aoai_embedding_model, query)
+        documents, count = search_index(ai_search_client, query, embedding, max_docs)
+
+    return documents, count
+
+# Search in one index with the embedding of the query already calculated
+def search_index(ai_search_client, query, embedding, max_docs, index_name=None):
+    with span("search", index=index_name) as search_span:
+        results = ai_search_client.search(**get_search_parameters(query, embedding, max_docs))
+        documents = list(results)
+        search_span.set(num_results=len(documents))
+    return documents, results.get_count()
+
+# Search in one index, or in several at the same time when ai_search_client is a dict {index name: client}
+def hybrid_search(ai_search_client, openai_client, aoai_embedding_model, query, max_docs):
+    if isinstance(ai_search_client, dict):
+        return federated_search(ai_search_client, openai_client, aoai_embedding_model, query, max_docs)
+    return semantic_hybrid_search(ai_search_client, openai_client, aoai_embedding_model, query, max_docs)
+
+_search_executor = None
+_search_executor_lock = threading.Lock()
+
+def get_search_executor():
+    global _search_executor
+    with _search_executor_lock:
+        if _search_executor is None:
+            _search_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix='search')
+    return _search_executor
+
+# Federated Semantic Hybrid Search: the embedding of the query is calculated once and searched in all the indexes
+# ({index name: client}) at the same time. An index that fails or does not answer in its timeout is left out and the
+# results of the others are merged with Reciprocal Rank Fusion, so the latency is the one of the slowest index (at most
+# its timeout) instead of the sum of all of them. It returns the same (documents, count) as semantic_hybrid_search
+def federated_search(ai_search_clients, openai_client, aoai_embedding_model, query, max_docs, timeout=FEDERATED_SEARCH_TIMEOUT):
+    with span("federated_search", indexes=len(ai_search_clients), max_docs=max_docs) as federated_span:
+        embedding = create_embedding(openai_client, aoai_embedding_model, query)
+        executor = get_search_executor()
+        start = time.perf_counter()
+        futures = {name: submit_in_context(executor, search_index, client, query, embedding, max_docs, name)
+                   for name, client in ai_search_clients.items()}
+        responses = {}
+        # The indexes with a shorter timeout first, every one waits until its own deadline
+        for name in sorted(futures, key=lambda name: get_index_timeout(timeout, name)):
+            try:
+                remaining = get_index_timeout(timeout, name) - (time.perf_counter() - start)
+                responses[name] = futures[name].result(timeout=max(0.0, remaining))
+            except Exception as ex:
+                responses[name] = ex
+        documents, count, failed = merge_index_results(responses, max_docs, timeout)
+        federated_span.set(num_results=len(documents), failed=failed)
+    return documents, count
+
+def get_index_timeout(timeout, index_name):
+    if isinstance(timeout, dict):
+        return timeout.get(index_name, FEDERATED_SEARCH_TIMEOUT)
+    return timeout
+
+# Results of the federated search from the response (or the exception) of every index: documents fused with
+# Reciprocal Rank Fusion, total count of the indexes that answered and names of the indexes left out
+def merge_index_results(responses, max_docs, timeout=FEDERATED_SEARCH_TIMEOUT):
+    results_by_index = {}
+    count = 0
+    failed = []
+    for name, response in responses.items():
+        if isinstance(response, BaseException):
+            if isinstance(response, (TimeoutError, concurrent.futures.TimeoutError)):
+                print(f'ERROR federated_search: the index {name} did not answer in {get_index_timeout(timeout, name)} seconds')
+            else:
+                print(f'ERROR federated_search: the index {name} failed: {response}')
+            failed.append(name)
+        else:
+            results_by_index[name] = response[0]
+            count += response[1] or 0
+    return fuse_results(results_by_index, max_docs), count, failed
+
+# Reciprocal Rank Fusion: the score of a chunk is the sum of 1 / (k + rank) in every index where it is found, so the
+# results are merged by their positions and not by the scores, that are not comparable between indexes
+# A chunk in several indexes (same id) is returned once, with the index where it was first found in "@search.index"
+def fuse_results(results_by_index, max_docs, k=RRF_K):
+    fused = {}
+    for name, documents in results_by_index.items():
+        for rank, document in enumerate(documents, start=1):
+            result = fused.get(document['id'])
+            if result is None:
+                result = fused[document['id']] = dict(document, **{"@search.index": name, "@search.rrf_score": 0.0})
+            result["@search.rrf_score"] += 1.0 / (k + rank)
+    return sorted(fused.values(), key=lambda result: result["@search.rrf_score"], reverse=True)[:max_docs]
+
+# Parameters of the Semantic Hybrid Search, shared by the sync and async clients
+def get_search_parameters(query, embedding, max_docs):
     EMBEDDING_FIELDS = "embeddingTitle, embeddingContent"
     SELECT_FIELDS=["id", "title", "content"]
 
-    # Semantic Hybrid Search
-    embedding = create_embedding(openai_client, aoai_embedding_model, query)
     vector_query = VectorizedQuery(vector=embedding, k_nearest_neighbors=max_docs, fields=EMBEDDING_FIELDS)
-
-    results = ai_search_client.search(
+    return dict(
         search_text=query,
         vector_queries=[vector_query],
         select=SELECT_FIELDS,
@@ -111,8 +527,6 @@ def semantic_hybrid_search(ai_search_client, openai_client, aoai_embedding_model
         # highlight_fields=["table_description", "column_description"]
     )
 
-    return list(results), results.get_count()
-
 # Print the AI Search search results
 def show_results(results, query):
     json_search_results = []
@@ -127,29 +541,44 @@ def show_results(results, query):
         )
     print("Hybrid Search Results:", json.dumps(json_search_results, indent=2))
 
-# Send a call to the model deployed on Azure OpenAI
-def call_aoai(aoai_client, aoai_model_name, system_prompt, user_prompt, temperature, max_tokens):
+# Send a call to the model deployed on Azure OpenAI, with retries, hedging and circuit breaker (resilience.py)
+# operation separates the latencies used to hedge, and deadline bounds the call with all its retries
+def call_aoai(aoai_client, aoai_model_name, system_prompt, user_prompt, temperature, max_tokens, response_format=None,
+              operation="chat", deadline=AOAI_DEADLINE_SECONDS):
     messages = [{'role': 'system', 'content': system_prompt},
                 {'role': 'user', 'content': user_prompt}]
     #print('---------------------------------------------')
     #print(f'SYSTEM_PROMPT: {system_prompt}')
     #print(f'USER_PROMPT: {user_prompt}')
     #print('---------------------------------------------')
+    response, _ = call_aoai_completion(aoai_client, aoai_model_name, messages, temperature, max_tokens, response_format,
+                                       operation, deadline)
+    #print(f'RESPONSE: {response}')
+    return response
+
+# Content and finish reason ("stop", "length" when max_tokens cut the response...) of a call, (None, None) when it failed
+def call_aoai_completion(aoai_client, aoai_model_name, messages, temperature, max_tokens, response_format=None,
+                         operation="chat", deadline=AOAI_DEADLINE_SECONDS):
+    # Optional structured output (json_object or json_schema)
+    extra_parameters = {"response_format": response_format} if response_format is not None else {}
     try:
-        response = aoai_client.chat.completions.create(
-            model=aoai_model_name,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens
-        )
+        with span("aoai", model=aoai_model_name):
+            response = create_chat_completion(
+                aoai_client,
+                aoai_model_name,
+                operation,
+                deadline,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                **extra_parameters
+            )
         json_response = json.loads(response.model_dump_json())
-        response = json_response['choices'][0]['message']['content']
+        choice = json_response['choices'][0]
+        return choice['message']['content'], choice['finish_reason']
     except Exception as ex:
         print(f'ERROR call_aoai: {ex}')
-        response = None
-    
-    #print(f'RESPONSE: {response}')
-    return response
+        return None, None
 
 # Extract data between two delimiters
 def extract_text(texto, start_delimiter, end_delimiter=''):
@@ -166,12 +595,24 @@ def calculate_rank(aoai_client, aoai_model_name, id, title, content, question):
     # Include every relevant detail from the text to ensure all pertinent information is retained.
     system_prompt = SYSTEM_PROMPT_TO_CALCULATE_RANK
     
-    user_prompt = """Search Query: """ + question + """
+    user_prompt = get_rank_user_prompt(content, question)
+    #print(f'USER PROMPT CALCULATE RANK: {user_prompt}')
+    with span("rerank_chunk", chunk_id=id):
+        response = call_aoai(aoai_client, aoai_model_name, system_prompt, user_prompt, 0.0, RANK_MAX_TOKENS,
+                             operation="rerank", deadline=RERANK_DEADLINE_SECONDS)
+    confidence, answer = parse_rank_response(response)
+
+    #print(f'\t- Response calculate rank: id: {id}, title: {title}, confidence: {confidence}')
+    return id, title, content, confidence, answer
+
+def get_rank_user_prompt(content, question):
+    return """Search Query: """ + question + """
     Text:  """ + content + """
     """
-    #print(f'USER PROMPT CALCULATE RANK: {user_prompt}')
-    response = call_aoai(aoai_client, aoai_model_name, system_prompt, user_prompt, 0.0, 800)
 
+# Extract the confidence and the answer from the response of the re-ranker
+# The confidence is None when the call failed, replaced later by the semantic reranker score (fill_failed_ranks)
+def parse_rank_response(response):
     if response is not None:
         confidence = extract_text(response, 'confidence": ', ',')
         answer = extract_text(response, 'answer": ', '\n}')
@@ -180,81 +621,409 @@ def calculate_rank(aoai_client, aoai_model_name, id, title, content, question):
         if confidence is None or confidence == '':
             confidence = 0
     else:
-        confidence = 0
+        confidence = None
         answer = ''
+    return confidence, answer
 
-    #print(f'\t- Response calculate rank: id: {id}, title: {title}, confidence: {confidence}')
-    return id, title, content, confidence, answer
+# Calculate the confidence and the 'answer' of several chunks with one call (listwise re-ranker)
+# When the call fails after its retries the confidences are None (semantic reranker score, see fill_failed_ranks). When
+# the response is cut by max_tokens, is not valid or misses chunks, the chunks without confidence are scored again
+# splitting them in two batches, down to one call per chunk (calculate_rank)
+def calculate_rank_batch(aoai_client, aoai_model_name, results, question):
+    messages = [{'role': 'system', 'content': SYSTEM_PROMPT_TO_CALCULATE_RANK_BATCH},
+                {'role': 'user', 'content': get_rank_batch_user_prompt(results, question)}]
+    with span("rerank_batch", chunks=len(results)):
+        response, finish_reason = call_aoai_completion(aoai_client, aoai_model_name, messages, 0.0, get_rank_batch_max_tokens(len(results)),
+                                                       response_format=RANK_BATCH_RESPONSE_FORMAT, operation="rerank_batch",
+                                                       deadline=RERANK_DEADLINE_SECONDS)
+    ranks = get_batch_ranks(results, response, finish_reason)
+    failed = get_failed_positions(ranks) if response is not None else []
+    if len(failed) == 1:
+        result = results[failed[0]]
+        ranks[failed[0]] = calculate_rank(aoai_client, aoai_model_name, result['id'], result['title'], result['content'], question)
+    elif len(failed) > 1:
+        half = (len(failed) + 1) // 2
+        for positions in (failed[:half], failed[half:]):
+            retried = calculate_rank_batch(aoai_client, aoai_model_name, [results[i] for i in positions], question)
+            for position, rank in zip(positions, retried):
+                ranks[position] = rank
+    return ranks
+
+# Ranks of a listwise call: the confidence is None for the chunks without a valid score in the response
+def get_batch_ranks(results, response, finish_reason):
+    scores = parse_rank_batch_response(response, len(results)) if finish_reason != "length" else None
+    if scores is None:
+        if response is not None:
+            print(f'ERROR calculate_rank_batch: invalid response for {len(results)} chunks (finish reason: {finish_reason})')
+        scores = [(None, '')] * len(results)
+    return [(result['id'], result['title'], result['content'], confidence, answer)
+            for result, (confidence, answer) in zip(results, scores)]
+
+def get_failed_positions(ranks):
+    return [i for i, rank in enumerate(ranks) if rank[3] is None]
+
+# The chunks are identified in the prompt by their position (1..N), shorter than the ids of the index
+def get_rank_batch_user_prompt(results, question):
+    texts = [{"id": str(i + 1), "text": result['content']} for i, result in enumerate(results)]
+    return "Search Query: " + question + "\nTexts: " + json.dumps(texts, ensure_ascii=False)
+
+# The same answer budget per chunk as the pointwise re-ranker, within the output limit of the model
+def get_rank_batch_max_tokens(num_chunks):
+    return min(RANK_BATCH_MAX_TOKENS, 100 + RANK_MAX_TOKENS * num_chunks)
+
+# Validate the structured response of the listwise re-ranker: one (confidence, answer) per chunk, confidence None for
+# the chunks missing or invalid in the response, and None when the response is not valid JSON (or the call failed)
+def parse_rank_batch_response(response, num_chunks):
+    try:
+        items = json.loads(response)["chunks"]
+    except (ValueError, KeyError, TypeError) as ex:
+        if response is not None:
+            print(f'ERROR parse_rank_batch_response: {ex}')
+        return None
+    if not isinstance(items, list):
+        return None
+    scores = [(None, '')] * num_chunks
+    for item in items:
+        try:
+            position = int(item["id"]) - 1
+            confidence = int(item["confidence"])
+            answer = item["answer"]
+        except (ValueError, KeyError, TypeError):
+            continue
+        if 0 <= position < num_chunks and isinstance(answer, str):
+            scores[position] = (min(max(confidence, 0), 100), answer)
+    return scores
+
+# Thread pool shared by all the queries, to bound the calls to the re-ranker model of concurrent users
+_rerank_executor = None
+_rerank_executor_lock = threading.Lock()
+
+def get_rerank_executor():
+    global _rerank_executor
+    with _rerank_executor_lock:
+        if _rerank_executor is None:
+            _rerank_executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_RETRIEVE, thread_name_prefix='rerank')
+    return _rerank_executor
 
 # Re-ranker: calculate in parallel the percentage of confidence and the answer comparing with the query
-def get_filtered_chunks(aoai_client, aoai_model_name, results, query):
-    i = 1
-    chunks = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_RETRIEVE) as executor:
-        futures = []
+def get_filtered_chunks(aoai_client, aoai_model_name, results, query, mode=RERANK_MODE, batch_size=RERANK_BATCH_SIZE):
+    with span("rerank", mode=mode, chunks=len(results)) as rerank_span:
+        ranks = rank_chunks(aoai_client, aoai_model_name, results, query, mode, batch_size)
+        valid_chunks, num_chunks = select_chunks(ranks)
+        rerank_span.set(selected=num_chunks)
+    return valid_chunks, num_chunks
+
+# Confidence and answer of every chunk: (id, title, content, confidence, answer)
+def rank_chunks(aoai_client, aoai_model_name, results, query, mode=RERANK_MODE, batch_size=RERANK_BATCH_SIZE):
+    if mode == "cascade":
+        return rank_chunks_cascade(aoai_client, aoai_model_name, results, query)
+    executor = get_rerank_executor()
+    futures = []
+    if mode == "listwise":
+        for i in range(0, len(results), batch_size):
+            futures.append(submit_in_context(executor, calculate_rank_batch, aoai_client, aoai_model_name, results[i:i + batch_size], query))
+    else:
         for result in results:
-            futures.append(executor.submit(calculate_rank, aoai_client, aoai_model_name, result['id'], result['title'], result['content'], query))
-
-        for future in concurrent.futures.as_completed(futures):
-            id, title, content, confidence, answer = future.result()
-            #print(f'\t  title: {title}, confidence: {confidence}, answer: {answer}')
-            if int(confidence) >= THRESHOLD_CONFIDENCE:
-                chunks.append({
-                    "id": int(id),
-                    "title": title,
-                    "content": content,
-                    "confidence": int(confidence),
-                    "answer": answer
-                    }
-                )
-                i += 1
+            futures.append(submit_in_context(executor, calculate_rank, aoai_client, aoai_model_name, result['id'], result['title'], result['content'], query))
+
+    ranks = []
+    for future in concurrent.futures.as_completed(futures):
+        if mode == "listwise":
+            ranks += future.result()
+        else:
+            ranks.append(future.result())
+    return fill_failed_ranks(ranks, results)
+
+# Cascade re-ranker: the chunks with a clear semantic reranker score are accepted or rejected without calling the model,
+# and the uncertain ones are scored by descending score in waves of wave_size, until MAX_GENERATE chunks are over
+# THRESHOLD_CONFIDENCE. The calls made and avoided are added to the current span
+def rank_chunks_cascade(aoai_client, aoai_model_name, results, query, wave_size=CASCADE_WAVE_SIZE,
+                        accept_score=CASCADE_ACCEPT_SCORE, reject_score=CASCADE_REJECT_SCORE):
+    ranks, uncertain, rejected = split_cascade(results, accept_score, reject_score)
+    accepted = len(ranks)
+    executor = get_rerank_executor()
+    calls = 0
+    for i in range(0, len(uncertain), wave_size):
+        if count_valid_ranks(ranks) >= MAX_GENERATE:
+            break
+        futures = [submit_in_context(executor, calculate_rank, aoai_client, aoai_model_name, result['id'], result['title'], result['content'], query)
+                   for result in uncertain[i:i + wave_size]]
+        ranks += fill_failed_ranks([future.result() for future in futures], uncertain[i:i + wave_size])
+        calls += len(futures)
+    report_cascade(len(results), accepted, rejected, calls)
+    return ranks
+
+# First stage of the cascade re-ranker: ranks of the accepted chunks (confidence from the score and no answer),
+# uncertain results by descending score (the ones without a semantic score, as the federated results of an index
+# without semantic ranker, are always uncertain) and number of rejected chunks
+def split_cascade(results, accept_score=CASCADE_ACCEPT_SCORE, reject_score=CASCADE_REJECT_SCORE):
+    accepted = []
+    uncertain = []
+    rejected = 0
+    for result in results:
+        score = get_reranker_score(result)
+        if score is not None and score >= accept_score:
+            accepted.append((result['id'], result['title'], result['content'], get_score_confidence(score), ''))
+        elif score is not None and score < reject_score:
+            rejected += 1
+        else:
+            uncertain.append(result)
+    uncertain.sort(key=get_uncertain_order, reverse=True)
+    return accepted, uncertain, rejected
+
+# Order of an uncertain result: its semantic reranker score (0.0 included), -1.0 without score so those results go last
+def get_uncertain_order(result):
+    score = get_reranker_score(result)
+    return score if score is not None else -1.0
+
+# Semantic reranker score of a search result (0-4), None when the search was not semantic
+def get_reranker_score(result):
+    score = result.get('@search.reranker_score', result.get('@search.rerankerScore'))
+    return float(score) if score is not None else None
+
+# Confidence of a chunk accepted by its semantic reranker score, at least THRESHOLD_CONFIDENCE
+def get_score_confidence(score):
+    return max(THRESHOLD_CONFIDENCE, min(100, round(score * 25)))
+
+# Chunks whose re-ranker call failed after its retries (confidence None): instead of dropping them, the ones with a
+# semantic reranker score over CASCADE_ACCEPT_SCORE are kept with the confidence of the score, the rest get 0
+def fill_failed_ranks(ranks, results):
+    scores = {result['id']: get_reranker_score(result) for result in results}
+    filled = []
+    failed = 0
+    for id, title, content, confidence, answer in ranks:
+        if confidence is None:
+            failed += 1
+            score = scores.get(id)
+            confidence = get_score_confidence(score) if score is not None and score >= CASCADE_ACCEPT_SCORE else 0
+        filled.append((id, title, content, confidence, answer))
+    if failed > 0:
+        current_span().set(rerank_failures=failed)
+        print(f'ERROR rerank: {failed} chunks without the confidence of the re-ranker, using their semantic reranker score')
+    return filled
+
+def count_valid_ranks(ranks):
+    return sum(1 for rank in ranks if int(rank[3]) >= THRESHOLD_CONFIDENCE)
+
+def report_cascade(num_results, accepted, rejected, calls):
+    current_span().set(accepted=accepted, rejected=rejected, llm_calls=calls, avoided_calls=num_results - calls)
+    print(f'\tCascade re-ranker: {num_results} chunks, accepted: {accepted}, rejected: {rejected}, '
+          f'calls: {calls}, avoided calls: {num_results - calls}')
+
+# Keep the chunks over the confidence threshold and prepare them as context for the answer
+def select_chunks(ranks, max_tokens=CONTEXT_MAX_TOKENS):
+    chunks = get_top_chunks(ranks)
+
+    # Valid chunks for the user question, merged and packed in the token budget
+    valid_chunks, stats = pack_context(chunks, max_tokens)
+    current_span().set(**stats)
+    if stats["tokens_saved"] > 0 or stats["tokens_dropped"] > 0:
+        print(f'\tContext: {stats["chunks"]} chunks in {stats["sections"]} sections, {stats["tokens"]} tokens, '
+              f'saved {stats["tokens_saved"]} tokens (duplicates: {stats["duplicates"]}, merged: {stats["merged"]}), '
+              f'over the budget {stats["tokens_dropped"]} tokens (cut: {stats["truncated"]}, dropped: {stats["dropped"]})')
+
+    return valid_chunks, stats["chunks"]
+
+def format_chunk(title, content):
+    return f"'Title: {title}. Content: {content}\n"
+
+# Pack the chunks sorted by confidence in a budget of tokens:
+# - chunks with the same content are included once
+# - chunks of the same document that overlap (TOKENS_OVERLAP) or are consecutive (ids of make_chunk_id) are merged
+#   in one section, so the shared text and the title are not repeated
+# - the sections are added in confidence order while they fit in max_tokens, cutting the first one that does not fit
+# tokens_saved counts the tokens removed by the duplicates and the merges (the same information in fewer tokens), and
+# tokens_dropped the tokens of the sections cut or left out by the budget (information lost)
+def pack_context(chunks, max_tokens=CONTEXT_MAX_TOKENS):
+    sections = []
+    contents = set()
+    duplicates = 0
+    for rank, chunk in enumerate(chunks):
+        if chunk['content'] in contents:
+            duplicates += 1
+            continue
+        contents.add(chunk['content'])
+        sections.append({"title": chunk['title'], "content": chunk['content'], "confidence": chunk['confidence'],
+                         "rank": rank, "position": get_chunk_position(chunk['id']), "chunks": 1})
+
+    # Merge the sections of the same document until no pair can be merged
+    merged = 0
+    merging = True
+    while merging:
+        merging = False
+        for first in sections:
+            for second in sections:
+                if first is second or first['title'] != second['title']:
+                    continue
+                content = merge_chunk_texts(first, second)
+                if content is not None:
+                    first['content'] = content
+                    first['confidence'] = max(first['confidence'], second['confidence'])
+                    first['rank'] = min(first['rank'], second['rank'])
+                    first['chunks'] += second['chunks']
+                    if first['position'] is not None and second['position'] is not None:
+                        first['position'] = (first['position'][0], min(first['position'][1], second['position'][1]),
+                                             max(first['position'][2], second['position'][2]))
+                    sections.remove(second)
+                    merged += 1
+                    merging = True
+                    break
+            if merging:
+                break
+
+    # Fill the budget in confidence order
+    encoding = get_encoding()
+    tokens_before = sum(len(encoding.encode(format_chunk(chunk['title'], chunk['content']))) for chunk in chunks)
+    tokens_packed = 0
+    parts = []
+    tokens = 0
+    included = 0
+    truncated = 0
+    dropped = 0
+    for section in sorted(sections, key=lambda section: (-section['confidence'], section['rank'])):
+        text = format_chunk(section['title'], section['content'])
+        section_tokens = encoding.encode(text)
+        tokens_packed += len(section_tokens)
+        if tokens + len(section_tokens) > max_tokens:
+            if max_tokens - tokens >= MIN_SECTION_TOKENS and truncated == 0:
+                section_tokens = section_tokens[:max_tokens - tokens - 1]
+                text = encoding.decode(section_tokens) + '\n'
+                truncated += 1
+            else:
+                dropped += section['chunks']
+                continue
+        parts.append(text)
+        tokens += len(section_tokens)
+        included += section['chunks']
+
+    stats = {
+        "chunks": included,
+        "sections": len(parts),
+        "duplicates": duplicates,
+        "merged": merged,
+        "truncated": truncated,
+        "dropped": dropped,
+        "tokens": tokens,
+        "tokens_saved": tokens_before - tokens_packed,
+        "tokens_dropped": tokens_packed - tokens,
+    }
+    return ''.join(parts), stats
+
+# Document and position of a chunk from the ids of make_chunk_id (source hash-ordinal-content hash): (source, first, last)
+def get_chunk_position(id):
+    match = re.match(r'^([0-9a-f]{16})-(\d+)-[0-9a-f]{16}$', str(id))
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2)), int(match.group(2))
+
+# Text of two sections of the same document merged, when the second one continues the first one, or None
+def merge_chunk_texts(first, second):
+    if second['content'] in first['content']:
+        return first['content']
+    overlap = get_overlap(first['content'], second['content'])
+    if overlap >= MIN_OVERLAP_CHARS:
+        return first['content'] + second['content'][overlap:]
+    if first['position'] is not None and second['position'] is not None and \
+            first['position'][0] == second['position'][0] and second['position'][1] == first['position'][2] + 1:
+        return first['content'] + '\n' + second['content']
+    return None
+
+# Length of the longest end of a text that is the start of another text (at least MIN_OVERLAP_CHARS), or 0
+def get_overlap(text, next_text):
+    head = next_text[:MIN_OVERLAP_CHARS]
+    position = text.find(head, max(0, len(text) - len(next_text)))
+    while position != -1:
+        if next_text.startswith(text[position:]):
+            return len(text) - position
+        position = text.find(head, position + 1)
+    return 0
+
+# Chunks over the confidence threshold sorted by confidence, up to the max number of docs to generate
+def get_top_chunks(ranks):
+    chunks = []
+    for id, title, content, confidence, answer in ranks:
+        #print(f'\t  title: {title}, confidence: {confidence}, answer: {answer}')
+        if int(confidence) >= THRESHOLD_CONFIDENCE:
+            chunks.append({
+                "id": id,
+                "title": title,
+                "content": content,
+                "confidence": int(confidence),
+                "answer": answer
+                }
+            )
     
     # Sort them by confidence and leave only the max number of docs to generate
     if chunks is not []:
         sorted_data = sorted(chunks, key=lambda x: x.get('confidence', float('-inf')), reverse=True)
         chunks = sorted_data[:MAX_GENERATE]
 
-    # Valid chunks for the user question
-    valid_chunks=""
-    for chunk in chunks:
-        valid_chunks = valid_chunks + f"'Title: {chunk['title']}. Content: {chunk['content']}\n"
-
-    return valid_chunks, len(chunks)
+    return chunks
 
 # Create embedding from a chunk
 def create_embedding(openai_client, aoai_embedding_model, text):
-    response = openai_client.embeddings.create(
-        model=aoai_embedding_model,
-        input=text
-    )
-    return response.data[0].embedding
+    if _embedding_batcher is not None:
+        return _embedding_batcher.embed(openai_client, aoai_embedding_model, text)
+    return create_embeddings(openai_client, aoai_embedding_model, [text])[0]
+
+_embedding_batcher = None
+
+# Send the embeddings of create_embedding through a micro-batcher shared by the threads of the process
+# (EmbeddingBatcher of embedding_batcher.py), or call Azure OpenAI directly with None
+def set_embedding_batcher(batcher):
+    global _embedding_batcher
+    _embedding_batcher = batcher
+
+# Create the embeddings of a list of texts in one request, keeping the order of the input
+# The embeddings already calculated are read from the embedding cache and only the rest are sent to Azure OpenAI
+def create_embeddings(openai_client, aoai_embedding_model, texts):
+    with span("embedding", texts=len(texts)) as embedding_span:
+        cache = get_embedding_cache()
+        embeddings = cache.get_many(aoai_embedding_model, texts) if cache is not None else [None] * len(texts)
+        missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        embedding_span.set(cache_misses=len(missing))
+        if len(missing) > 0:
+            response = create_with_retries(
+                openai_client.embeddings,
+                model=aoai_embedding_model,
+                input=missing
+            )
+            record_usage(response)
+            new_embeddings = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            if cache is not None:
+                cache.put_many(aoai_embedding_model, missing, new_embeddings)
+            new_embeddings = dict(zip(missing, new_embeddings))
+            embeddings = [new_embeddings[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)]
+    return embeddings
 
 # GENERATE THE ANSWER
 def generate_answer(aoai_client, aoai_deployment_name, valid_chunks, question):
     #print(f'\nCalling Azure OpenAI model {aoai_deployment_name}...')
     user_prompt = f"**Knowledge base:**\nSections: {valid_chunks}\n**Question:** {question}\nFinal Response:"
 
-    answer = call_aoai(aoai_client, aoai_deployment_name, SYSTEM_PROMPT_GENERATE_ANSWER, user_prompt, 0.0, 1200)
+    with span("generate"):
+        answer = call_aoai(aoai_client, aoai_deployment_name, SYSTEM_PROMPT_GENERATE_ANSWER, user_prompt, 0.0, 1200,
+                           operation="generate", deadline=GENERATE_DEADLINE_SECONDS)
     #print(f'\tRESPONSE: [{answer}]')
     if answer == None: answer = 'ERROR'
     return answer
 
 
 def generate_answer_with_history(aoai_client, aoai_deployment_name, valid_chunks, question, history):
-    messages = [{'role': 'system', 'content': SYSTEM_PROMPT_GENERATE_ANSWER}]
-    for q_a in history:
-        messages.append({"role": "user", "content": q_a["question"]})
-        messages.append({"role": "assistant", "content": q_a["answer"]})
-    messages.append({"role": "user", "content": f"**Knowledge base:**\nSections: {valid_chunks}\n**Question:** {question}\nFinal Response:"})
+    messages = get_answer_messages(valid_chunks, question, history)
 
     print(f"\nmessages: {json.dumps(messages, indent=2)}\n")
     try:
-        response = aoai_client.chat.completions.create(
-            model=aoai_deployment_name,
-            messages=messages,
-            temperature=0.0,
-            max_tokens=1200
-        )
+        with span("generate", model=aoai_deployment_name):
+            response = create_chat_completion(
+                aoai_client,
+                aoai_deployment_name,
+                "generate",
+                GENERATE_DEADLINE_SECONDS,
+                messages=messages,
+                temperature=0.0,
+                max_tokens=1200
+            )
         json_response = json.loads(response.model_dump_json())
         response = json_response['choices'][0]['message']['content']
     except Exception as ex:
@@ -262,10 +1031,66 @@ def generate_answer_with_history(aoai_client, aoai_deployment_name, valid_chunks
         response = None
     return response
 
-# Cut a text to a maximum number of tokens
-def cut_max_tokens(text):
-    tokens = encoding.encode(text)
+# Stream the answer with the conversation history, yielding the text deltas as they arrive
+# Returns the finish_reason of the answer ("stop" when it is complete) and raises when the stream fails (see call_aoai_stream)
+def generate_answer_with_history_stream(aoai_client, aoai_deployment_name, valid_chunks, question, history):
+    messages = get_answer_messages(valid_chunks, question, history)
+    return (yield from call_aoai_stream(aoai_client, aoai_deployment_name, messages, 0.0, 1200, operation="generate_stream",
+                                        deadline=GENERATE_DEADLINE_SECONDS))
+
+# Send a list of messages to the model deployed on Azure OpenAI with streaming, yielding the text deltas
+# The failures before the first token are retried (create_chat_completion_stream). A failure after it (connection lost,
+# deadline) is raised once the deltas received have been yielded, so the caller can tell a partial answer from a complete
+# one. The return value of the generator is the finish_reason of the completion ("stop", "length", "content_filter")
+# The span is not activated: the generator runs in the context of its caller between the chunks
+def call_aoai_stream(aoai_client, aoai_model_name, messages, temperature, max_tokens, operation="chat", deadline=AOAI_DEADLINE_SECONDS):
+    with span("generate_stream", activate=False, model=aoai_model_name) as stream_span:
+        try:
+            start = time.perf_counter()
+            deltas = 0
+            finish_reason = None
+            response = create_chat_completion_stream(
+                aoai_client,
+                aoai_model_name,
+                operation,
+                deadline,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens
+            )
+            for chunk in response:
+                # The first chunk of Azure OpenAI only contains the prompt filter results
+                if len(chunk.choices) == 0:
+                    continue
+                if chunk.choices[0].delta.content:
+                    if deltas == 0:
+                        stream_span.set(ttft_ms=round((time.perf_counter() - start) * 1000, 3))
+                    deltas += 1
+                    stream_span.set(deltas=deltas)
+                    yield chunk.choices[0].delta.content
+                if chunk.choices[0].finish_reason is not None:
+                    finish_reason = chunk.choices[0].finish_reason
+            stream_span.set(finish_reason=finish_reason)
+            return finish_reason
+        except Exception as ex:
+            print(f'ERROR call_aoai_stream: {ex}')
+            stream_span.set(error=str(ex))
+            raise
+
+# Messages to generate the answer with the conversation history
+def get_answer_messages(valid_chunks, question, history):
+    messages = [{'role': 'system', 'content': SYSTEM_PROMPT_GENERATE_ANSWER}]
+    messages += get_history_messages(history)
+    messages.append({"role": "user", "content": f"**Knowledge base:**\nSections: {valid_chunks}\n**Question:** {question}\nFinal Response:"})
+    return messages
+
+# Cut a text to a maximum number of tokens (num_tokens, when known from the chunker, avoids encoding the text again)
+def cut_max_tokens(text, num_tokens=None):
     max_tokens = 8191
+    if num_tokens is not None and num_tokens <= max_tokens:
+        return text
+    encoding = get_encoding()
+    tokens = encoding.encode(text)
     if len(tokens) > max_tokens:
         print(f'\t*** CUT TOKENS, tokens: {len(tokens)}')
         return encoding.decode(tokens[:max_tokens])
@@ -291,22 +1116,41 @@ conversation_messages = [{"role": "system", "content": SYSTEM_PROMPT_REWRITE_QUE
                          {"role": "assistant", "content": "Show available health plans"},]
 
 def generate_search_query(aoai_client, aoai_deployment_name, query, history):
-    curr_messages = conversation_messages.copy()
-    for q_a in history:
-        curr_messages.append({"role": "user", "content": q_a["question"]})
-        curr_messages.append({"role": "assistant", "content": q_a["answer"]})
-    curr_messages.append({"role": "user", "content": f"Generate search query for: {query}"})
+    curr_messages = get_search_query_messages(query, history)
     print(f"\ncurr_messages: {json.dumps(curr_messages, indent=2)}\n")
     try:
-        response = aoai_client.chat.completions.create(
-            model=aoai_deployment_name,
-            messages=curr_messages,
-            temperature=0.0,
-            max_tokens=1200
-        )
+        with span("rewrite", model=aoai_deployment_name):
+            response = create_chat_completion(
+                aoai_client,
+                aoai_deployment_name,
+                "rewrite",
+                REWRITE_DEADLINE_SECONDS,
+                messages=curr_messages,
+                temperature=0.0,
+                max_tokens=1200
+            )
         json_response = json.loads(response.model_dump_json())
         response = json_response['choices'][0]['message']['content']
     except Exception as ex:
         print(f'ERROR generate_query: {ex}')
         response = None
-    return response
\ No newline at end of file
+    return response
+
+# Messages to rewrite the user question as a search query
+def get_search_query_messages(query, history):
+    curr_messages = conversation_messages.copy()
+    curr_messages += get_history_messages(history)
+    curr_messages.append({"role": "user", "content": f"Generate search query for: {query}"})
+    return curr_messages
+
+# Messages of the conversation history, after the fixed system and few-shot messages (the prefix reused by the prompt cache)
+# history is a list of {"question", "answer"} or a ConversationMemory, whose summary of the older turns goes first
+def get_history_messages(history):
+    messages = []
+    summary = getattr(history, 'summary', None)
+    if summary:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+    for q_a in history:
+        messages.append({"role": "user", "content": q_a["question"]})
+        messages.append({"role": "assistant", "content": q_a["answer"]})
+    return messages
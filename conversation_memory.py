@@ -0,0 +1,100 @@
+from common_utils import get_encoding, call_aoai
+from prompts import SYSTEM_PROMPT_SUMMARIZE_HISTORY
+from tracing import span
+
+# CONSTANTS
+HISTORY_MAX_TOKENS = 2000 # Budget of the summary and the turns kept word by word, the older turns are summarized over it
+HISTORY_TARGET_TOKENS = 1200 # Tokens left after summarizing, so the history grows again for several turns before the next summary
+HISTORY_MIN_TURNS = 1 # Last turns never summarized
+HISTORY_ANSWER_MAX_TOKENS = 400 # Tokens of every answer stored in the history
+SUMMARY_MAX_TOKENS = 300
+
+# Conversation history with a token budget: the last questions and answers are kept word by word and the older ones are
+# folded into a running summary of the conversation (one call with the previous summary and the new old turns).
+# It is iterable like the list of {"question", "answer"} used by the prompts, and its summary is added after the fixed
+# system and few-shot messages. The turns are only removed in batches when the budget is exceeded, so between two summaries
+# the prompt of a turn starts with the whole prompt of the previous one and the provider prompt cache can reuse it.
+# Without an Azure OpenAI client (or when the summary fails) the old turns are dropped instead of summarized
+class ConversationMemory:
+    def __init__(self, aoai_client=None, aoai_deployment_name=None, max_tokens=HISTORY_MAX_TOKENS, target_tokens=HISTORY_TARGET_TOKENS,
+                 min_turns=HISTORY_MIN_TURNS, answer_max_tokens=HISTORY_ANSWER_MAX_TOKENS, summary_max_tokens=SUMMARY_MAX_TOKENS):
+        self.aoai_client = aoai_client
+        self.aoai_deployment_name = aoai_deployment_name
+        self.max_tokens = max_tokens
+        self.target_tokens = min(target_tokens, max_tokens)
+        self.min_turns = min_turns
+        self.answer_max_tokens = answer_max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.turns = []
+        self.summary = None
+        self.summary_tokens = 0
+        self.counters = {"turns": 0, "summaries": 0, "summarized_turns": 0, "dropped_turns": 0, "cut_answers": 0}
+
+    def __iter__(self):
+        return iter(self.turns)
+
+    def __len__(self):
+        return len(self.turns)
+
+    # Tokens of the summary and of the turns in the history
+    def tokens(self):
+        return self.summary_tokens + sum(turn["tokens"] for turn in self.turns)
+
+    # Add a question and its answer, summarizing the older turns when the history is over the budget
+    def add_turn(self, question, answer):
+        answer = self.cut_answer(answer or '')
+        encoding = get_encoding()
+        self.turns.append({"question": question, "answer": answer,
+                           "tokens": len(encoding.encode(question)) + len(encoding.encode(answer))})
+        self.counters["turns"] += 1
+        if self.tokens() > self.max_tokens:
+            self.compact()
+
+    # Only the beginning of a long answer is needed to rewrite the next questions and to keep the conversation coherent
+    def cut_answer(self, answer):
+        encoding = get_encoding()
+        tokens = encoding.encode(answer)
+        if len(tokens) <= self.answer_max_tokens:
+            return answer
+        self.counters["cut_answers"] += 1
+        return encoding.decode(tokens[:self.answer_max_tokens]) + ' ...'
+
+    # Move the oldest turns to the summary until the summary and the rest of the turns fit in target_tokens
+    def compact(self):
+        old_turns = []
+        turns_tokens = sum(turn["tokens"] for turn in self.turns)
+        while len(self.turns) > self.min_turns and self.summary_max_tokens + turns_tokens > self.target_tokens:
+            turn = self.turns.pop(0)
+            turns_tokens -= turn["tokens"]
+            old_turns.append(turn)
+        if len(old_turns) == 0:
+            return
+        summary = self.summarize(old_turns)
+        if summary is None:
+            self.counters["dropped_turns"] += len(old_turns)
+            return
+        self.summary = summary
+        self.summary_tokens = len(get_encoding().encode(summary))
+        self.counters["summaries"] += 1
+        self.counters["summarized_turns"] += len(old_turns)
+
+    # New summary with the previous summary and the turns removed from the history
+    def summarize(self, old_turns):
+        if self.aoai_client is None:
+            return None
+        turns = '\n'.join(f'Question: {turn["question"]}\nAnswer: {turn["answer"]}' for turn in old_turns)
+        user_prompt = f"**Summary of the conversation:**\n{self.summary or 'None'}\n**New questions and answers:**\n{turns}\nUpdated summary:"
+        with span("summarize_history", model=self.aoai_deployment_name, turns=len(old_turns)):
+            summary = call_aoai(self.aoai_client, self.aoai_deployment_name, SYSTEM_PROMPT_SUMMARIZE_HISTORY, user_prompt, 0.0,
+                                self.summary_max_tokens, operation="summarize_history")
+        if summary is None or summary.strip() == '':
+            print(f'ERROR ConversationMemory: the summary of {len(old_turns)} turns could not be generated, they are dropped')
+            return None
+        return summary.strip()
+
+    # Turns as the list of {"question", "answer"} of the prompts (to print or log them)
+    def to_list(self):
+        return [{"question": turn["question"], "answer": turn["answer"]} for turn in self.turns]
+
+    def stats(self):
+        return dict(self.counters, history_turns=len(self.turns), history_tokens=self.tokens(), summary_tokens=self.summary_tokens)
@@ -0,0 +1,74 @@
+import concurrent.futures
+import queue
+import threading
+import time
+
+from common_utils import create_embeddings
+
+# CONSTANTS
+EMBEDDING_BATCH_WAIT_MS = 5 # Milliseconds the first text of a batch waits for the texts of other requests
+EMBEDDING_BATCH_MAX = 16 # Texts of one embeddings request
+EMBEDDING_BATCH_WORKERS = 4 # Batches sent at the same time
+
+# Micro-batcher of embeddings: the texts embedded at the same time by different requests (threads) are collected for
+# max_wait_ms milliseconds, or until max_batch texts, and sent in one embeddings request with create_embeddings (embedding
+# cache included). Every caller waits only for the embedding of its text. Enabled in create_embedding with
+# set_embedding_batcher, so semantic_hybrid_search and federated_search use it without changes
+class EmbeddingBatcher:
+    def __init__(self, max_wait_ms=EMBEDDING_BATCH_WAIT_MS, max_batch=EMBEDDING_BATCH_MAX, workers=EMBEDDING_BATCH_WORKERS):
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.counters = {"texts": 0, "batches": 0, "max_batch": 0, "errors": 0}
+        # A slow embeddings request does not stop the collection of the next batch
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='embedding-batch')
+        threading.Thread(target=self.collect, name='embedding-batcher', daemon=True).start()
+
+    # Embedding of one text, calculated in the next batch
+    def embed(self, openai_client, aoai_embedding_model, text):
+        future = concurrent.futures.Future()
+        self.requests.put((openai_client, aoai_embedding_model, text, future))
+        return future.result()
+
+    def collect(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # One request for every client and model of the batch
+            groups = {}
+            for request in batch:
+                groups.setdefault((id(request[0]), request[1]), []).append(request)
+            for requests in groups.values():
+                self.executor.submit(self.send, requests)
+
+    def send(self, requests):
+        try:
+            embeddings = create_embeddings(requests[0][0], requests[0][1], [request[2] for request in requests])
+        except Exception as ex:
+            print(f'ERROR EmbeddingBatcher: {ex}')
+            with self.lock:
+                self.counters["errors"] += 1
+            for request in requests:
+                request[3].set_exception(ex)
+            return
+        with self.lock:
+            self.counters["texts"] += len(requests)
+            self.counters["batches"] += 1
+            self.counters["max_batch"] = max(self.counters["max_batch"], len(requests))
+        for request, embedding in zip(requests, embeddings):
+            request[3].set_result(embedding)
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+        counters["mean_batch"] = round(counters["texts"] / counters["batches"], 2) if counters["batches"] > 0 else 0.0
+        return counters
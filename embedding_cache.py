@@ -0,0 +1,176 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+# CONSTANTS
+EMBEDDING_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'embedding_cache.db')
+EMBEDDING_CACHE_MEMORY_ITEMS = 4096 # Embeddings kept in the in-process LRU (~6 KB each for 1536 dimensions)
+EMBEDDING_CACHE_MAX_MB = 1024 # Size of the vectors stored on disk before evicting the least recently used
+EMBEDDING_CACHE_TOUCH_ITEMS = 1000 # Pending updates of last_used written in one transaction
+EMBEDDING_CACHE_TOUCH_SECONDS = 60 # Maximum seconds an update of last_used waits to be written
+
+# Persistent embedding cache: SQLite on disk keyed by (model, text hash) with an in-process LRU in front
+class EmbeddingCache:
+    def __init__(self, path=EMBEDDING_CACHE_FILE, memory_items=EMBEDDING_CACHE_MEMORY_ITEMS, max_mb=EMBEDDING_CACHE_MAX_MB):
+        self.path = path
+        self.memory_items = memory_items
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        # last_used of the hits, written in batches: the order of the evictions does not need a write on every hit
+        self.touched = {}
+        self.touched_at = time.monotonic()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                                model TEXT NOT NULL,
+                                hash TEXT NOT NULL,
+                                vector BLOB NOT NULL,
+                                last_used REAL NOT NULL,
+                                PRIMARY KEY (model, hash))""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+
+    # Get the embeddings of a list of texts, None for the texts not in the cache
+    def get_many(self, model, texts):
+        keys = [text_hash(text) for text in texts]
+        found = {}
+        with self.lock:
+            for key in keys:
+                vector = self.memory.get((model, key))
+                if vector is not None:
+                    self.memory.move_to_end((model, key))
+                    found[key] = vector
+            missing = [key for key in dict.fromkeys(keys) if key not in found]
+            self.counters["memory_hits"] += sum(1 for key in keys if key in found)
+            if len(missing) > 0:
+                rows = []
+                for i in range(0, len(missing), 500): # SQLite limits the number of variables per query
+                    part = missing[i:i + 500]
+                    rows += self.conn.execute(
+                        f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(part))})",
+                        [model] + part).fetchall()
+                for key, vector in rows:
+                    found[key] = vector
+                    self.remember(model, key, vector)
+                missing = set(missing)
+                self.counters["disk_hits"] += sum(1 for key in keys if key in missing and key in found)
+                self.counters["misses"] += sum(1 for key in keys if key not in found)
+            now = time.time()
+            for key in found:
+                self.touched[(model, key)] = now
+            if len(self.touched) >= EMBEDDING_CACHE_TOUCH_ITEMS or time.monotonic() - self.touched_at >= EMBEDDING_CACHE_TOUCH_SECONDS:
+                self.write_touched()
+                self.conn.commit()
+        return [to_list(found[key]) if key in found else None for key in keys]
+
+    # Store the embeddings of a list of texts
+    def put_many(self, model, texts, embeddings):
+        now = time.time()
+        rows = []
+        with self.lock:
+            for text, embedding in zip(texts, embeddings):
+                key = text_hash(text)
+                vector = array('f', embedding).tobytes()
+                self.remember(model, key, vector)
+                self.touched.pop((model, key), None)
+                rows.append((model, key, vector, now))
+            for model_name, key, vector, _ in rows:
+                old = self.conn.execute("SELECT LENGTH(vector) FROM embeddings WHERE model = ? AND hash = ?",
+                                        (model_name, key)).fetchone()
+                self.size += len(vector) - (old[0] if old else 0)
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings (model, hash, vector, last_used) VALUES (?, ?, ?, ?)", rows)
+            self.write_touched()
+            self.conn.commit()
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def get(self, model, text):
+        return self.get_many(model, [text])[0]
+
+    def put(self, model, text, embedding):
+        self.put_many(model, [text], [embedding])
+
+    # Update last_used of the pending hits, in the transaction of the caller
+    def write_touched(self):
+        if len(self.touched) > 0:
+            self.conn.executemany("UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?",
+                                  [(last_used, model, key) for (model, key), last_used in self.touched.items()])
+            self.touched = {}
+        self.touched_at = time.monotonic()
+
+    # Keep a vector in the in-process LRU
+    def remember(self, model, key, vector):
+        self.memory[(model, key)] = vector
+        self.memory.move_to_end((model, key))
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    # Delete the least recently used vectors until the cache uses 90% of its maximum size
+    def evict(self):
+        target = int(self.max_bytes * 0.9)
+        while self.size > target:
+            rows = self.conn.execute("SELECT model, hash, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 500").fetchall()
+            if len(rows) == 0:
+                break
+            evicted = []
+            for model, key, size in rows:
+                if self.size <= target:
+                    break
+                evicted.append((model, key))
+                self.size -= size
+                self.memory.pop((model, key), None)
+            self.conn.executemany("DELETE FROM embeddings WHERE model = ? AND hash = ?", evicted)
+            self.counters["evictions"] += len(evicted)
+        self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["hits"] = stats["memory_hits"] + stats["disk_hits"]
+            total = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = round(stats["hits"] / total, 4) if total > 0 else 0.0
+            stats["disk_mb"] = round(self.size / 1024 / 1024, 2)
+        return stats
+
+    def reset_stats(self):
+        with self.lock:
+            for name in self.counters:
+                self.counters[name] = 0
+
+    def close(self):
+        with self.lock:
+            self.write_touched()
+            self.conn.commit()
+            self.conn.close()
+
+# Hash of the text used as key in the cache
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+# Convert a float32 vector stored in the cache to a list, the same format returned by Azure OpenAI
+def to_list(vector):
+    values = array('f')
+    values.frombytes(vector)
+    return values.tolist()
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+# Shared cache of the process, configured with EMBEDDING_CACHE_PATH (empty to disable it) and EMBEDDING_CACHE_MAX_MB
+def get_embedding_cache():
+    global _embedding_cache
+    if _embedding_cache is None:
+        with _embedding_cache_lock:
+            if _embedding_cache is None:
+                path = os.getenv('EMBEDDING_CACHE_PATH', EMBEDDING_CACHE_FILE)
+                if path == '':
+                    return None
+                _embedding_cache = EmbeddingCache(path, max_mb=float(os.getenv('EMBEDDING_CACHE_MAX_MB', EMBEDDING_CACHE_MAX_MB)))
+    return _embedding_cache
@@ -0,0 +1,457 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from openai import RateLimitError, APIConnectionError, InternalServerError
+from azure.search.documents import SearchIndexingBufferedSender
+# Classes of the index definition, used by create_index in the indexing notebook (not imported by common_utils, that
+# only loads what the queries need)
+from azure.search.documents.indexes import SearchIndexClient
+from azure.search.documents.indexes.models import (
+    SimpleField, SearchFieldDataType, SearchableField, SearchField, VectorSearch, HnswAlgorithmConfiguration,
+    VectorSearchProfile, SemanticConfiguration, SemanticPrioritizedFields, SemanticField, SemanticSearch,
+    SearchIndex, VectorSearchAlgorithmKind, HnswParameters, VectorSearchAlgorithmMetric
+)
+
+from common_utils import create_embeddings, cut_max_tokens
+from embedding_cache import get_embedding_cache
+
+# CONSTANTS
+EMBEDDING_BATCH_SIZE = 16 # Chunks embedded per request (title + content, so up to 32 inputs)
+EMBEDDING_MAX_WORKERS = 4 # Embedding requests in flight at the same time
+UPLOAD_FLUSH_DOCS = 100 # Documents sent to AI Search in every flush
+UPLOAD_FLUSH_BYTES = 8 * 1024 * 1024 # Flush before reaching the 16 MB request limit of AI Search
+EMBEDDING_JSON_BYTES = 20 # Approximate size of one float of an embedding serialized in JSON
+MAX_THROTTLE_RETRIES = 8
+# Manifests and version stamps of the indexes, the apps read the stamps to invalidate the answer cache (answer_cache.py)
+INDEX_MANIFESTS_DIR = os.getenv('INDEX_MANIFESTS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index_manifests'))
+CONVERSION_MAX_IN_FLIGHT = 8 # Document Intelligence analyze operations running at the same time
+CONVERSION_POLLING_INTERVAL = 1.0 # Seconds between the status requests of an analyze operation
+CONVERSION_TIMEOUT = 600 # Seconds to wait for the analysis of one document
+MARKDOWN_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'markdown_cache') # Markdown by SHA-256 of the document
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Adaptive throttling: wait only when the service answers 429, and relax again after successful calls
+class AdaptiveThrottle:
+    def __init__(self, min_delay=1.0, max_delay=60.0):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            delay = self.delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def on_success(self):
+        with self.lock:
+            self.delay = self.delay / 2 if self.delay > self.min_delay else 0.0
+
+    def on_throttle(self, retry_after=None):
+        with self.lock:
+            self.throttled += 1
+            delay = max(self.min_delay, self.delay * 2)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            self.delay = min(delay, self.max_delay)
+            return self.delay
+
+    # Call a function retrying it while the service returns 429, a 5xx or a connection error (timeouts included)
+    # The only retries of the call: the client must be created with max_retries=0, otherwise every attempt of this loop
+    # includes the retries of the SDK
+    def call(self, fn, *args, **kwargs):
+        for attempt in range(MAX_THROTTLE_RETRIES):
+            self.wait()
+            try:
+                result = fn(*args, **kwargs)
+                self.on_success()
+                return result
+            except RateLimitError as ex:
+                delay = self.on_throttle(get_retry_after(ex))
+                print(f'\t*** THROTTLED (429), attempt {attempt + 1}, waiting {delay:.1f} seconds...')
+            except (APIConnectionError, InternalServerError) as ex:
+                delay = self.on_throttle()
+                print(f'\t*** ERROR ({type(ex).__name__}), attempt {attempt + 1}, waiting {delay:.1f} seconds...')
+        self.wait()
+        return fn(*args, **kwargs)
+
+# Read the seconds to wait from the 'retry-after' headers of a 429 response
+def get_retry_after(ex):
+    headers = getattr(getattr(ex, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+# Split an iterable in lists of a maximum size
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+# Create the embeddings of titles and contents of a batch of chunks with one request
+def embed_batch(embedding_client, embedding_model_name, throttle, batch):
+    # Every distinct text is sent once (the title is usually the same for all the chunks of a file)
+    texts = []
+    for _, content in batch:
+        texts.append(cut_max_tokens(content['title'], content.get('title_tokens')))
+        texts.append(cut_max_tokens(content['content'], content.get('tokens')))
+    unique_texts = list(dict.fromkeys(texts))
+    embeddings = dict(zip(unique_texts, throttle.call(create_embeddings, embedding_client, embedding_model_name, unique_texts)))
+
+    documents = []
+    for j, (chunk_id, content) in enumerate(batch):
+        documents.append({
+            "id": chunk_id,
+            "title": content['title'],
+            "content": content['content'],
+            "embeddingTitle": embeddings[texts[2 * j]],
+            "embeddingContent": embeddings[texts[2 * j + 1]],
+        })
+    return documents
+
+# Approximate size in bytes of a document in the upload request
+def document_size(document):
+    size = len(document['title'].encode('utf-8')) + len(document['content'].encode('utf-8'))
+    size += EMBEDDING_JSON_BYTES * (len(document['embeddingTitle']) + len(document['embeddingContent']))
+    return size
+
+# Queue documents in the buffered sender and flush them by number of documents and by size
+class DocumentUploader:
+    def __init__(self, batch_client, flush_docs=UPLOAD_FLUSH_DOCS, flush_bytes=UPLOAD_FLUSH_BYTES):
+        self.batch_client = batch_client
+        self.flush_docs = flush_docs
+        self.flush_bytes = flush_bytes
+        self.pending_docs = 0
+        self.pending_bytes = 0
+        self.pending_ids = []
+        self.uploaded = 0
+        self.uploaded_ids = set()
+        self.deleted = 0
+
+    def upload(self, documents):
+        for document in documents:
+            size = document_size(document)
+            if self.pending_docs > 0 and self.pending_bytes + size > self.flush_bytes:
+                self.flush()
+            self.batch_client.merge_or_upload_documents(documents=[document])
+            self.pending_ids.append(document["id"])
+            self.pending_docs += 1
+            self.pending_bytes += size
+            if self.pending_docs >= self.flush_docs:
+                self.flush()
+
+    # Delete documents by id
+    def delete(self, ids):
+        self.flush()
+        for batch in batched(ids, self.flush_docs):
+            self.batch_client.delete_documents(documents=[{"id": chunk_id} for chunk_id in batch])
+            self.batch_client.flush()
+            self.deleted += len(batch)
+
+    def flush(self):
+        if self.pending_docs == 0:
+            return
+        self.batch_client.flush()
+        self.uploaded += self.pending_docs
+        self.uploaded_ids.update(self.pending_ids)
+        self.pending_docs = 0
+        self.pending_bytes = 0
+        self.pending_ids = []
+
+# Deterministic id of a chunk built from its source, its position in the source and the hash of its content
+def make_chunk_id(source, ordinal, title, content):
+    source_hash = hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]
+    content_hash = hashlib.sha256(f'{title}\n{content}'.encode('utf-8')).hexdigest()[:16]
+    return f'{source_hash}-{ordinal}-{content_hash}'
+
+# Local manifest of the chunks indexed from every source: {"sources": {source: [chunk ids]}}
+def get_manifest_path(index_name):
+    return os.path.join(INDEX_MANIFESTS_DIR, f'{index_name}.json')
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {"sources": {}}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+# Save the manifest and the version stamp of the index (<index name>.version), the hash of all the chunk ids: it changes
+# when any chunk is added, changed or deleted, and stays the same when an incremental run does not change anything
+def save_manifest(manifest_path, manifest):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(get_manifest_version(manifest))
+    os.replace(tmp_path, get_version_path(manifest_path))
+
+def get_manifest_version(manifest):
+    return hashlib.sha256(json.dumps(manifest["sources"], sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def get_version_path(manifest_path):
+    return os.path.splitext(manifest_path)[0] + '.version'
+
+# Index the contents or chunks: batched embeddings, concurrent requests and buffered uploads
+# Every content can include a 'source' (file path, table...), by default its title is used as source
+# incremental=True embeds and uploads only new or changed chunks and deletes the stale chunks of the indexed sources,
+# delete_missing_sources=True also deletes the chunks of the sources in the manifest not included in contents
+# batch_client replaces the SearchIndexingBufferedSender, for example with a LocalSearchClient of local_search.py
+def index_documents(ai_search_endpoint, ai_search_credential, index_name, embedding_client, embedding_model_name, contents,
+                    batch_size=EMBEDDING_BATCH_SIZE, max_workers=EMBEDDING_MAX_WORKERS,
+                    flush_docs=UPLOAD_FLUSH_DOCS, flush_bytes=UPLOAD_FLUSH_BYTES,
+                    incremental=False, delete_missing_sources=False, manifest_path=None, batch_client=None):
+    print(f'Indexing documents in {index_name} index (incremental: {incremental})...')
+    throttle = AdaptiveThrottle()
+    # The retries of the embeddings are the ones of the throttle, without the retries of the SDK in every attempt
+    embedding_client = embedding_client.with_options(max_retries=0)
+    errors = []
+    cache = get_embedding_cache()
+    cache_before = cache.stats() if cache is not None else None
+    manifest_path = manifest_path or get_manifest_path(index_name)
+    manifest = load_manifest(manifest_path)
+    indexed = {}
+    seen = {}
+    unchanged = 0
+    start = time.perf_counter()
+
+    # Assign the chunk ids and skip the chunks already indexed with the same content
+    def new_chunks():
+        nonlocal unchanged
+        for content in contents:
+            source = content.get('source', content['title'])
+            if source not in seen:
+                seen[source] = []
+                indexed[source] = set(manifest["sources"].get(source, []))
+            chunk_id = make_chunk_id(source, len(seen[source]), content['title'], content['content'])
+            seen[source].append(chunk_id)
+            if incremental and chunk_id in indexed[source]:
+                unchanged += 1
+                continue
+            yield chunk_id, content
+
+    # Create an index batch client, the documents are sent only when the uploader flushes them
+    if batch_client is None:
+        batch_client = SearchIndexingBufferedSender(endpoint=ai_search_endpoint,
+                                                    index_name=index_name,
+                                                    credential=ai_search_credential,
+                                                    auto_flush=False,
+                                                    initial_batch_action_count=flush_docs,
+                                                    on_error=errors.append)
+    uploader = DocumentUploader(batch_client, flush_docs, flush_bytes)
+    # Chunks of the batches whose embeddings failed after the retries of the throttle, indexed in the next run
+    not_embedded = []
+    batches = {}
+    stale = {}
+    incomplete = set()
+    completed = False
+
+    # Upload the documents of an embedded batch, or record its chunks as not embedded
+    def upload_batch(future):
+        chunk_ids = batches.pop(future)
+        try:
+            documents = future.result()
+        except Exception as ex:
+            print(f'ERROR index_documents: {len(chunk_ids)} chunks not embedded: {ex}')
+            not_embedded.extend(chunk_ids)
+            return
+        uploader.upload(documents)
+        print_progress(uploader, start)
+
+    try:
+        with batch_client:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for batch in batched(new_chunks(), batch_size):
+                    future = executor.submit(embed_batch, embedding_client, embedding_model_name, throttle, batch)
+                    batches[future] = [chunk_id for chunk_id, _ in batch]
+                    # Keep a bounded number of batches in memory
+                    if len(batches) >= max_workers * 2:
+                        done, _ = concurrent.futures.wait(batches, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            upload_batch(future)
+                for future in concurrent.futures.as_completed(list(batches)):
+                    upload_batch(future)
+            uploader.flush()
+
+            # Delete the chunks that are not in the current version of the sources, except in the sources with chunks not
+            # embedded: their previous chunks are kept until the new ones are indexed
+            incomplete = get_chunk_sources(seen, not_embedded)
+            for source, chunk_ids in seen.items():
+                if source not in incomplete:
+                    stale[source] = indexed[source] - set(chunk_ids)
+            if delete_missing_sources:
+                for source, chunk_ids in manifest["sources"].items():
+                    if source not in seen:
+                        stale[source] = set(chunk_ids)
+            uploader.delete([chunk_id for chunk_ids in stale.values() for chunk_id in chunk_ids])
+        completed = True
+    finally:
+        # Also when the indexing fails, so the chunks already uploaded are not embedded and uploaded again in the next run
+        failed = {action.additional_properties.get("id") for action in errors if action.additional_properties}
+        update_manifest(manifest, seen, stale if completed else {}, uploader.uploaded_ids, failed,
+                        incomplete if completed else set(seen))
+        save_manifest(manifest_path, manifest)
+
+    elapsed = time.perf_counter() - start
+    stats = {
+        "chunks": uploader.uploaded,
+        "unchanged": unchanged,
+        "deleted": uploader.deleted,
+        "errors": len(errors) + len(not_embedded),
+        "throttled": throttle.throttled,
+        "seconds": round(elapsed, 2),
+        "chunks_per_sec": round(uploader.uploaded / elapsed, 2) if elapsed > 0 else 0.0,
+    }
+    if cache is not None:
+        cache_after = cache.stats()
+        stats["embedding_cache_hits"] = cache_after["hits"] - cache_before["hits"]
+        stats["embedding_cache_misses"] = cache_after["misses"] - cache_before["misses"]
+    print(f'Indexed {stats["chunks"]} chunks in {stats["seconds"]} seconds ({stats["chunks_per_sec"]} chunks/sec), '
+          f'unchanged: {stats["unchanged"]}, deleted: {stats["deleted"]}, errors: {stats["errors"]}, throttled: {stats["throttled"]}')
+    if cache is not None:
+        print(f'Embedding cache hits: {stats["embedding_cache_hits"]}, misses: {stats["embedding_cache_misses"]}')
+    return stats
+
+# Sources of some chunk ids
+def get_chunk_sources(seen, chunk_ids):
+    chunk_ids = set(chunk_ids)
+    return {source for source, source_chunk_ids in seen.items() if any(chunk_id in chunk_ids for chunk_id in source_chunk_ids)}
+
+# Update the manifest with the chunks indexed, keeping the failed deletions to retry them in the next run
+# The incomplete sources (chunks not embedded, or an indexing that failed) keep their previous chunks plus the ones uploaded
+# in this run: the next run skips the uploaded chunks, indexes the rest and deletes the stale ones
+def update_manifest(manifest, seen, stale, uploaded_ids, failed, incomplete):
+    for source, chunk_ids in seen.items():
+        if source in incomplete:
+            uploaded = [chunk_id for chunk_id in chunk_ids if chunk_id in uploaded_ids and chunk_id not in failed]
+            manifest["sources"][source] = list(dict.fromkeys(manifest["sources"].get(source, []) + uploaded))
+        else:
+            manifest["sources"][source] = [chunk_id for chunk_id in chunk_ids if chunk_id not in failed]
+    for source, chunk_ids in stale.items():
+        remaining = (manifest["sources"][source] if source in seen else []) + [chunk_id for chunk_id in chunk_ids if chunk_id in failed]
+        if len(remaining) > 0:
+            manifest["sources"][source] = remaining
+        else:
+            manifest["sources"].pop(source, None)
+
+# Print the number of uploaded chunks and the throughput
+def print_progress(uploader, start):
+    elapsed = time.perf_counter() - start
+    pending = uploader.uploaded + uploader.pending_docs
+    print(f'\tEmbedded {pending} chunks, uploaded {uploader.uploaded} ({pending / elapsed:.1f} chunks/sec)')
+
+# Convert the documents of a directory to markdown with Document Intelligence (prebuilt-layout)
+# - up to max_in_flight analyze operations run at the same time, and one loop checks all their pollers
+# - the markdown is cached by the SHA-256 of the document, so unchanged documents are not analyzed again
+# - the documents are uploaded from the open file, without reading them in memory
+# Return the report of every document: status (converted, cached or failed), seconds, bytes and error
+def convert_documents_to_markdown(doc_intel_client, input_dir, output_dir, extension='.pdf', max_in_flight=CONVERSION_MAX_IN_FLIGHT,
+                                  cache_dir=MARKDOWN_CACHE_DIR, polling_interval=CONVERSION_POLLING_INTERVAL, timeout=CONVERSION_TIMEOUT):
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    file_paths = sorted(os.path.join(input_dir, filename) for filename in os.listdir(input_dir) if filename.lower().endswith(extension))
+    print(f'Converting {len(file_paths)} documents in {input_dir} to markdown (in flight: {max_in_flight})...')
+    start = time.perf_counter()
+    reports = []
+    pending = {} # Documents to analyze by hash, a document repeated in the directory is analyzed once
+    for file_path in file_paths:
+        report = {"file": file_path, "output": get_markdown_path(file_path, output_dir), "status": None,
+                  "seconds": 0.0, "bytes": os.path.getsize(file_path), "error": None}
+        reports.append(report)
+        file_hash = hash_file(file_path)
+        cache_path = os.path.join(cache_dir, f'{file_hash}.md')
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                write_markdown(report["output"], f.read())
+            report["status"] = "cached"
+        else:
+            pending.setdefault(file_hash, []).append(report)
+
+    # Start the operations while there is room, and finish the ones done or timed out
+    queue = deque(pending.items())
+    in_flight = []
+    while len(queue) > 0 or len(in_flight) > 0:
+        while len(queue) > 0 and len(in_flight) < max_in_flight:
+            file_hash, file_reports = queue.popleft()
+            try:
+                with open(file_reports[0]["file"], 'rb') as f:
+                    poller = begin_markdown_analysis(doc_intel_client, f, polling_interval)
+                in_flight.append((poller, file_hash, file_reports, time.perf_counter()))
+            except Exception as ex:
+                finish_conversion(file_reports, None, None, ex, 0.0)
+        time.sleep(min(polling_interval, 0.1))
+        running = []
+        for poller, file_hash, file_reports, started in in_flight:
+            seconds = time.perf_counter() - started
+            if poller.done():
+                try:
+                    finish_conversion(file_reports, os.path.join(cache_dir, f'{file_hash}.md'), poller.result().content, None, seconds)
+                except Exception as ex:
+                    finish_conversion(file_reports, None, None, ex, seconds)
+            elif seconds > timeout:
+                finish_conversion(file_reports, None, None, TimeoutError(f'analysis not finished in {timeout} seconds'), seconds)
+            else:
+                running.append((poller, file_hash, file_reports, started))
+        in_flight = running
+
+    elapsed = time.perf_counter() - start
+    counts = {status: sum(1 for report in reports if report["status"] == status) for status in ("converted", "cached", "failed")}
+    print(f'Converted {counts["converted"]} documents in {elapsed:.1f} seconds, cached: {counts["cached"]}, failed: {counts["failed"]}')
+    return reports
+
+# Start the analysis of a document (bytes or open file) with the prebuilt-layout model and markdown output
+def begin_markdown_analysis(doc_intel_client, document, polling_interval=CONVERSION_POLLING_INTERVAL):
+    return doc_intel_client.begin_analyze_document("prebuilt-layout",
+                                                   body=document,
+                                                   output_content_format="markdown",
+                                                   content_type="application/octet-stream",
+                                                   polling_interval=polling_interval)
+
+# Save the markdown of an analyzed document in the cache and in the output of every file with its content
+def finish_conversion(file_reports, cache_path, markdown, error, seconds):
+    for report in file_reports:
+        report["seconds"] = round(seconds, 3)
+        if error is None:
+            write_markdown(report["output"], markdown)
+            report["status"] = "converted"
+            print(f'\tConverted {report["file"]} in {seconds:.1f} seconds')
+        else:
+            report["status"] = "failed"
+            report["error"] = f'{type(error).__name__}: {error}'
+            print(f'ERROR convert_documents_to_markdown {report["file"]}: {error}')
+    if error is None:
+        write_markdown(cache_path, markdown)
+
+def get_markdown_path(file_path, output_dir):
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(file_path))[0] + '.md')
+
+# SHA-256 of a file read in blocks
+def hash_file(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+# Write a file through a temporary file, so an interrupted run does not leave a partial markdown
+def write_markdown(path, markdown):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(markdown)
+    os.replace(tmp_path, path)
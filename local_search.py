@@ -0,0 +1,308 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import numpy as np
+
+# CONSTANTS
+VECTOR_FIELDS = ["embeddingTitle", "embeddingContent"]
+RRF_K = 60 # Constant of the reciprocal rank fusion, the same used by Azure AI Search
+BLOCK_ROWS = 65536 # Rows of the vector matrix loaded at once in the exact search (~400 MB for 1536 dimensions)
+INITIAL_CAPACITY = 1024
+BM25_WEIGHTS = (2.0, 1.0) # Weights of title and content in BM25
+PENDING_MAX_DOCS = 1000 # Documents added or updated in one SQLite transaction (and one insertion in the HNSW indexes)
+
+# Local hybrid search backend with the interface of the SearchClient used by semantic_hybrid_search:
+# - vectors of embeddingTitle and embeddingContent in memory-mapped float32 matrices (normalized, so dot product = cosine)
+# - BM25 inverted index over title and content with SQLite FTS5, and the documents in the same SQLite database
+# - keyword and vector results fused with reciprocal rank fusion
+# RAM stays bounded with millions of chunks: the exact vector search reads the matrices in blocks, and ann=True
+# uses an HNSW index (pip install hnswlib) instead
+# Like the SearchIndexingBufferedSender, the uploaded documents are written in batches (flush, every PENDING_MAX_DOCS
+# documents or before a search) and the HNSW indexes are saved to disk only by save, close or at the end of a with block
+class LocalSearchClient:
+    def __init__(self, index_dir, ann=False):
+        os.makedirs(index_dir, exist_ok=True)
+        self.index_dir = index_dir
+        self.ann = ann
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(os.path.join(index_dir, 'documents.db'), check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS documents (
+                                row INTEGER PRIMARY KEY,
+                                id TEXT UNIQUE NOT NULL,
+                                title TEXT,
+                                content TEXT,
+                                deleted INTEGER NOT NULL DEFAULT 0)""")
+        self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(title, content)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+        metadata = dict(self.conn.execute("SELECT key, value FROM metadata").fetchall())
+        self.dimensions = int(metadata["dimensions"]) if "dimensions" in metadata else None
+        self.capacity = int(metadata.get("capacity", 0))
+        self.count = self.conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM documents").fetchone()[0]
+        self.deleted = np.zeros(max(self.capacity, 1), dtype=bool)
+        for (row,) in self.conn.execute("SELECT row FROM documents WHERE deleted = 1"):
+            self.deleted[row] = True
+        self.vectors = {}
+        self.ann_indexes = {}
+        self.pending = []
+        if self.dimensions is not None and self.capacity > 0:
+            self.open_vectors()
+            if self.ann:
+                self.open_ann_indexes()
+
+    def vectors_path(self, field):
+        return os.path.join(self.index_dir, f'{field}.f32')
+
+    def open_vectors(self):
+        for field in VECTOR_FIELDS:
+            self.vectors[field] = np.memmap(self.vectors_path(field), dtype=np.float32, mode='r+', shape=(self.capacity, self.dimensions))
+
+    def open_ann_indexes(self):
+        for field in VECTOR_FIELDS:
+            self.ann_indexes[field] = self.open_ann_index(field)
+
+    # Grow the memory-mapped matrices doubling their capacity
+    def grow(self, rows):
+        capacity = max(self.capacity, INITIAL_CAPACITY)
+        while capacity < rows:
+            capacity *= 2
+        if capacity == self.capacity:
+            return
+        for field in VECTOR_FIELDS:
+            if field in self.vectors:
+                self.vectors[field].flush()
+                del self.vectors[field]
+            with open(self.vectors_path(field), 'ab') as f:
+                f.truncate(capacity * self.dimensions * 4)
+        deleted = np.zeros(capacity, dtype=bool)
+        deleted[:len(self.deleted)] = self.deleted[:capacity]
+        self.deleted = deleted
+        self.capacity = capacity
+        self.conn.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('capacity', ?)", (str(capacity),))
+        self.open_vectors()
+        for index in self.ann_indexes.values():
+            index.resize_index(capacity)
+
+    # Optional HNSW index of a vector field
+    def open_ann_index(self, field):
+        import hnswlib
+        path = os.path.join(self.index_dir, f'{field}.hnsw')
+        index = hnswlib.Index(space='ip', dim=self.dimensions)
+        rows = np.arange(self.count)
+        if os.path.exists(path):
+            index.load_index(path, max_elements=self.capacity)
+            # Rows added after the last save (a process that ended without closing the client)
+            rows = np.setdiff1d(rows, np.asarray(index.get_ids_list(), dtype=np.int64))
+        else:
+            index.init_index(max_elements=self.capacity, ef_construction=400, M=16)
+        if len(rows) > 0:
+            index.add_items(np.asarray(self.vectors[field][rows]), rows)
+            for row in rows[self.deleted[rows]]:
+                index.mark_deleted(int(row))
+        index.resize_index(self.capacity)
+        index.set_ef(500)
+        return index
+
+    # Add or update documents with the fields produced by index_documents: id, title, content, embeddingTitle, embeddingContent
+    def merge_or_upload_documents(self, documents):
+        with self.lock:
+            self.pending += documents
+            if len(self.pending) >= PENDING_MAX_DOCS:
+                self.write_pending()
+
+    # Write the pending documents in one transaction
+    def write_pending(self):
+        with self.lock:
+            # The last version of every document
+            documents = list({document["id"]: document for document in self.pending}.values())
+            self.pending = []
+            if len(documents) == 0:
+                return
+            if self.dimensions is None:
+                self.dimensions = len(documents[0][VECTOR_FIELDS[0]])
+                self.conn.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('dimensions', ?)", (str(self.dimensions),))
+            rows = []
+            for document in documents:
+                existing = self.conn.execute("SELECT row FROM documents WHERE id = ?", (document["id"],)).fetchone()
+                if existing is not None:
+                    row = existing[0]
+                    self.conn.execute("UPDATE documents SET title = ?, content = ?, deleted = 0 WHERE row = ?",
+                                      (document["title"], document["content"], row))
+                    self.conn.execute("DELETE FROM documents_fts WHERE rowid = ?", (row,))
+                else:
+                    row = self.count
+                    self.count += 1
+                    self.conn.execute("INSERT INTO documents (row, id, title, content) VALUES (?, ?, ?, ?)",
+                                      (row, document["id"], document["title"], document["content"]))
+                self.conn.execute("INSERT INTO documents_fts (rowid, title, content) VALUES (?, ?, ?)",
+                                  (row, document["title"], document["content"]))
+                rows.append(row)
+            self.grow(self.count)
+            if self.ann and len(self.ann_indexes) == 0:
+                self.open_ann_indexes()
+            for field in VECTOR_FIELDS:
+                matrix = np.array([document[field] for document in documents], dtype=np.float32)
+                norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                matrix = matrix / np.where(norms > 0, norms, 1)
+                self.vectors[field][rows] = matrix
+                if field in self.ann_indexes:
+                    self.ann_indexes[field].add_items(matrix, np.array(rows))
+            self.deleted[rows] = False
+            self.conn.commit()
+
+    def upload_documents(self, documents):
+        self.merge_or_upload_documents(documents)
+
+    # Delete documents by id
+    def delete_documents(self, documents):
+        with self.lock:
+            self.write_pending()
+            for document in documents:
+                existing = self.conn.execute("SELECT row FROM documents WHERE id = ? AND deleted = 0", (document["id"],)).fetchone()
+                if existing is None:
+                    continue
+                row = existing[0]
+                self.conn.execute("UPDATE documents SET deleted = 1 WHERE row = ?", (row,))
+                self.conn.execute("DELETE FROM documents_fts WHERE rowid = ?", (row,))
+                self.deleted[row] = True
+                for index in self.ann_indexes.values():
+                    index.mark_deleted(row)
+            self.conn.commit()
+
+    # Write the pending documents and the vectors to disk (index_documents calls it every UPLOAD_FLUSH_DOCS documents)
+    def flush(self):
+        with self.lock:
+            self.write_pending()
+            for matrix in self.vectors.values():
+                matrix.flush()
+            self.conn.commit()
+
+    # Flush and write the HNSW indexes to disk, once at the end of the indexing: every save writes the whole index
+    def save(self):
+        with self.lock:
+            self.flush()
+            for field, index in self.ann_indexes.items():
+                index.save_index(os.path.join(self.index_dir, f'{field}.hnsw'))
+
+    def close(self):
+        self.save()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.save()
+
+    def get_document_count(self):
+        with self.lock:
+            self.write_pending()
+            return self.conn.execute("SELECT COUNT(*) FROM documents WHERE deleted = 0").fetchone()[0]
+
+    # Top k rows of a vector field by cosine similarity
+    def vector_search(self, field, vector, k):
+        if self.count == 0 or k <= 0:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        if field in self.ann_indexes:
+            # get_current_count of hnswlib also counts the rows marked as deleted, knn_query fails asking for more rows than
+            # the live ones
+            k = min(k, self.count - int(np.count_nonzero(self.deleted[:self.count])))
+            if k <= 0:
+                return []
+            try:
+                labels, _ = self.ann_indexes[field].knn_query(query, k=k)
+                return [int(row) for row in labels[0]]
+            except RuntimeError as ex:
+                # Fewer than k live rows reachable in the graph (many deleted ones): exact search
+                print(f'WARNING vector_search: {ex}, exact search of {field}')
+
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, self.count, BLOCK_ROWS):
+            end = min(start + BLOCK_ROWS, self.count)
+            scores = np.asarray(self.vectors[field][start:end]) @ query
+            scores[self.deleted[start:end]] = -np.inf
+            if len(scores) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+            else:
+                top = np.arange(len(scores))
+            best_rows = np.concatenate([best_rows, top + start])
+            best_scores = np.concatenate([best_scores, scores[top]])
+            if len(best_rows) > k:
+                keep = np.argpartition(-best_scores, k - 1)[:k]
+                best_rows, best_scores = best_rows[keep], best_scores[keep]
+        order = np.argsort(-best_scores)
+        return [int(best_rows[i]) for i in order if np.isfinite(best_scores[i])]
+
+    # Top k rows by BM25 over title and content
+    def keyword_search(self, search_text, k):
+        terms = re.findall(r'\w+', search_text or '')
+        if len(terms) == 0 or search_text == '*':
+            return []
+        match = ' OR '.join(f'"{term}"' for term in dict.fromkeys(terms))
+        rows = self.conn.execute(f"SELECT rowid FROM documents_fts WHERE documents_fts MATCH ? "
+                                 f"ORDER BY bm25(documents_fts, {BM25_WEIGHTS[0]}, {BM25_WEIGHTS[1]}) LIMIT ?",
+                                 (match, k)).fetchall()
+        return [row for (row,) in rows]
+
+    # Hybrid search with the parameters of SearchClient.search (the semantic ranker options are ignored)
+    def search(self, search_text=None, vector_queries=None, select=None, top=50, **kwargs):
+        with self.lock:
+            self.write_pending()
+            rankings = []
+            rankings.append(self.keyword_search(search_text, max(top, 50)))
+            for vector_query in vector_queries or []:
+                for field in [field.strip() for field in vector_query.fields.split(',')]:
+                    rankings.append(self.vector_search(field, vector_query.vector, vector_query.k_nearest_neighbors or top))
+
+            # Reciprocal rank fusion
+            scores = {}
+            for ranking in rankings:
+                for rank, row in enumerate(ranking):
+                    scores[row] = scores.get(row, 0.0) + 1.0 / (RRF_K + rank + 1)
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+            results = LocalSearchResults(count=len(ranked))
+            rows = [row for row, _ in ranked[:top]]
+            documents = {}
+            for i in range(0, len(rows), 500):
+                part = rows[i:i + 500]
+                for row, id, title, content in self.conn.execute(
+                        f"SELECT row, id, title, content FROM documents WHERE row IN ({','.join('?' * len(part))})", part):
+                    documents[row] = {"id": id, "title": title, "content": content}
+            for row, score in ranked[:top]:
+                document = documents[row]
+                result = {field: document[field] for field in (select or document.keys())}
+                result["@search.score"] = score
+                result["@search.reranker_score"] = None
+                results.append(result)
+            return results
+
+# Results of the local search with the get_count() of the AI Search results
+class LocalSearchResults(list):
+    def __init__(self, count):
+        super().__init__()
+        self.count = count
+
+    def get_count(self):
+        return self.count
+
+# Load a local index from documents exported as JSON lines (one document of index_documents per line)
+def load_local_index(index_dir, jsonl_path=None, ann=False, batch_size=1000):
+    client = LocalSearchClient(index_dir, ann=ann)
+    if jsonl_path is not None:
+        batch = []
+        with open(jsonl_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                batch.append(json.loads(line))
+                if len(batch) == batch_size:
+                    client.merge_or_upload_documents(batch)
+                    batch = []
+        client.merge_or_upload_documents(batch)
+        client.save()
+    print(f'Local index {index_dir}: {client.get_document_count()} documents')
+    return client
@@ -0,0 +1,313 @@
+from flask import Flask, request, jsonify
+import argparse
+import hmac
+import math
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from common_utils import (get_shared_config, start_warm_up, set_embedding_batcher, generate_search_query, hybrid_search,
+                          get_filtered_chunks, generate_answer_with_history, RERANK_MODE)
+from embedding_batcher import EmbeddingBatcher
+from resilience import get_resilience_metrics, get_circuit_states
+from tracing import span
+
+# CONSTANTS
+API_HOST = os.getenv('RAG_API_HOST', '0.0.0.0')
+API_PORT = int(os.getenv('RAG_API_PORT', 8000))
+API_WORKERS = int(os.getenv('RAG_API_WORKERS', 1)) # Processes answering requests, every one with its clients, batcher and limits
+TENANT_MAX_CONCURRENT = int(os.getenv('RAG_API_TENANT_MAX_CONCURRENT', 8)) # Requests of a tenant answered at the same time (all the workers, approximate, see configure_workers)
+TENANT_WAIT_SECONDS = float(os.getenv('RAG_API_TENANT_WAIT_SECONDS', 1.0)) # Seconds a request waits for a free slot of its tenant before a 429
+TENANT_IDLE_SECONDS = float(os.getenv('RAG_API_TENANT_IDLE_SECONDS', 600)) # Seconds without requests before the state of a tenant is removed
+TENANT_MAX_TRACKED = int(os.getenv('RAG_API_TENANT_MAX_TRACKED', 10000)) # Tenants with state in a worker, the idle ones are removed over it
+EMBEDDING_BATCHING = os.getenv('RAG_API_EMBEDDING_BATCHING', '1') != '0' # Embeddings of concurrent requests in one call (EmbeddingBatcher)
+# Tenants authenticated with API keys: "key1:tenant1,key2:tenant2". Without keys the tenant is the TENANT_HEADER sent by the
+# client, which is only a limit when a trusted gateway in front of the API authenticates the clients and sets the header
+API_KEYS = os.getenv('RAG_API_KEYS', '')
+TENANT_HEADER = 'X-Tenant-Id'
+DEFAULT_TENANT = 'default'
+MAX_DOCS = 10
+MAX_DOCS_LIMIT = 50
+MAX_HISTORY_TURNS = 5 # Last turns of the history sent by the client that are used in the prompts
+INDEX_NAMES = ("docs", "regs")
+RERANK_MODES = ("pointwise", "listwise", "cascade")
+
+app = Flask(__name__)
+
+# {API key: tenant} of RAG_API_KEYS
+def parse_api_keys(api_keys):
+    tenants = {}
+    for item in api_keys.split(','):
+        if item.strip() == '':
+            continue
+        key, separator, tenant = item.strip().partition(':')
+        if separator == '' or key == '' or tenant == '':
+            raise ValueError(f'Invalid RAG_API_KEYS item, expected key:tenant: {item.strip()}')
+        tenants[key] = tenant
+    return tenants
+
+_api_keys = parse_api_keys(API_KEYS)
+
+# Tenant of a request: the tenant of its API key (Authorization: Bearer <key>) when RAG_API_KEYS is configured, ignoring
+# the TENANT_HEADER so a client cannot take the limit of another tenant, or None when the key is missing or invalid.
+# Without API keys, the TENANT_HEADER is trusted (set by a gateway) or the DEFAULT_TENANT
+def get_tenant(headers, api_keys):
+    if len(api_keys) == 0:
+        return headers.get(TENANT_HEADER) or DEFAULT_TENANT
+    scheme, _, key = (headers.get('Authorization') or '').partition(' ')
+    if scheme.lower() != 'bearer' or key == '':
+        return None
+    tenant = None
+    # Every key is compared in constant time
+    for valid_key, valid_tenant in api_keys.items():
+        if hmac.compare_digest(key.encode('utf-8'), valid_key.encode('utf-8')):
+            tenant = valid_tenant
+    return tenant
+
+# Concurrency limit of every tenant: a request waits up to wait_seconds for one of the max_concurrent slots of its tenant,
+# so a tenant with many concurrent users cannot take all the Azure OpenAI quota and connections of the process
+# The tenant id comes from a header, so the state of the tenants without active requests is removed after idle_seconds
+# (or before when there are more than max_tracked tenants) and the memory does not grow with every id received
+class TenantLimiter:
+    def __init__(self, max_concurrent=TENANT_MAX_CONCURRENT, wait_seconds=TENANT_WAIT_SECONDS, idle_seconds=TENANT_IDLE_SECONDS,
+                 max_tracked=TENANT_MAX_TRACKED):
+        self.max_concurrent = max_concurrent
+        self.wait_seconds = wait_seconds
+        self.idle_seconds = idle_seconds
+        self.max_tracked = max_tracked
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.counters = {}
+        self.last_used = {}
+        self.evicted = 0
+        self.next_eviction = time.monotonic() + idle_seconds
+
+    def acquire(self, tenant):
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.next_eviction or (tenant not in self.semaphores and len(self.semaphores) >= self.max_tracked):
+                self.evict_idle(now)
+            if tenant not in self.semaphores:
+                self.semaphores[tenant] = threading.BoundedSemaphore(self.max_concurrent)
+                self.counters[tenant] = {"active": 0, "waiting": 0, "accepted": 0, "rejected": 0}
+            semaphore = self.semaphores[tenant]
+            # A waiting request keeps the state of its tenant until it gets a slot or a 429
+            self.counters[tenant]["waiting"] += 1
+            self.last_used[tenant] = now
+        acquired = semaphore.acquire(timeout=self.wait_seconds)
+        with self.lock:
+            counters = self.counters[tenant]
+            counters["waiting"] -= 1
+            if acquired:
+                counters["active"] += 1
+                counters["accepted"] += 1
+            else:
+                counters["rejected"] += 1
+        return acquired
+
+    def release(self, tenant):
+        with self.lock:
+            self.counters[tenant]["active"] -= 1
+            self.last_used[tenant] = time.monotonic()
+            semaphore = self.semaphores[tenant]
+        semaphore.release()
+
+    # Remove the tenants without active or waiting requests: the ones idle for idle_seconds, and the least recently used
+    # ones while there are more than max_tracked tenants
+    def evict_idle(self, now):
+        idle = [tenant for tenant, counters in self.counters.items() if counters["active"] == 0 and counters["waiting"] == 0]
+        idle.sort(key=lambda tenant: self.last_used[tenant])
+        excess = len(self.semaphores) - self.max_tracked + 1
+        for i, tenant in enumerate(idle):
+            if now - self.last_used[tenant] < self.idle_seconds and i >= excess:
+                break
+            del self.semaphores[tenant], self.counters[tenant], self.last_used[tenant]
+            self.evicted += 1
+        self.next_eviction = now + self.idle_seconds
+
+    def stats(self):
+        with self.lock:
+            return {tenant: dict(counters) for tenant, counters in self.counters.items()}
+
+_limiter = TenantLimiter()
+_batcher = None
+_api_lock = threading.Lock()
+_api_started = False
+
+# Clients shared by all the requests of the worker and the micro-batcher of their embeddings, created when the worker starts
+# (after the fork of the workers, the connections of a client cannot be shared by several processes) or by the first request
+def get_api_config():
+    global _batcher, _api_started
+    openai_config, ai_search_config = get_shared_config()
+    with _api_lock:
+        if not _api_started:
+            _api_started = True
+            if EMBEDDING_BATCHING:
+                _batcher = EmbeddingBatcher()
+                set_embedding_batcher(_batcher)
+            start_warm_up(openai_config, ai_search_config)
+    return openai_config, ai_search_config
+
+# AI Search client of the index of the request, or the clients of all the indexes for a federated search
+def get_search_client(ai_search_config, index):
+    if index == 'all':
+        return {name: ai_search_config[f'ai_search_client_{name}'] for name in INDEX_NAMES}
+    return ai_search_config[f'ai_search_client_{index}']
+
+# Rewrite, search and rerank of a question, and the answer when generate is True, with the seconds of every stage
+def answer_question(openai_config, ai_search_client, question, history, max_docs, rerank_mode, generate=True):
+    openai_client = openai_config["openai_client"]
+    timings = {}
+    start = time.perf_counter()
+    with span("api_answer", generate=generate, rerank_mode=rerank_mode) as answer_span:
+        query = generate_search_query(openai_client, openai_config["aoai_deployment_name"], question, history) or question
+        timings["rewrite"] = round(time.perf_counter() - start, 3)
+        step_start = time.perf_counter()
+        results, num_results = hybrid_search(ai_search_client, openai_client, openai_config["aoai_embedding_model"], query, max_docs)
+        timings["search"] = round(time.perf_counter() - step_start, 3)
+        step_start = time.perf_counter()
+        valid_chunks, num_chunks = get_filtered_chunks(openai_client, openai_config["aoai_rerank_model"], results, question, mode=rerank_mode)
+        timings["rerank"] = round(time.perf_counter() - step_start, 3)
+        result = {"query": query, "num_results": num_results, "num_chunks": num_chunks}
+        if generate:
+            step_start = time.perf_counter()
+            result["answer"] = generate_answer_with_history(openai_client, openai_config["aoai_deployment_name"], valid_chunks, question, history)
+            if result["answer"] is None:
+                raise RuntimeError('The answer could not be generated')
+            timings["generate"] = round(time.perf_counter() - step_start, 3)
+        else:
+            result["context"] = valid_chunks
+        answer_span.set(num_chunks=num_chunks)
+    timings["total"] = round(time.perf_counter() - start, 3)
+    result["timings"] = timings
+    result["trace_id"] = answer_span.trace_id
+    return result
+
+# Parameters of the body of a request, raises ValueError when they are not valid
+def parse_request(data):
+    if not isinstance(data, dict):
+        raise ValueError('The body must be a JSON object')
+    question = data.get('question')
+    if not isinstance(question, str) or question.strip() == '':
+        raise ValueError('question is required')
+    history = data.get('history') or []
+    if not isinstance(history, list) or not all(isinstance(turn, dict) and 'question' in turn and 'answer' in turn for turn in history):
+        raise ValueError('history must be a list of {"question", "answer"}')
+    index = data.get('index', 'docs')
+    if index not in INDEX_NAMES + ('all',):
+        raise ValueError(f'Invalid index: {index}')
+    rerank_mode = data.get('rerank_mode', RERANK_MODE)
+    if rerank_mode not in RERANK_MODES:
+        raise ValueError(f'Invalid rerank_mode: {rerank_mode}')
+    max_docs = data.get('max_docs')
+    if max_docs is None:
+        max_docs = MAX_DOCS
+    if isinstance(max_docs, str) and max_docs.strip().isdigit():
+        max_docs = int(max_docs)
+    if not isinstance(max_docs, int) or isinstance(max_docs, bool) or max_docs < 1 or max_docs > MAX_DOCS_LIMIT:
+        raise ValueError(f'max_docs must be an integer between 1 and {MAX_DOCS_LIMIT}')
+    return question.strip(), history[-MAX_HISTORY_TURNS:], index, rerank_mode, max_docs
+
+# Request of a tenant within its concurrency limit: 401 without a valid API key (when RAG_API_KEYS is configured), 400
+# with invalid parameters, 429 (with Retry-After) when the tenant has all its slots busy and 500 when a service fails
+def handle_request(generate):
+    tenant = get_tenant(request.headers, _api_keys)
+    if tenant is None:
+        response = jsonify({'error': 'A valid API key is required (Authorization: Bearer <key>)'})
+        response.headers['WWW-Authenticate'] = 'Bearer'
+        return response, 401
+    try:
+        question, history, index, rerank_mode, max_docs = parse_request(request.get_json(silent=True))
+    except ValueError as ex:
+        return jsonify({'error': str(ex)}), 400
+    if not _limiter.acquire(tenant):
+        response = jsonify({'error': f'Too many concurrent requests of the tenant {tenant}'})
+        response.headers['Retry-After'] = str(max(1, math.ceil(_limiter.wait_seconds)))
+        return response, 429
+    try:
+        openai_config, ai_search_config = get_api_config()
+        result = answer_question(openai_config, get_search_client(ai_search_config, index), question, history, max_docs, rerank_mode, generate)
+    except Exception as ex:
+        print(f'ERROR handle_request: {ex}')
+        return jsonify({'error': str(ex)}), 500
+    finally:
+        _limiter.release(tenant)
+    result["tenant"] = tenant
+    return jsonify(result)
+
+# Body: {"question": "...", "history": [{"question", "answer"}], "index": "docs|regs|all", "rerank_mode": "...", "max_docs": 10}
+# Returns the rewritten query, the answer, the number of results and valid chunks and the seconds of every stage
+@app.route('/v1/answer', methods=['POST'])
+def answer():
+    return handle_request(generate=True)
+
+# Same body as /v1/answer, returns the context with the valid chunks instead of the answer
+@app.route('/v1/retrieve', methods=['POST'])
+def retrieve():
+    return handle_request(generate=False)
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'ok'})
+
+# Counters of the worker that answers the request: requests of every tenant, batches of embeddings, retries and hedges
+# of the Azure OpenAI calls and state of the circuit of every deployment
+@app.route('/v1/stats', methods=['GET'])
+def stats():
+    return jsonify({'pid': os.getpid(), 'tenants': _limiter.stats(), 'tenants_evicted': _limiter.evicted,
+                    'embedding_batcher': _batcher.stats() if _batcher is not None else None, 'aoai_calls': get_resilience_metrics().stats(), 'circuits': get_circuit_states()})
+
+# Split the concurrency limit of the tenants between the workers (every worker has its own limiter, nothing is shared)
+# It is an approximation: the kernel does not spread the accept() of the connections evenly between the workers, so a
+# tenant can receive 429s from a busy worker with ceil(limit / workers) requests of the tenant while other workers are
+# idle, and the limit of the tenant in all the workers can be up to workers - 1 requests over TENANT_MAX_CONCURRENT.
+# An exact limit needs the counters shared between the workers (or a gateway in front of the API enforcing it)
+def configure_workers(workers):
+    global _limiter
+    _limiter = TenantLimiter(max(1, math.ceil(TENANT_MAX_CONCURRENT / workers)), TENANT_WAIT_SECONDS)
+
+def serve_worker(host, port, fd, workers):
+    from werkzeug.serving import make_server
+    configure_workers(workers)
+    # The worker accepts connections when the tokenizer is loaded and the connections are open
+    start_warm_up(*get_api_config()).join()
+    make_server(host, port, app, threaded=True, fd=fd).serve_forever()
+
+# One process with a thread per request, or several worker processes accepting the connections of the same socket
+# (pre-fork, Linux and macOS). In production it can also run with gunicorn: gunicorn -w 4 --threads 32 -b 0.0.0.0:8000 rag_api:app
+def serve(host=API_HOST, port=API_PORT, workers=API_WORKERS):
+    if workers <= 1:
+        configure_workers(1)
+        # The worker accepts connections when the tokenizer is loaded and the connections are open
+        start_warm_up(*get_api_config()).join()
+        app.run(host=host, port=port, threaded=True)
+        return
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=serve_worker, args=(host, port, sock.fileno(), workers), name=f'rag-api-{i}') for i in range(workers)]
+    for process in processes:
+        process.start()
+    print(f'RAG API listening on {host}:{port} with {workers} workers')
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+    finally:
+        sock.close()
+
+# python rag_api.py [--host 0.0.0.0] [--port 8000] [--workers 4]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HTTP API of the RAG pipeline: rewrite, retrieve, rerank and generate')
+    parser.add_argument('--host', default=API_HOST)
+    parser.add_argument('--port', type=int, default=API_PORT)
+    parser.add_argument('--workers', type=int, default=API_WORKERS)
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
@@ -1,14 +1,18 @@
 # Import libraries
 import os
 import sys
+import time
 from dotenv import load_dotenv, find_dotenv
-from openai import AzureOpenAI
 import streamlit as st
 import logging
 from logging.handlers import RotatingFileHandler
 
 sys.path.append('..')
 from common_utils import *
+from async_utils import add_to_answer_cache, get_shared_async_config, retrieve_async, run_async, start_warm_up_async
+from answer_cache import get_answer_cache, get_index_version
+from conversation_memory import ConversationMemory
+from tracing import configure_tracing, get_tracer, span
 
 # Define constants and icons
 USER_ICON = 'https://static.vecteezy.com/system/resources/previews/014/194/215/non_2x/avatar-icon-human-a-person-s-badge-social-media-profile-symbol-the-symbol-of-a-person-vector.jpg'
@@ -16,7 +20,7 @@ BOT_ICON = 'https://th.bing.com/th/id/R.b978cf9a22395802eb1a6b17f3493584?rik=bfp
 BOT_ICON = 'https://media.tenor.com/arlZrN0YovkAAAAC/robot-smile.gif'
 MSFT_LOGO='microsoft.png'
 APP_TITLE="RAG Chat Demo"
-MAX_QUESTION_ANSWER_HISTORY = 3
+INCOMPLETE_ANSWER_MARKER = '[ERROR: incomplete answer]' # Shown after the text of an answer whose stream did not finish
 
 # Función para mostrar mensajes en forma de bocadillo
 def get_message_markdown(message, message_role="user"):
@@ -43,31 +47,56 @@ def store_message(message, is_user=True):
     message_role = "user" if is_user else "assistant"
     st.session_state.messages.append({"role": message_role, "content": message})
 
+# Mostrar todos los mensajes almacenados en la sesión
+def show_messages(messages):
+    for message in messages:
+        message_role = message["role"]
+        message_content = message["content"]
+
+        if message_role in ("user", "assistant", "function") and message_content:
+            message_markdown = get_message_markdown(message_content, message_role)
+            st.markdown(message_markdown, unsafe_allow_html=True)
+
+# Logger of the process: the handlers are added by the first session only, not again for every new session
+def get_logger():
+    logger = logging.getLogger()
+    if not any(handler.get_name() == 'rag_chat' for handler in logger.handlers):
+        # Basic logging configuration
+        log_file = "rag_chat.log"
+        log_handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=2)  # 5 MB per file, 2 backups
+        log_handler.set_name('rag_chat')
+        log_handler.setLevel(logging.INFO)
+        log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        log_handler.setFormatter(log_formatter)
+        logger.setLevel(logging.INFO)
+        logger.addHandler(log_handler)
+        # Handler for printing to the console
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(log_formatter)
+        logger.addHandler(console_handler)
+        logger.info("RAG Chat application started.")
+    return logger
+
 # MAIN
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
-    # Load Azure OpenAI and AI Search variables and create clients
-    openai_config, ai_search_config = load_config()
+    # Azure OpenAI and AI Search clients shared by all the sessions of the process (created by the first one), so a new
+    # session reuses the open connections
+    openai_config, ai_search_config = get_shared_config()
     st.session_state.openai_config = openai_config
     st.session_state.ai_search_config = ai_search_config
-    st.session_state.history = []
-
-    # Basic logging configuration
-    log_file = "rag_chat.log"
-    log_handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=2)  # 5 MB per file, 2 backups
-    log_handler.setLevel(logging.INFO)
-    log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    log_handler.setFormatter(log_formatter)
-    st.session_state.logger = logging.getLogger()
-    st.session_state.logger.setLevel(logging.INFO)
-    st.session_state.logger.addHandler(log_handler)
-    st.session_state.logger.info("RAG Chat application started.")
-    st.session_state.logger.info(f"OpenAI config: {openai_config}")
-    # Handler for printing to the console
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(log_formatter)
-    st.session_state.logger.addHandler(console_handler)
+    # Async clients: the rewrite and a speculative search of the question run at the same time
+    st.session_state.async_openai_config, st.session_state.async_ai_search_config = get_shared_async_config()
+    # The first session loads the tokenizer and opens the connections in the background while the user writes the question
+    start_warm_up(openai_config, ai_search_config)
+    start_warm_up_async(st.session_state.async_openai_config, st.session_state.async_ai_search_config)
+    # Last turns of the conversation and a summary of the older ones (made with the rerank model) within a token budget
+    st.session_state.history = ConversationMemory(openai_config["openai_client"], openai_config["aoai_rerank_model"])
+    # Per-stage latency and tokens with RAG_TRACING=1 (spans exported to RAG_TRACING_EXPORT_PATH as JSON lines)
+    configure_tracing()
+    st.session_state.logger = get_logger()
+    st.session_state.logger.info(f"New session, OpenAI deployment: {openai_config['aoai_deployment_name']}")
 
 # Prepare the web app
 st.set_page_config(
@@ -80,58 +109,95 @@ st.title(APP_TITLE)
 user_input = st.chat_input("Your question:", key="input")
 if user_input:
     store_message(user_input)
+    show_messages(st.session_state.messages)
 
-    with st.spinner("Generando respuesta..."):
-        question = user_input
-        print(f"User question: {question}")
-        st.session_state.logger.info(f"User question: {question}")
-        query = generate_search_query(st.session_state.openai_config["openai_client"],
-                               st.session_state.openai_config["aoai_deployment_name"],
-                               question,
-                               st.session_state.history)
-        print(f'Rewritten Question: {query}')
-        st.session_state.logger.info(f'Rewritten Question: {query}')
-
-        # Hybrid search
-        results, num_results = semantic_hybrid_search(st.session_state.ai_search_config["ai_search_client_docs"],
-                                                      st.session_state.openai_config["openai_client"],
-                                                      st.session_state.openai_config["aoai_embedding_model"],
-                                                      query, 10)
-        print(f"query: {query}, num results: {num_results}")
-        st.session_state.logger.info(f"query: {query}, num results: {num_results}")
-        #show_results(results, query)
-
-        # Valid chunks for the user question
-        valid_chunks, num_chunks = get_filtered_chunks(st.session_state.openai_config["openai_client"],
-                                                       st.session_state.openai_config["aoai_rerank_model"],
-                                                       results, question)
-
-        # Generate answer:
-        #answer = generate_answer(st.session_state.openai_config["openai_client"],
-        #                         st.session_state.openai_config["aoai_deployment_name"],
-        #                         valid_chunks,
-        #                         question)
-        answer = generate_answer_with_history(st.session_state.openai_config["openai_client"],
-                                              st.session_state.openai_config["aoai_deployment_name"],
-                                              valid_chunks,
+    # Span of the turn, parent of the spans of every stage when RAG_TRACING=1
+    with span("chat_turn", history=len(st.session_state.history)) as turn_span:
+        with st.spinner("Generando respuesta..."):
+            question = user_input
+            print(f"User question: {question}")
+            st.session_state.logger.info(f"User question: {question}")
+            # Answer cache shared by all the sessions (only for questions without history), invalidated when an index changes
+            answer_cache = get_answer_cache()
+            answer_cache.check_index_version(lambda: '-'.join(get_index_version(st.session_state.ai_search_config[f"ai_search_client_{name}"],
+                                                                                st.session_state.ai_search_config[f"ai_search_index_name_{name}"])
+                                                              for name in ("docs", "regs")))
+            # Rewrite the question, search in the docs and regs indexes at the same time and filter the chunks
+            result = run_async(retrieve_async(st.session_state.async_openai_config,
+                                              {"docs": st.session_state.async_ai_search_config["ai_search_client_docs"],
+                                               "regs": st.session_state.async_ai_search_config["ai_search_client_regs"]},
                                               question,
-                                              st.session_state.history)
-        st.session_state.logger.info(f"Answer: {answer}")
-        store_message(answer, is_user=False)
+                                              st.session_state.history,
+                                              max_docs=10,
+                                              answer_cache=answer_cache))
+            query, num_results = result["query"], result["num_results"]
+            print(f'Rewritten Question: {query}')
+            st.session_state.logger.info(f'Rewritten Question: {query}')
+            print(f"query: {query}, num results: {num_results}, num chunks: {result['num_chunks']}")
+            st.session_state.logger.info(f"query: {query}, num results: {num_results}, num chunks: {result['num_chunks']}")
+            st.session_state.logger.info(f"Timings: {result['timings']}, speculative search used: {result['speculative_hit']}, "
+                                         f"answer cache hit: {result['cache_hit']}")
 
-        # check if the number of question and answer pair has reached the limit of N and remove the oldest one
-        if len(st.session_state.history) >= MAX_QUESTION_ANSWER_HISTORY:
-            st.session_state.history.pop(0)
-        st.session_state.history.append({"question": question, "answer": answer})
-        print(f"\nhistory: {json.dumps(st.session_state.history, indent=2)}\n")
-        st.session_state.logger.info(f"\nhistory: {json.dumps(st.session_state.history, indent=2)}\n")
-        print("--------------------------------------------------")
+        answer_placeholder = st.empty()
+        if result["cache_hit"]:
+            # Answer of a similar query in the answer cache
+            answer = result["answer"]
+            answer_complete = True
+            answer_placeholder.markdown(get_message_markdown(answer, "assistant"), unsafe_allow_html=True)
+            st.session_state.logger.info(f"Answer (cached): {answer}")
+        else:
+            # Generate the answer showing the tokens in the chat bubble as they arrive
+            answer = ''
+            time_to_first_token = None
+            generate_start = time.perf_counter()
+            stream = generate_answer_with_history_stream(st.session_state.openai_config["openai_client"],
+                                                         st.session_state.openai_config["aoai_deployment_name"],
+                                                         result["valid_chunks"],
+                                                         question,
+                                                         st.session_state.history)
+            # The return value of the stream is its finish_reason, "stop" when the answer is complete
+            finish_reason = None
+            try:
+                while True:
+                    delta = next(stream)
+                    if time_to_first_token is None:
+                        time_to_first_token = time.perf_counter() - generate_start
+                    answer += delta
+                    answer_placeholder.markdown(get_message_markdown(answer, "assistant"), unsafe_allow_html=True)
+            except StopIteration as stop:
+                finish_reason = stop.value
+            except Exception as ex:
+                st.session_state.logger.error(f"Answer stream failed after {len(answer)} characters: {ex}")
+            generate_time = time.perf_counter() - generate_start
+            answer_complete = finish_reason == "stop" and answer != ''
+            if answer == '':
+                answer = 'ERROR'
+                answer_placeholder.markdown(get_message_markdown(answer, "assistant"), unsafe_allow_html=True)
+            elif not answer_complete:
+                # A cut answer (failed stream, max_tokens or content filter) is shown with the marker
+                st.session_state.logger.error(f"Incomplete answer, finish_reason: {finish_reason}")
+                answer_placeholder.markdown(get_message_markdown(f'{answer} {INCOMPLETE_ANSWER_MARKER}', "assistant"), unsafe_allow_html=True)
+            total_time = sum(result['timings'].values()) + generate_time
+            st.session_state.logger.info(f"Answer: {answer}")
+            st.session_state.logger.info(f"Generation time to first token: {time_to_first_token if time_to_first_token is not None else -1:.3f}s, "
+                                         f"total generation: {generate_time:.3f}s, total: {total_time:.3f}s")
+            # Only a complete answer is cached: the cache is shared by all the sessions of the process
+            if answer_complete:
+                result["answer"] = answer
+                add_to_answer_cache(answer_cache, result, total_time)
+        st.session_state.logger.info(f"Answer cache: {answer_cache.stats()}")
+    tracer = get_tracer()
+    if tracer is not None:
+        st.session_state.logger.info(f"Trace {turn_span.trace_id}: {json.dumps(tracer.summary(turn_span.trace_id))}")
+    store_message(answer if answer_complete or answer == 'ERROR' else f'{answer} {INCOMPLETE_ANSWER_MARKER}', is_user=False)
 
-        # Mostrar todos los mensajes almacenados en la sesión
-        for message in st.session_state.messages:
-            message_role = message["role"]
-            message_content = message["content"]
-
-            if message_role in ("user", "assistant", "function") and message_content:
-                message_markdown = get_message_markdown(message_content, message_role)
-                st.markdown(message_markdown, unsafe_allow_html=True)
\ No newline at end of file
+    # Add the turn to the history, the older turns are summarized when it is over its token budget (after the answer is shown)
+    # A failed or incomplete answer is not added: the next rewrites and the summary would build on it
+    if answer_complete:
+        st.session_state.history.add_turn(question, answer)
+    else:
+        st.session_state.logger.info("Turn not added to the history: the answer is not complete")
+    print(f"\nhistory: {json.dumps(st.session_state.history.to_list(), indent=2)}\n")
+    st.session_state.logger.info(f"\nhistory summary: {st.session_state.history.summary}\nhistory: {json.dumps(st.session_state.history.to_list(), indent=2)}\n")
+    st.session_state.logger.info(f"History: {st.session_state.history.stats()}")
+    print("--------------------------------------------------")
@@ -0,0 +1,439 @@
+import asyncio
+import concurrent.futures
+import random
+import threading
+import time
+from collections import deque
+
+from tracing import current_span, submit_in_context, record_usage, percentile
+
+# CONSTANTS
+AOAI_DEADLINE_SECONDS = 60 # Maximum seconds of a call with all its attempts, hedges and waits
+AOAI_ATTEMPT_TIMEOUT_SECONDS = 30 # Maximum seconds of one attempt (the SDK default is 600)
+AOAI_MAX_ATTEMPTS = 4
+RETRY_BASE_SECONDS = 0.5 # Maximum backoff of the first retry, doubled in every retry (full jitter)
+RETRY_MAX_SECONDS = 8.0
+RETRY_AFTER_JITTER_SECONDS = 0.1 # Maximum random seconds added to the first Retry-After, doubled in every retry
+HEDGE_PERCENTILE = 95 # A duplicate request is sent when an attempt takes longer than this percentile of the recent calls
+HEDGE_MIN_SAMPLES = 20 # Calls of a deployment and operation measured before hedging them
+HEDGE_MIN_DELAY_SECONDS = 0.05
+HEDGE_BUDGET = 0.1 # Maximum share of the calls with a duplicate request (extra requests and tokens)
+HEDGE_THROTTLE_PAUSE_SECONDS = 10 # Seconds without hedging a deployment after a throttled call (more requests make it worse)
+HEDGE_MAX_WORKERS = 128 # Attempts running at the same time in the threads of the sync calls with hedging
+LATENCY_WINDOW = 200 # Recent latencies of every deployment and operation used for the hedging delay
+BREAKER_FAILURES = 5 # Consecutive failures of a deployment that open its circuit (the throttling is not a failure)
+BREAKER_OPEN_SECONDS = 30 # Seconds without calls to a deployment with its circuit open, then one trial call
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+
+# Resilient calls to the chat completions of Azure OpenAI, used instead of the retries of the SDK (disabled in these calls):
+# - every call has a deadline and every attempt a timeout, so a slow completion does not hold the re-ranker or the answer
+# - the throttling (429), timeouts, connection errors and 5xx are retried with exponential backoff and jitter, waiting
+#   the Retry-After of the service, or immediately in a fallback deployment when there is one
+# - when an attempt takes longer than the HEDGE_PERCENTILE of the recent calls of its deployment and operation, a duplicate
+#   request is sent and the first answer is used (within HEDGE_BUDGET of the calls)
+# - a deployment with BREAKER_FAILURES consecutive failures (timeouts, connection errors and 5xx) is not called for
+#   BREAKER_OPEN_SECONDS (circuit open) and its calls go to its fallback deployments (set_fallback_deployments), or fail
+#   at once when it has none
+# The retries and hedges are added to the active span and to the counters of get_resilience_metrics
+class DeadlineExceededError(TimeoutError):
+    pass
+
+class CircuitOpenError(Exception):
+    pass
+
+# Counters of the resilient calls of the process
+class ResilienceMetrics:
+    NAMES = ("calls", "attempts", "retries", "retry_after_waits", "timeouts", "hedges", "hedge_wins", "fallbacks",
+             "circuit_opened", "circuit_rejected", "failures")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {name: 0 for name in self.NAMES}
+
+    def add(self, **counters):
+        with self.lock:
+            for name, value in counters.items():
+                self.counters[name] += value
+
+    # Reserve a hedge within HEDGE_BUDGET of the calls
+    def take_hedge(self, budget=HEDGE_BUDGET):
+        with self.lock:
+            if self.counters["hedges"] + 1 > budget * self.counters["calls"]:
+                return False
+            self.counters["hedges"] += 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+# Consecutive failures of a deployment: closed (calls allowed), open (no calls until open_seconds have passed) and
+# half open (one trial call, that closes the circuit if it succeeds or opens it again)
+class CircuitBreaker:
+    def __init__(self, failures=BREAKER_FAILURES, open_seconds=BREAKER_OPEN_SECONDS):
+        self.max_failures = failures
+        self.open_seconds = open_seconds
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+
+    # Closed, or open (or half open without an answer to its trial call) for open_seconds
+    def available(self):
+        with self.lock:
+            return self.state == "closed" or time.monotonic() - self.opened_at >= self.open_seconds
+
+    # Allow a call, the first one after open_seconds is the trial call of the half open state
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = "half_open"
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+
+    # Returns True when the failure opens the circuit
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.max_failures):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+# Recent latencies of the successful attempts of a deployment and operation
+class LatencyTracker:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.throttled_at = None
+
+    def add(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def add_throttled(self):
+        with self.lock:
+            self.throttled_at = time.monotonic()
+
+    # Seconds to wait before sending a duplicate request, None until there are enough samples or after a throttled call
+    def hedge_delay(self, p=HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES):
+        with self.lock:
+            if len(self.latencies) < min_samples:
+                return None
+            if self.throttled_at is not None and time.monotonic() - self.throttled_at < HEDGE_THROTTLE_PAUSE_SECONDS:
+                return None
+            latencies = list(self.latencies)
+        return max(HEDGE_MIN_DELAY_SECONDS, percentile(latencies, p))
+
+_metrics = ResilienceMetrics()
+_lock = threading.Lock()
+_breakers = {}
+_trackers = {}
+_fallback_deployments = {}
+_no_retry_clients = {}
+_hedge_executor = None
+
+def get_resilience_metrics():
+    return _metrics
+
+# Fallback deployments of every deployment ({deployment: [fallback deployments]}), used in order when its circuit is open
+# or it is throttled, for example the same model deployed in another region or with another quota
+def set_fallback_deployments(fallback_deployments):
+    global _fallback_deployments
+    _fallback_deployments = {deployment: list(fallbacks) for deployment, fallbacks in (fallback_deployments or {}).items()}
+
+def get_breaker(deployment):
+    with _lock:
+        if deployment not in _breakers:
+            _breakers[deployment] = CircuitBreaker()
+        return _breakers[deployment]
+
+def get_latency_tracker(deployment, operation):
+    with _lock:
+        if (deployment, operation) not in _trackers:
+            _trackers[(deployment, operation)] = LatencyTracker()
+        return _trackers[(deployment, operation)]
+
+# State of the circuit of every deployment called
+def get_circuit_states():
+    with _lock:
+        breakers = dict(_breakers)
+    return {deployment: breaker.state for deployment, breaker in breakers.items()}
+
+# Copy of a client without the retries of the SDK (it shares the connection pool), the retries are made here
+def get_no_retry_client(aoai_client):
+    with _lock:
+        if id(aoai_client) not in _no_retry_clients:
+            _no_retry_clients[id(aoai_client)] = (aoai_client, aoai_client.with_options(max_retries=0))
+        return _no_retry_clients[id(aoai_client)][1]
+
+def get_hedge_executor():
+    global _hedge_executor
+    with _lock:
+        if _hedge_executor is None:
+            _hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix='aoai-hedge')
+    return _hedge_executor
+
+# First deployment of the model and its fallbacks with the circuit closed (or ready for a trial call), avoiding the one
+# that has just been throttled when there is another one
+def select_deployment(model, avoid=None):
+    candidates = [model] + _fallback_deployments.get(model, [])
+    for deployment in [deployment for deployment in candidates if deployment != avoid] + [avoid]:
+        if deployment in candidates and get_breaker(deployment).allow():
+            if deployment != model:
+                _metrics.add(fallbacks=1)
+            return deployment
+    _metrics.add(circuit_rejected=1)
+    raise CircuitOpenError(f'The circuit of {", ".join(candidates)} is open')
+
+def is_retryable(ex):
+    import openai
+
+    if isinstance(ex, (openai.APIConnectionError, TimeoutError, asyncio.TimeoutError, concurrent.futures.TimeoutError)):
+        return True
+    status_code = getattr(ex, 'status_code', None)
+    return status_code is not None and (status_code in RETRYABLE_STATUS_CODES or status_code >= 500)
+
+# Seconds of the Retry-After (or retry-after-ms) header of a throttled response, None without it
+def get_retry_after(ex):
+    response = getattr(ex, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if headers is None:
+        return None
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after') is not None:
+            return float(headers['retry-after'])
+    except ValueError:
+        # Retry-After as an HTTP date
+        pass
+    return None
+
+# After a failed attempt: (seconds to wait, deployment to avoid) for the next attempt, or raise when the error is not
+# retryable, there are no attempts left or the wait would pass the deadline
+def handle_failure(ex, model, deployment, operation, attempt, remaining):
+    if not is_retryable(ex):
+        # An error of the request (400, content filter...) is an answer of the deployment, that is available
+        if getattr(ex, 'status_code', None) is not None:
+            get_breaker(deployment).record_success()
+        _metrics.add(failures=1)
+        raise ex
+    if isinstance(ex, (TimeoutError, asyncio.TimeoutError)) or type(ex).__name__ == 'APITimeoutError':
+        _metrics.add(timeouts=1)
+    # The throttling is the deployment at its quota, not failing: it is retried after its Retry-After or in a fallback
+    # deployment, without opening the circuit (with no fallback, an open circuit would turn the throttling into errors)
+    if getattr(ex, 'status_code', None) == 429:
+        get_breaker(deployment).record_success()
+        get_latency_tracker(deployment, operation).add_throttled()
+    elif get_breaker(deployment).record_failure():
+        _metrics.add(circuit_opened=1)
+        print(f'ERROR resilience: circuit of the deployment {deployment} open for {BREAKER_OPEN_SECONDS} seconds after {BREAKER_FAILURES} failures')
+    if attempt >= AOAI_MAX_ATTEMPTS:
+        _metrics.add(failures=1)
+        raise ex
+    retry_after = get_retry_after(ex)
+    has_fallback = any(get_breaker(fallback).available() for fallback in [model] + _fallback_deployments.get(model, []) if fallback != deployment)
+    if has_fallback:
+        # Another deployment answers the retry at once
+        wait = 0.0
+    elif retry_after is not None:
+        # At least the Retry-After, with jitter so the calls throttled at the same time do not retry at the same time
+        _metrics.add(retry_after_waits=1)
+        wait = retry_after + random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_AFTER_JITTER_SECONDS * 2 ** (attempt - 1)))
+    else:
+        wait = random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempt - 1)))
+    if wait >= remaining:
+        _metrics.add(failures=1)
+        raise DeadlineExceededError(f'No time left to retry in {deployment}: {ex}') from ex
+    _metrics.add(retries=1)
+    current_span().add_to_stages(retries=1)
+    print(f'\tRetry {attempt} of {deployment} in {wait:.2f}s: {ex}')
+    return wait, deployment
+
+# Chat completion of a model with deadline, retries, hedging and circuit breaker. operation separates the latencies of
+# calls with different lengths to the same deployment (rewrite, rerank, generate...)
+def create_chat_completion(aoai_client, model, operation="chat", deadline=AOAI_DEADLINE_SECONDS, hedge=True, **kwargs):
+    _metrics.add(calls=1)
+    start = time.perf_counter()
+    avoid = None
+    attempt = 0
+    while True:
+        remaining = deadline - (time.perf_counter() - start)
+        if remaining <= 0:
+            _metrics.add(failures=1)
+            raise DeadlineExceededError(f'Deadline of {deadline}s exceeded calling {model}')
+        deployment = select_deployment(model, avoid)
+        attempt += 1
+        try:
+            response = run_attempt(aoai_client, deployment, operation, min(AOAI_ATTEMPT_TIMEOUT_SECONDS, remaining), hedge, kwargs)
+            get_breaker(deployment).record_success()
+            return response
+        except Exception as ex:
+            wait, avoid = handle_failure(ex, model, deployment, operation, attempt, deadline - (time.perf_counter() - start))
+        time.sleep(wait)
+
+# One attempt, with a duplicate request when it takes longer than the hedging delay of its deployment and operation
+def run_attempt(aoai_client, deployment, operation, timeout, hedge, kwargs):
+    _metrics.add(attempts=1)
+    tracker = get_latency_tracker(deployment, operation)
+    client = get_no_retry_client(aoai_client)
+
+    def send():
+        started = time.perf_counter()
+        response = client.chat.completions.create(model=deployment, timeout=timeout, **kwargs)
+        tracker.add(time.perf_counter() - started)
+        record_usage(response)
+        return response
+
+    delay = tracker.hedge_delay() if hedge else None
+    if delay is None or delay >= timeout:
+        return send()
+    executor = get_hedge_executor()
+    first = submit_in_context(executor, send)
+    done, _ = concurrent.futures.wait([first], timeout=delay)
+    if len(done) > 0 or not _metrics.take_hedge():
+        return first.result()
+    current_span().add_to_stages(hedges=1)
+    second = submit_in_context(executor, send)
+    error = None
+    # The slower request is not cancelled (the sync client cannot), its answer is ignored
+    for future in concurrent.futures.as_completed([first, second], timeout=timeout - delay):
+        try:
+            response = future.result()
+        except Exception as ex:
+            error = ex
+            continue
+        if future is second:
+            _metrics.add(hedge_wins=1)
+        return response
+    raise error
+
+# create_chat_completion with the async client
+async def create_chat_completion_async(aoai_client, model, operation="chat", deadline=AOAI_DEADLINE_SECONDS, hedge=True, **kwargs):
+    _metrics.add(calls=1)
+    start = time.perf_counter()
+    avoid = None
+    attempt = 0
+    while True:
+        remaining = deadline - (time.perf_counter() - start)
+        if remaining <= 0:
+            _metrics.add(failures=1)
+            raise DeadlineExceededError(f'Deadline of {deadline}s exceeded calling {model}')
+        deployment = select_deployment(model, avoid)
+        attempt += 1
+        try:
+            response = await run_attempt_async(aoai_client, deployment, operation, min(AOAI_ATTEMPT_TIMEOUT_SECONDS, remaining), hedge, kwargs)
+            get_breaker(deployment).record_success()
+            return response
+        except Exception as ex:
+            wait, avoid = handle_failure(ex, model, deployment, operation, attempt, deadline - (time.perf_counter() - start))
+        await asyncio.sleep(wait)
+
+# run_attempt with the async client, the slower request is cancelled
+async def run_attempt_async(aoai_client, deployment, operation, timeout, hedge, kwargs):
+    _metrics.add(attempts=1)
+    tracker = get_latency_tracker(deployment, operation)
+    client = get_no_retry_client(aoai_client)
+
+    async def send():
+        started = time.perf_counter()
+        response = await client.chat.completions.create(model=deployment, timeout=timeout, **kwargs)
+        tracker.add(time.perf_counter() - started)
+        record_usage(response)
+        return response
+
+    delay = tracker.hedge_delay() if hedge else None
+    if delay is None or delay >= timeout:
+        return await asyncio.wait_for(send(), timeout)
+    first = asyncio.ensure_future(send())
+    done, _ = await asyncio.wait([first], timeout=delay)
+    if len(done) > 0 or not _metrics.take_hedge():
+        return await asyncio.wait_for(first, timeout - delay)
+    current_span().add_to_stages(hedges=1)
+    second = asyncio.ensure_future(send())
+    pending = {first, second}
+    end = time.perf_counter() + timeout - delay
+    error = None
+    try:
+        while len(pending) > 0:
+            done, pending = await asyncio.wait(pending, timeout=max(0.0, end - time.perf_counter()), return_when=asyncio.FIRST_COMPLETED)
+            if len(done) == 0:
+                raise asyncio.TimeoutError()
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                if task is second:
+                    _metrics.add(hedge_wins=1)
+                return task.result()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+# Streamed chat completion of a model, yielding its chunks, with the deadline, retries and circuit breaker of
+# create_chat_completion (without hedging). An attempt is retried only until its first content delta: after that the
+# text has reached the caller and a failure (or the deadline, checked between chunks) ends the stream with an error
+def create_chat_completion_stream(aoai_client, model, operation="chat", deadline=AOAI_DEADLINE_SECONDS, **kwargs):
+    _metrics.add(calls=1)
+    start = time.perf_counter()
+    avoid = None
+    attempt = 0
+    while True:
+        remaining = deadline - (time.perf_counter() - start)
+        if remaining <= 0:
+            _metrics.add(failures=1)
+            raise DeadlineExceededError(f'Deadline of {deadline}s exceeded calling {model}')
+        deployment = select_deployment(model, avoid)
+        attempt += 1
+        _metrics.add(attempts=1)
+        response = None
+        # Chunks before the first content delta (the prompt filter results of Azure OpenAI)
+        chunks = []
+        try:
+            response = get_no_retry_client(aoai_client).chat.completions.create(
+                model=deployment, timeout=min(AOAI_ATTEMPT_TIMEOUT_SECONDS, remaining), stream=True, **kwargs)
+            for chunk in response:
+                chunks.append(chunk)
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                    break
+                if time.perf_counter() - start >= deadline:
+                    raise DeadlineExceededError(f'Deadline of {deadline}s exceeded calling {model}')
+        except Exception as ex:
+            close_stream(response)
+            wait, avoid = handle_failure(ex, model, deployment, operation, attempt, deadline - (time.perf_counter() - start))
+            time.sleep(wait)
+            continue
+        get_breaker(deployment).record_success()
+        try:
+            yield from chunks
+            for chunk in response:
+                if time.perf_counter() - start >= deadline:
+                    raise DeadlineExceededError(f'Deadline of {deadline}s exceeded streaming {model}')
+                yield chunk
+        except Exception:
+            _metrics.add(failures=1)
+            raise
+        finally:
+            close_stream(response)
+        return
+
+# Close the HTTP response of a stream that is not read to the end
+def close_stream(response):
+    close = getattr(response, 'close', None)
+    if close is not None:
+        close()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the repository are imported from its root, as the notebooks and the apps do
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
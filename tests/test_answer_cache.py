@@ -0,0 +1,98 @@
+import asyncio
+
+import numpy as np
+
+import answer_cache
+import async_utils
+import indexing_utils
+from answer_cache import SemanticAnswerCache, get_index_version
+
+def add(cache, embedding, answer):
+    cache.add(embedding, answer, "context", 1, answer, 1.0)
+
+def test_lookup_returns_the_most_similar_entry_over_the_threshold():
+    cache = SemanticAnswerCache(threshold=0.9)
+    add(cache, [1.0, 0.0, 0.0], "a")
+    add(cache, [0.0, 1.0, 0.0], "b")
+    assert cache.lookup([0.1, 2.0, 0.0])["answer"] == "b"
+    assert cache.lookup([1.0, 1.0, 0.0]) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["lookups"] == 2
+
+def test_full_cache_evicts_the_least_recently_used():
+    cache = SemanticAnswerCache(threshold=0.99, max_items=2)
+    add(cache, [1.0, 0.0, 0.0], "a")
+    add(cache, [0.0, 1.0, 0.0], "b")
+    cache.last_used[0] += 10 # "a" used after "b"
+    add(cache, [0.0, 0.0, 1.0], "c")
+    assert cache.lookup([0.0, 1.0, 0.0]) is None
+    assert cache.lookup([1.0, 0.0, 0.0])["answer"] == "a"
+    assert cache.stats()["evictions"] == 1
+
+def test_expired_entries_are_not_returned():
+    cache = SemanticAnswerCache(ttl_seconds=60)
+    add(cache, [1.0, 0.0], "a")
+    cache.created[:] -= 61
+    assert cache.lookup([1.0, 0.0]) is None
+    assert cache.stats()["expired"] == 1 and cache.stats()["items"] == 0
+
+def test_new_index_version_invalidates_the_cache():
+    cache = SemanticAnswerCache(version_check_seconds=0)
+    versions = iter(["1", "1", "2"])
+    cache.check_index_version(lambda: next(versions))
+    add(cache, [1.0, 0.0], "a")
+    cache.check_index_version(lambda: next(versions))
+    assert cache.stats()["items"] == 1
+    cache.check_index_version(lambda: next(versions))
+    assert cache.stats()["items"] == 0 and cache.stats()["invalidations"] == 1
+
+class FakeSearchClient:
+    def __init__(self, count):
+        self.count = count
+
+    def get_document_count(self):
+        return self.count
+
+def test_index_version_changes_with_the_content_of_the_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(answer_cache, "INDEX_MANIFESTS_DIR", str(tmp_path))
+    manifest_path = str(tmp_path / "docs.json")
+    client = FakeSearchClient(2)
+    assert get_index_version(client, "docs") == "2"
+
+    indexing_utils.save_manifest(manifest_path, {"sources": {"a.md": ["a-0-1111", "a-1-2222"]}})
+    first = get_index_version(client, "docs")
+    indexing_utils.save_manifest(manifest_path, {"sources": {"a.md": ["a-0-1111", "a-1-2222"]}})
+    assert get_index_version(client, "docs") == first
+    # Same number of documents, one chunk with a new content
+    indexing_utils.save_manifest(manifest_path, {"sources": {"a.md": ["a-0-1111", "a-1-3333"]}})
+    assert get_index_version(client, "docs") != first
+    assert get_index_version(client, "regs") == "2"
+
+def test_answer_cache_is_not_used_with_history(monkeypatch):
+    async def rewrite(*args):
+        return "standalone query"
+
+    async def search(*args):
+        return [], 0
+
+    async def embed(*args):
+        return [1.0, 0.0]
+
+    async def rerank(*args):
+        return "context", 1
+
+    monkeypatch.setattr(async_utils, "generate_search_query_async", rewrite)
+    monkeypatch.setattr(async_utils, "hybrid_search_async", search)
+    monkeypatch.setattr(async_utils, "create_embedding_async", embed)
+    monkeypatch.setattr(async_utils, "get_filtered_chunks_async", rerank)
+    openai_config = {"openai_client": None, "aoai_deployment_name": "chat", "aoai_embedding_model": "embedding", "aoai_rerank_model": "rerank"}
+    cache = SemanticAnswerCache()
+    add(cache, [1.0, 0.0], "answer of another session")
+
+    history = [{"question": "first question", "answer": "first answer"}]
+    result = asyncio.run(async_utils.retrieve_async(openai_config, None, "question", history, answer_cache=cache))
+    assert not result["cache_hit"] and result["query_embedding"] is None
+    assert cache.stats()["lookups"] == 0
+
+    result = asyncio.run(async_utils.retrieve_async(openai_config, None, "question", [], answer_cache=cache))
+    assert result["cache_hit"] and result["answer"] == "answer of another session"
+    assert np.isclose(cache.stats()["hit_rate"], 1.0)
@@ -0,0 +1,61 @@
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+from blob_ingestion import BlobIngestionPipeline
+
+# Fake container whose blobs are downloaded in slow ranged chunks
+class FakeContainer:
+    container_name = "docs"
+
+    def __init__(self, count, chunks=20):
+        self.names = [f"doc-{i}.pdf" for i in range(count)]
+        self.chunks = chunks
+
+    def list_blobs(self, name_starts_with=None):
+        return [SimpleNamespace(name=name) for name in self.names]
+
+    def download_blob(self, name):
+        def chunks():
+            for i in range(self.chunks):
+                time.sleep(0.005)
+                yield f"{name} {i}\n".encode("utf-8")
+        return SimpleNamespace(chunks=chunks)
+
+# Fake Document Intelligence whose analyses take some polls to finish
+class FakeDocIntel:
+    def begin_analyze_document(self, model, body, **kwargs):
+        content = body.read().decode("utf-8")
+        polls = [3]
+
+        # Polls until the analysis is done or the timeout passes, like the poller of the SDK
+        def wait(timeout=None):
+            end = time.perf_counter() + (timeout if timeout is not None else 60)
+            while polls[0] > 0 and time.perf_counter() < end:
+                time.sleep(0.01)
+                polls[0] -= 1
+
+        return SimpleNamespace(done=lambda: polls[0] <= 0, wait=wait, result=lambda: SimpleNamespace(content=f"# Title\n\n{content}"))
+
+def make_pipeline(tmp_path, count):
+    return BlobIngestionPipeline(FakeContainer(count), FakeDocIntel(), download_workers=3, convert_workers=3, queue_size=2,
+                                 cache_dir=str(tmp_path / "cache"), polling_interval=0.01, timeout=5)
+
+def test_pipeline_chunks_every_blob(tmp_path):
+    pipeline = make_pipeline(tmp_path, 6)
+    sources = {chunk["source"] for chunk in pipeline.chunks()}
+    assert sources == {f"docs/doc-{i}.pdf" for i in range(6)}
+    assert pipeline.stats["converted"] == 6 and pipeline.stats["failed"] == 0
+    assert not os.path.exists(pipeline.spool_dir)
+
+def test_closing_the_chunks_early_stops_the_stages_without_failures(tmp_path):
+    threads_before = threading.active_count()
+    pipeline = make_pipeline(tmp_path, 30)
+    chunks = pipeline.chunks()
+    next(chunks)
+    chunks.close()
+    assert pipeline.failures == [] and pipeline.stats["failed"] == 0
+    assert all(not thread.is_alive() for thread in pipeline.threads)
+    assert threading.active_count() == threads_before
+    assert not os.path.exists(pipeline.spool_dir)
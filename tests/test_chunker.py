@@ -0,0 +1,65 @@
+import re
+
+from common_utils import chunk_markdown, iter_markdown_blocks, get_encoding
+
+WORDS = ("physicians specialists nurses appointments emergency hospital coverage reimbursement prescription "
+         "pharmacy dental vision maternity below above within annual deductible copayment network").split()
+
+def paragraph(words, offset=0):
+    return ' '.join(WORDS[(offset + i) % len(WORDS)] for i in range(words))
+
+DOCUMENT = '\n'.join([
+    '# Health plan',
+    '',
+    paragraph(40),
+    '',
+    '<!-- PageBreak -->',
+    '## Coverage',
+    '',
+    paragraph(600, 3),
+    '',
+    '| Service | Copay |',
+    '|---|---|',
+    *[f'| {WORDS[i % len(WORDS)]} {i} | {i * 5} |' for i in range(80)],
+    '',
+    paragraph(120, 7),
+    '',
+])
+
+def words(text):
+    return re.findall(r'[^\s|#-]+', text)
+
+def test_chunks_without_overlap_rebuild_the_document():
+    blocks = [block for _, block in iter_markdown_blocks(DOCUMENT.splitlines(keepends=True))]
+    chunks = list(chunk_markdown('plan.md', DOCUMENT, max_tokens=256, overlap_tokens=0))
+    assert len(chunks) > 3
+    # Every word of the document in the same order, none split or repeated (table headers of the split table aside)
+    chunk_words = [word for chunk in chunks for word in words(chunk['content']) if word not in ('Service', 'Copay')]
+    assert chunk_words == [word for block in blocks for word in words(block) if word not in ('Service', 'Copay')]
+    # The text of a paragraph split between chunks is the text of the paragraph
+    assert paragraph(600, 3) in ' '.join(chunk['content'] for chunk in chunks)
+
+def test_overlap_starts_at_a_word_and_continues_the_text():
+    document_words = set(words(DOCUMENT))
+    chunks = list(chunk_markdown('plan.md', DOCUMENT, max_tokens=256, overlap_tokens=64))
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert set(words(chunk['content'])) <= document_words
+        assert '\n\n' not in chunk['content'][:1]
+    # A chunk that starts inside the long paragraph repeats the end of the previous chunk and continues it
+    long_paragraph = paragraph(600, 3)
+    inside = [chunk['content'] for chunk in chunks if chunk['content'] in long_paragraph]
+    assert len(inside) > 1
+
+def test_token_counts_and_budget():
+    encoding = get_encoding()
+    for chunk in chunk_markdown('plan.md', DOCUMENT, max_tokens=256, overlap_tokens=64):
+        assert chunk['tokens'] <= 256
+        # The separators counted are the ones in the text (re-encoding the joined text may merge a few tokens)
+        assert abs(chunk['tokens'] - len(encoding.encode_ordinary(chunk['content']))) <= 2 + chunk['content'].count('\n\n')
+        assert chunk['title_tokens'] == len(encoding.encode_ordinary('plan.md'))
+
+def test_split_table_repeats_its_header():
+    chunks = [chunk['content'] for chunk in chunk_markdown('plan.md', DOCUMENT, max_tokens=256, overlap_tokens=0)]
+    tables = [content for content in chunks if '| Service | Copay |' in content]
+    assert len(tables) > 1
+    assert all('|---|---|' in content for content in tables)
@@ -0,0 +1,56 @@
+import conversation_memory
+from common_utils import get_history_messages
+from conversation_memory import ConversationMemory
+
+def make_memory(monkeypatch, summaries, **kwargs):
+    calls = []
+
+    def call(aoai_client, aoai_deployment_name, system_prompt, user_prompt, temperature, max_tokens, **kw):
+        calls.append(user_prompt)
+        return summaries.pop(0) if summaries else None
+
+    monkeypatch.setattr(conversation_memory, "call_aoai", call)
+    return ConversationMemory(object(), "chat", **kwargs), calls
+
+def add_turns(memory, count, size=60):
+    for i in range(count):
+        memory.add_turn(f"question {i} " + "q" * size, f"answer {i} " + "a" * size)
+
+def test_history_under_the_budget_is_not_summarized(monkeypatch):
+    memory, calls = make_memory(monkeypatch, ["summary"], max_tokens=10000)
+    add_turns(memory, 3)
+    assert len(memory) == 3 and memory.summary is None and calls == []
+
+def test_compact_moves_the_oldest_turns_to_the_summary(monkeypatch):
+    memory, calls = make_memory(monkeypatch, ["first summary", "second summary"], max_tokens=1000, target_tokens=600, summary_max_tokens=100)
+    add_turns(memory, 20)
+    assert memory.stats()["summaries"] >= 1
+    assert memory.summary in ("first summary", "second summary")
+    assert memory.tokens() <= 1000
+    # The newest turns are kept word by word, the oldest ones are in the summary
+    assert memory.to_list()[-1]["question"].startswith("question 19")
+    assert all(not turn["question"].startswith("question 0 ") for turn in memory)
+    assert "question 0 " in calls[0]
+    # The second summary includes the previous one
+    if len(calls) > 1:
+        assert "first summary" in calls[1]
+    messages = get_history_messages(memory)
+    assert messages[0]["role"] == "system" and memory.summary in messages[0]["content"]
+
+def test_compact_keeps_the_last_turns(monkeypatch):
+    memory, _ = make_memory(monkeypatch, ["summary"] * 10, max_tokens=100, target_tokens=50, min_turns=2)
+    add_turns(memory, 4, size=200)
+    assert len(memory) == 2
+
+def test_failed_summary_drops_the_old_turns(monkeypatch):
+    memory, _ = make_memory(monkeypatch, [], max_tokens=500, target_tokens=300, summary_max_tokens=50)
+    add_turns(memory, 10)
+    assert memory.summary is None
+    assert memory.stats()["dropped_turns"] > 0
+    assert memory.tokens() <= 500
+
+def test_long_answers_are_cut(monkeypatch):
+    memory, _ = make_memory(monkeypatch, [], answer_max_tokens=20)
+    memory.add_turn("question", "word " * 100)
+    assert memory.to_list()[0]["answer"].endswith(" ...")
+    assert memory.stats()["cut_answers"] == 1
@@ -0,0 +1,45 @@
+import sqlite3
+
+import embedding_cache
+from embedding_cache import EmbeddingCache, text_hash
+
+MODEL = "text-embedding-3-small"
+
+def read_last_used(path, text):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT last_used FROM embeddings WHERE model = ? AND hash = ?", (MODEL, text_hash(text))).fetchone()[0]
+
+def test_round_trip(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.db"))
+    cache.put_many(MODEL, ["a", "b"], [[0.5, 1.0], [2.0, -1.0]])
+    assert cache.get_many(MODEL, ["b", "c", "a"]) == [[2.0, -1.0], None, [0.5, 1.0]]
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+    cache.close()
+
+def test_hits_do_not_write_last_used_until_the_batch_is_full(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.db")
+    cache = EmbeddingCache(path, memory_items=0)
+    cache.put(MODEL, "a", [1.0])
+    stored = read_last_used(path, "a")
+
+    monkeypatch.setattr(embedding_cache, "EMBEDDING_CACHE_TOUCH_ITEMS", 2)
+    monkeypatch.setattr(embedding_cache.time, "time", lambda: stored + 100)
+    assert cache.get(MODEL, "a") == [1.0]
+    assert read_last_used(path, "a") == stored
+    cache.put(MODEL, "b", [2.0])
+    assert read_last_used(path, "a") == stored + 100
+
+    monkeypatch.setattr(embedding_cache.time, "time", lambda: stored + 200)
+    cache.get_many(MODEL, ["a", "b"])
+    assert read_last_used(path, "a") == stored + 200
+    cache.close()
+
+def test_close_writes_the_pending_hits(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.db")
+    cache = EmbeddingCache(path)
+    cache.put(MODEL, "a", [1.0])
+    stored = read_last_used(path, "a")
+    monkeypatch.setattr(embedding_cache.time, "time", lambda: stored + 100)
+    cache.get(MODEL, "a")
+    cache.close()
+    assert read_last_used(path, "a") == stored + 100
@@ -0,0 +1,25 @@
+import concurrent.futures
+
+from common_utils import fuse_results, merge_index_results
+
+def documents(*ids):
+    return [{"id": id, "title": id, "content": id} for id in ids]
+
+def test_rrf_uses_the_positions_in_every_index():
+    fused = fuse_results({"docs": documents("a", "b", "c"), "regs": documents("c", "d")}, max_docs=10, k=60)
+    # b and d are both second in their index: the tie keeps the order of the indexes
+    assert [result["id"] for result in fused] == ["c", "a", "b", "d"]
+    assert fused[0]["@search.rrf_score"] == 1 / 63 + 1 / 61
+    assert fused[0]["@search.index"] == "docs"
+    assert fused[3]["@search.index"] == "regs"
+
+def test_fused_results_are_cut_to_max_docs():
+    fused = fuse_results({"docs": documents("a", "b", "c"), "regs": documents("d", "e")}, max_docs=3)
+    assert len(fused) == 3 and len({result["id"] for result in fused}) == 3
+
+def test_failed_and_slow_indexes_are_left_out():
+    responses = {"docs": (documents("a", "b"), 12), "regs": concurrent.futures.TimeoutError(), "other": RuntimeError("503")}
+    fused, count, failed = merge_index_results(responses, max_docs=10)
+    assert [result["id"] for result in fused] == ["a", "b"]
+    assert count == 12
+    assert sorted(failed) == ["other", "regs"]
@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+import indexing_utils
+from indexing_utils import index_documents
+
+class FakeEmbeddingClient:
+    def with_options(self, **options):
+        return self
+
+# Buffered sender that keeps the documents uploaded and deleted
+class FakeBatchClient:
+    def __init__(self):
+        self.documents = {}
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def merge_or_upload_documents(self, documents):
+        self.pending += documents
+
+    def delete_documents(self, documents):
+        for document in documents:
+            self.documents.pop(document["id"], None)
+
+    def flush(self):
+        for document in self.pending:
+            self.documents[document["id"]] = document
+        self.pending = []
+
+@pytest.fixture
+def embedded(monkeypatch):
+    monkeypatch.setattr(indexing_utils, "get_embedding_cache", lambda: None)
+    texts = []
+    failing = set()
+
+    # Fake embed_batch that fails for the batches with a chunk in failing
+    def embed_batch(embedding_client, embedding_model_name, throttle, batch):
+        if any(content["content"] in failing for _, content in batch):
+            raise RuntimeError("embeddings failed after the retries")
+        texts.extend(content["content"] for _, content in batch)
+        return [{"id": chunk_id, "title": content["title"], "content": content["content"],
+                 "embeddingTitle": [0.0], "embeddingContent": [0.0]} for chunk_id, content in batch]
+
+    monkeypatch.setattr(indexing_utils, "embed_batch", embed_batch)
+    return texts, failing
+
+def make_contents(sources, chunks):
+    return [{"title": source, "source": source, "content": f"{source} chunk {i}"} for source in sources for i in range(chunks)]
+
+def run(tmp_path, batch_client, contents):
+    return index_documents(None, None, "test", FakeEmbeddingClient(), "embedding", contents, batch_size=2, max_workers=1,
+                           flush_docs=2, incremental=True, manifest_path=str(tmp_path / "test.json"), batch_client=batch_client)
+
+def load_sources(tmp_path):
+    with open(tmp_path / "test.json", encoding="utf-8") as f:
+        return json.load(f)["sources"]
+
+def test_failed_embedding_batch_is_reported_and_indexed_in_the_next_run(tmp_path, embedded):
+    texts, failing = embedded
+    batch_client = FakeBatchClient()
+    failing.add("b chunk 0")
+    stats = run(tmp_path, batch_client, make_contents(["a", "b"], 2))
+    assert stats["errors"] == 2 and stats["chunks"] == 2
+    assert len(load_sources(tmp_path)["a"]) == 2 and load_sources(tmp_path)["b"] == []
+
+    failing.clear()
+    texts.clear()
+    stats = run(tmp_path, batch_client, make_contents(["a", "b"], 2))
+    assert texts == ["b chunk 0", "b chunk 1"]
+    assert stats["errors"] == 0 and stats["unchanged"] == 2
+    assert len(batch_client.documents) == 4
+
+def test_failed_source_keeps_its_previous_chunks(tmp_path, embedded):
+    texts, failing = embedded
+    batch_client = FakeBatchClient()
+    run(tmp_path, batch_client, make_contents(["a"], 2))
+    previous = set(batch_client.documents)
+
+    # The new version of the source fails: the previous chunks are not deleted
+    contents = [{"title": "a", "source": "a", "content": "a new chunk 0"}, {"title": "a", "source": "a", "content": "a new chunk 1"}]
+    failing.add("a new chunk 0")
+    run(tmp_path, batch_client, contents)
+    assert set(batch_client.documents) == previous
+    assert set(load_sources(tmp_path)["a"]) == previous
+
+def test_manifest_is_saved_when_the_contents_fail(tmp_path, embedded):
+    texts, failing = embedded
+    batch_client = FakeBatchClient()
+
+    def contents():
+        yield from make_contents(["a", "b"], 2)
+        raise OSError("source not readable")
+
+    with pytest.raises(OSError):
+        run(tmp_path, batch_client, contents())
+    # The manifest has the chunks uploaded before the failure
+    sources = load_sources(tmp_path)
+    uploaded = {document["content"] for document in batch_client.documents.values()}
+    assert sorted(chunk_id for chunk_ids in sources.values() for chunk_id in chunk_ids) == sorted(batch_client.documents)
+    assert len(uploaded) > 0
+
+    # and the next run only embeds the rest
+    texts.clear()
+    run(tmp_path, batch_client, make_contents(["a", "b"], 2))
+    assert sorted(texts + list(uploaded)) == ["a chunk 0", "a chunk 1", "b chunk 0", "b chunk 1"]
@@ -0,0 +1,114 @@
+import sqlite3
+
+import numpy as np
+
+from local_search import LocalSearchClient
+
+class VectorQuery:
+    def __init__(self, vector, fields="embeddingContent", k_nearest_neighbors=3):
+        self.vector = vector
+        self.fields = fields
+        self.k_nearest_neighbors = k_nearest_neighbors
+
+# Stand-in of an HNSW index that counts the saves
+class FakeAnnIndex:
+    def __init__(self):
+        self.saves = 0
+
+    def add_items(self, vectors, labels):
+        pass
+
+    def resize_index(self, capacity):
+        pass
+
+    def save_index(self, path):
+        self.saves += 1
+
+def make_document(i, text):
+    vector = np.zeros(4)
+    vector[i % 4] = 1.0
+    return {"id": f"doc-{i}", "title": f"title {i}", "content": text, "embeddingTitle": vector.tolist(), "embeddingContent": vector.tolist()}
+
+def stored_documents(index_dir):
+    with sqlite3.connect(str(index_dir / "documents.db")) as conn:
+        return conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+def test_documents_are_written_in_one_transaction_per_flush(tmp_path):
+    client = LocalSearchClient(str(tmp_path))
+    for i in range(5):
+        client.merge_or_upload_documents([make_document(i, f"text {i}")])
+    assert stored_documents(tmp_path) == 0
+    client.flush()
+    assert stored_documents(tmp_path) == 5
+    client.close()
+
+def test_search_sees_the_pending_documents(tmp_path):
+    client = LocalSearchClient(str(tmp_path))
+    client.merge_or_upload_documents([make_document(0, "solar panels"), make_document(1, "wind turbines")])
+    client.merge_or_upload_documents([make_document(1, "offshore wind turbines")])
+    results = client.search(search_text="wind", vector_queries=[VectorQuery([0.0, 1.0, 0.0, 0.0])], top=2)
+    assert results[0]["id"] == "doc-1" and results[0]["content"] == "offshore wind turbines"
+    assert client.get_document_count() == 2
+    client.delete_documents([{"id": "doc-1"}])
+    assert [result["id"] for result in client.search(search_text="wind", top=2)] == []
+    client.close()
+
+def test_ann_indexes_are_saved_only_at_the_end(tmp_path):
+    client = LocalSearchClient(str(tmp_path))
+    index = FakeAnnIndex()
+    client.ann_indexes["embeddingContent"] = index
+    with client:
+        for i in range(10):
+            client.merge_or_upload_documents([make_document(i, f"text {i}")])
+            if i % 3 == 0:
+                client.flush()
+        assert index.saves == 0
+    assert index.saves == 1
+    assert client.get_document_count() == 10
+
+# Stand-in of an HNSW index that fails like hnswlib when k is over the rows not marked as deleted
+class FakeKnnIndex(FakeAnnIndex):
+    def __init__(self):
+        super().__init__()
+        self.vectors = {}
+        self.deleted = set()
+
+    def add_items(self, vectors, labels):
+        for vector, label in zip(vectors, labels):
+            self.vectors[int(label)] = vector
+            self.deleted.discard(int(label))
+
+    def mark_deleted(self, label):
+        self.deleted.add(label)
+
+    def get_current_count(self):
+        return len(self.vectors)
+
+    def knn_query(self, query, k):
+        live = [label for label in self.vectors if label not in self.deleted]
+        if k > len(live):
+            raise RuntimeError("Cannot return the results in a contiguous 2D array. Probably ef or M is too small")
+        live.sort(key=lambda label: -float(self.vectors[label] @ query))
+        return np.array([live[:k]]), None
+
+def test_vector_search_after_deletes_asks_only_for_the_live_rows(tmp_path):
+    client = LocalSearchClient(str(tmp_path))
+    client.ann_indexes["embeddingContent"] = FakeKnnIndex()
+    client.merge_or_upload_documents([make_document(i, f"text {i}") for i in range(4)])
+    client.delete_documents([{"id": "doc-0"}, {"id": "doc-1"}])
+    results = client.search(vector_queries=[VectorQuery([0.0, 0.0, 1.0, 0.0], k_nearest_neighbors=4)], top=4)
+    assert [result["id"] for result in results] == ["doc-2", "doc-3"]
+    client.delete_documents([{"id": "doc-2"}, {"id": "doc-3"}])
+    assert client.search(vector_queries=[VectorQuery([0.0, 0.0, 1.0, 0.0])], top=4) == []
+    client.close()
+
+def test_vector_search_falls_back_to_exact_search_when_the_graph_fails(tmp_path):
+    client = LocalSearchClient(str(tmp_path))
+    index = FakeKnnIndex()
+    client.ann_indexes["embeddingContent"] = index
+    client.merge_or_upload_documents([make_document(i, f"text {i}") for i in range(4)])
+    client.flush()
+    index.deleted.add(3) # Unreachable row in the graph, still live in the index
+    results = client.search(vector_queries=[VectorQuery([0.0, 0.0, 1.0, 0.0], k_nearest_neighbors=4)], top=4)
+    assert results[0]["id"] == "doc-2" and len(results) == 4
+    client.close()
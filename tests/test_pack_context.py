@@ -0,0 +1,51 @@
+from common_utils import pack_context, format_chunk, get_chunk_position, get_encoding
+from indexing_utils import make_chunk_id
+
+def count_tokens(title, content):
+    return len(get_encoding().encode(format_chunk(title, content)))
+
+def make_chunk(source, ordinal, content, confidence=95, title="Guide"):
+    return {"id": make_chunk_id(source, ordinal, title, content), "title": title, "content": content, "confidence": confidence}
+
+FIRST = "The annual leave is twenty-two working days for every employee of the company. "
+SECOND = "twenty-two working days for every employee of the company. It can be split in three periods."
+OTHER = "Remote work is allowed two days a week after the first month in the company."
+
+def test_chunk_position_from_the_chunk_id():
+    first = make_chunk_id("docs/guide.md", 3, "Guide", "text")
+    assert get_chunk_position(first) == (first.split('-')[0], 3, 3)
+    assert make_chunk_id("docs/guide.md", 3, "Guide", "text") == first
+    assert make_chunk_id("docs/guide.md", 3, "Guide", "new text") != first
+    assert get_chunk_position("42") is None
+
+def test_duplicates_and_overlaps_are_saved_not_dropped():
+    chunks = [make_chunk("a.md", 0, FIRST), make_chunk("b.md", 0, FIRST, 94), make_chunk("a.md", 1, SECOND, 93)]
+    context, stats = pack_context(chunks, max_tokens=10000)
+    merged = FIRST + "It can be split in three periods."
+    assert context == format_chunk("Guide", merged)
+    assert stats["duplicates"] == 1 and stats["merged"] == 1 and stats["chunks"] == 2 and stats["sections"] == 1
+    assert stats["tokens_dropped"] == 0 and stats["dropped"] == 0
+    tokens_before = sum(count_tokens(chunk["title"], chunk["content"]) for chunk in chunks)
+    assert stats["tokens"] == count_tokens("Guide", merged)
+    assert stats["tokens_saved"] == tokens_before - stats["tokens"]
+
+def test_consecutive_chunks_of_a_document_are_merged():
+    context, stats = pack_context([make_chunk("a.md", 5, OTHER, 99), make_chunk("a.md", 4, FIRST, 92)])
+    assert stats["sections"] == 1 and stats["merged"] == 1
+    assert FIRST + "\n" + OTHER in context or OTHER + "\n" + FIRST in context
+
+def test_budget_drops_are_reported_apart_from_the_savings():
+    chunks = [make_chunk("a.md", 0, FIRST, 99, "A"), make_chunk("b.md", 0, OTHER, 98, "B"), make_chunk("c.md", 0, SECOND, 97, "C")]
+    max_tokens = count_tokens("A", FIRST) + 5
+    context, stats = pack_context(chunks, max_tokens=max_tokens)
+    assert context == format_chunk("A", FIRST)
+    assert stats["chunks"] == 1 and stats["dropped"] == 2 and stats["truncated"] == 0
+    assert stats["tokens_saved"] == 0
+    assert stats["tokens_dropped"] == count_tokens("B", OTHER) + count_tokens("C", SECOND)
+
+def test_first_section_over_the_budget_is_cut():
+    chunks = [make_chunk("a.md", 0, FIRST * 20, 99)]
+    context, stats = pack_context(chunks, max_tokens=100)
+    assert stats["truncated"] == 1 and stats["tokens"] <= 100
+    assert stats["tokens_dropped"] == count_tokens("Guide", FIRST * 20) - stats["tokens"]
+    assert stats["tokens_saved"] == 0
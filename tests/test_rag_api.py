@@ -0,0 +1,72 @@
+import pytest
+
+import rag_api
+from rag_api import TenantLimiter, parse_request, parse_api_keys, get_tenant
+
+def test_max_docs_accepts_integers_and_numeric_strings():
+    assert parse_request({"question": "q"})[4] == rag_api.MAX_DOCS
+    assert parse_request({"question": "q", "max_docs": None})[4] == rag_api.MAX_DOCS
+    assert parse_request({"question": "q", "max_docs": 3})[4] == 3
+    assert parse_request({"question": "q", "max_docs": " 4 "})[4] == 4
+
+@pytest.mark.parametrize("max_docs", [[1], {"n": 1}, True, 2.5, "abc", 0, -1, rag_api.MAX_DOCS_LIMIT + 1])
+def test_invalid_max_docs_raises_value_error(max_docs):
+    with pytest.raises(ValueError):
+        parse_request({"question": "q", "max_docs": max_docs})
+
+def test_invalid_max_docs_is_a_400():
+    client = rag_api.app.test_client()
+    response = client.post('/v1/answer', json={"question": "q", "max_docs": [1]})
+    assert response.status_code == 400
+    assert "max_docs" in response.get_json()["error"]
+
+def test_limiter_rejects_over_the_tenant_limit():
+    limiter = TenantLimiter(max_concurrent=1, wait_seconds=0.01)
+    assert limiter.acquire("a")
+    assert not limiter.acquire("a")
+    assert limiter.acquire("b")
+    limiter.release("a")
+    assert limiter.acquire("a")
+    assert limiter.stats()["a"] == {"active": 1, "waiting": 0, "accepted": 2, "rejected": 1}
+
+def test_limiter_evicts_idle_tenants():
+    limiter = TenantLimiter(max_concurrent=1, wait_seconds=0.01, idle_seconds=10)
+    limiter.acquire("idle")
+    limiter.release("idle")
+    limiter.acquire("busy")
+    limiter.last_used["idle"] -= 20
+    limiter.last_used["busy"] -= 20
+    limiter.evict_idle(limiter.last_used["busy"] + 20)
+    assert list(limiter.stats()) == ["busy"] # A tenant with an active request is kept
+    assert limiter.evicted == 1
+    limiter.release("busy")
+
+def test_limiter_evicts_the_least_recently_used_over_max_tracked():
+    limiter = TenantLimiter(max_concurrent=1, wait_seconds=0.01, max_tracked=2)
+    for tenant in ("a", "b", "c"):
+        assert limiter.acquire(tenant)
+        limiter.release(tenant)
+    assert sorted(limiter.stats()) == ["b", "c"]
+    assert limiter.evicted == 1
+
+def test_tenant_comes_from_the_header_without_api_keys():
+    assert get_tenant({"X-Tenant-Id": "a"}, {}) == "a"
+    assert get_tenant({}, {}) == rag_api.DEFAULT_TENANT
+
+def test_tenant_comes_from_the_api_key_when_configured():
+    api_keys = parse_api_keys("k1:a, k2:b")
+    assert api_keys == {"k1": "a", "k2": "b"}
+    assert get_tenant({"Authorization": "Bearer k2", "X-Tenant-Id": "a"}, api_keys) == "b"
+    assert get_tenant({"Authorization": "Bearer wrong"}, api_keys) is None
+    assert get_tenant({"X-Tenant-Id": "a"}, api_keys) is None
+
+def test_invalid_api_keys_setting_raises():
+    with pytest.raises(ValueError):
+        parse_api_keys("k1")
+
+def test_request_without_a_valid_api_key_is_a_401(monkeypatch):
+    monkeypatch.setattr(rag_api, "_api_keys", {"k1": "a"})
+    client = rag_api.app.test_client()
+    response = client.post('/v1/answer', json={"question": "q"}, headers={"X-Tenant-Id": "a"})
+    assert response.status_code == 401
+    assert response.headers["WWW-Authenticate"] == "Bearer"
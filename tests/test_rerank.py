@@ -0,0 +1,95 @@
+import asyncio
+import json
+
+import async_utils
+import common_utils
+from common_utils import parse_rank_batch_response, get_rank_batch_max_tokens, fill_failed_ranks, split_cascade, RANK_BATCH_MAX_TOKENS
+
+def make_results(count):
+    return [{"id": f"chunk-{i}", "title": "title", "content": f"content {i}"} for i in range(count)]
+
+def batch_response(positions, confidence=95):
+    return json.dumps({"chunks": [{"id": str(position), "confidence": confidence, "answer": f"answer {position}"} for position in positions]})
+
+# Fake listwise model: scores the chunks of the prompt, with an invalid (cut) response for batches over max_valid chunks
+def fake_completion(calls, max_valid):
+    def call(aoai_client, aoai_model_name, messages, temperature, max_tokens, response_format=None, operation="chat", deadline=None):
+        texts = json.loads(messages[-1]["content"].split("\nTexts: ", 1)[1])
+        calls.append(len(texts))
+        if len(texts) > max_valid:
+            return batch_response(range(1, len(texts) + 1))[:-20], "length"
+        return batch_response(range(1, len(texts) + 1)), "stop"
+    return call
+
+def fake_rank(calls):
+    def rank(aoai_client, aoai_model_name, id, title, content, question):
+        calls.append(1)
+        return id, title, content, 91, "pointwise"
+    return rank
+
+def test_parse_valid_response():
+    scores = parse_rank_batch_response(json.dumps({"chunks": [{"id": "2", "confidence": 120, "answer": "b"},
+                                                              {"id": "1", "confidence": 40, "answer": "a"}]}), 2)
+    assert scores == [(40, "a"), (100, "b")]
+
+def test_parse_missing_and_invalid_items_have_no_confidence():
+    response = json.dumps({"chunks": [{"id": "1", "confidence": 90, "answer": "a"},
+                                      {"id": "7", "confidence": 90, "answer": "out of range"},
+                                      {"id": "3", "confidence": "high", "answer": "c"}]})
+    assert parse_rank_batch_response(response, 3) == [(90, "a"), (None, ""), (None, "")]
+
+def test_parse_invalid_or_truncated_json_is_a_failure():
+    assert parse_rank_batch_response(None, 2) is None
+    assert parse_rank_batch_response('{"chunks": [{"id": "1", "confidence": 9', 2) is None
+    assert parse_rank_batch_response('{"ranks": []}', 2) is None
+    assert parse_rank_batch_response('{"chunks": {}}', 2) is None
+
+def test_max_tokens_grow_with_the_batch_up_to_the_output_limit():
+    assert get_rank_batch_max_tokens(2) < get_rank_batch_max_tokens(8) <= RANK_BATCH_MAX_TOKENS
+    assert get_rank_batch_max_tokens(1000) == RANK_BATCH_MAX_TOKENS
+
+def test_truncated_batch_is_split_until_the_responses_are_valid(monkeypatch):
+    calls = []
+    monkeypatch.setattr(common_utils, "call_aoai_completion", fake_completion(calls, max_valid=2))
+    ranks = common_utils.calculate_rank_batch(None, "model", make_results(8), "question")
+    assert calls == [8, 4, 2, 2, 4, 2, 2]
+    assert [rank[0] for rank in ranks] == [f"chunk-{i}" for i in range(8)]
+    assert all(rank[3] == 95 for rank in ranks)
+
+def test_single_failed_chunk_is_ranked_alone(monkeypatch):
+    rank_calls = []
+    monkeypatch.setattr(common_utils, "call_aoai_completion", lambda *args, **kwargs: (batch_response([1, 3]), "stop"))
+    monkeypatch.setattr(common_utils, "calculate_rank", fake_rank(rank_calls))
+    ranks = common_utils.calculate_rank_batch(None, "model", make_results(3), "question")
+    assert [rank[3] for rank in ranks] == [95, 91, 95]
+    assert len(rank_calls) == 1
+
+def test_failed_call_is_not_retried_and_falls_back_to_the_semantic_score(monkeypatch):
+    calls = []
+    monkeypatch.setattr(common_utils, "call_aoai_completion", lambda *args, **kwargs: calls.append(1) or (None, None))
+    results = make_results(4)
+    results[0]["@search.reranker_score"] = 3.6
+    ranks = common_utils.calculate_rank_batch(None, "model", results, "question")
+    assert len(calls) == 1
+    assert [rank[3] for rank in ranks] == [None] * 4
+    assert [rank[3] for rank in fill_failed_ranks(ranks, results)] == [90, 0, 0, 0]
+
+def test_truncated_batch_is_split_with_the_async_client(monkeypatch):
+    calls = []
+    completion = fake_completion(calls, max_valid=3)
+
+    async def call(*args, **kwargs):
+        return completion(*args, **kwargs)
+
+    monkeypatch.setattr(async_utils, "call_aoai_completion_async", call)
+    ranks = asyncio.run(async_utils.calculate_rank_batch_async(None, "model", make_results(5), "question"))
+    assert sorted(calls) == [2, 3, 5]
+    assert all(rank[3] == 95 for rank in ranks)
+
+def test_cascade_orders_a_zero_score_before_the_results_without_score():
+    results = [{"id": "none", "title": "t", "content": "c"},
+               {"id": "zero", "title": "t", "content": "c", "@search.reranker_score": 0.0},
+               {"id": "two", "title": "t", "content": "c", "@search.reranker_score": 2.0}]
+    accepted, uncertain, rejected = split_cascade(results, accept_score=3.0, reject_score=-0.5)
+    assert accepted == [] and rejected == 0
+    assert [result["id"] for result in uncertain] == ["two", "zero", "none"]
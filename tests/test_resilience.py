@@ -0,0 +1,110 @@
+from types import SimpleNamespace
+
+import pytest
+
+import resilience
+from common_utils import call_aoai_stream
+from resilience import CircuitBreaker, create_chat_completion_stream
+
+class ServiceError(Exception):
+    status_code = 503
+
+def make_chunk(content, finish_reason=None):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content), finish_reason=finish_reason)])
+
+# Text deltas and return value (finish_reason) of a generator
+def consume(stream):
+    deltas = []
+    while True:
+        try:
+            deltas.append(next(stream))
+        except StopIteration as stop:
+            return deltas, stop.value
+
+# Fake client whose streams are the lists of chunks of streams, in order, with an exception raised where it appears
+class FakeStreamClient:
+    def __init__(self, streams):
+        self.streams = list(streams)
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def with_options(self, **options):
+        return self
+
+    def create(self, **kwargs):
+        self.calls += 1
+        return self.stream(self.streams.pop(0))
+
+    def stream(self, items):
+        for item in items:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+@pytest.fixture(autouse=True)
+def isolated_state(monkeypatch):
+    monkeypatch.setattr(resilience, "_breakers", {})
+    monkeypatch.setattr(resilience, "_no_retry_clients", {})
+    monkeypatch.setattr(resilience, "_fallback_deployments", {})
+    monkeypatch.setattr(resilience.time, "sleep", lambda seconds: None)
+
+def test_breaker_opens_after_the_consecutive_failures(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failures=3, open_seconds=30)
+    assert not breaker.record_failure() and not breaker.record_failure()
+    assert breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow() and not breaker.available()
+
+    # After open_seconds one trial call (half open), a failure opens the circuit again
+    now[0] += 30
+    assert breaker.available() and breaker.allow()
+    assert breaker.state == "half_open" and not breaker.allow()
+    assert breaker.record_failure()
+    assert breaker.state == "open"
+
+    # A successful trial call closes it
+    now[0] += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.failures == 0 and breaker.allow()
+
+def test_breaker_success_resets_the_consecutive_failures():
+    breaker = CircuitBreaker(failures=2)
+    breaker.record_failure()
+    breaker.record_success()
+    assert not breaker.record_failure()
+    assert breaker.state == "closed"
+
+def test_stream_retries_the_failures_before_the_first_token():
+    client = FakeStreamClient([[ServiceError("down")], [make_chunk(None), ServiceError("reset")], [make_chunk(None), make_chunk("Hel"), make_chunk("lo")]])
+    chunks = list(create_chat_completion_stream(client, "gpt", messages=[]))
+    assert [chunk.choices[0].delta.content for chunk in chunks] == [None, "Hel", "lo"]
+    assert client.calls == 3
+
+def test_stream_does_not_retry_after_the_first_token():
+    client = FakeStreamClient([[make_chunk("Hel"), ServiceError("reset")], [make_chunk("Hello")]])
+    stream = create_chat_completion_stream(client, "gpt", messages=[])
+    assert next(stream).choices[0].delta.content == "Hel"
+    with pytest.raises(ServiceError):
+        next(stream)
+    assert client.calls == 1
+
+def test_stream_raises_the_errors_of_the_request_at_once():
+    error = ServiceError("bad request")
+    error.status_code = 400
+    client = FakeStreamClient([[error], [make_chunk("Hello")]])
+    with pytest.raises(ServiceError):
+        list(create_chat_completion_stream(client, "gpt", messages=[]))
+    assert client.calls == 1
+
+def test_call_aoai_stream_returns_the_finish_reason():
+    client = FakeStreamClient([[make_chunk(None), make_chunk("Hel"), make_chunk("lo"), make_chunk(None, "stop")]])
+    assert consume(call_aoai_stream(client, "gpt", [], 0.0, 100)) == (["Hel", "lo"], "stop")
+
+def test_call_aoai_stream_raises_a_failure_after_the_first_token():
+    client = FakeStreamClient([[make_chunk("Hel"), ServiceError("reset")]])
+    stream = call_aoai_stream(client, "gpt", [], 0.0, 100)
+    assert next(stream) == "Hel"
+    with pytest.raises(ServiceError):
+        next(stream)
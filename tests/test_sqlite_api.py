@@ -0,0 +1,46 @@
+import importlib.util
+import json
+import os
+import sqlite3
+
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(__file__), '..', '1_indexing', 'app.py')
+CREDENTIALS = {"user": "admin", "password": "Password123!"}
+
+@pytest.fixture
+def sqlite_app(tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'test.db')
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)')
+        conn.executemany('INSERT INTO items VALUES (?, ?)', [(i, f'item {i}') for i in range(1, 21)])
+    monkeypatch.setenv('SQLITE_DB_PATH', db_path)
+    spec = importlib.util.spec_from_file_location('sqlite_app', APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def query(sqlite_app, **parameters):
+    client = sqlite_app.app.test_client()
+    return client.post('/sqlite-query', json=dict(CREDENTIALS, query='SELECT id, name FROM items', **parameters))
+
+def test_pages_follow_next_after(sqlite_app):
+    body = json.loads(query(sqlite_app, order_by='id', page_size='8').get_data(as_text=True))
+    assert [row[0] for row in body["rows"]] == list(range(1, 9)) and body["next_after"] == 8
+    body = json.loads(query(sqlite_app, order_by='id', page_size=8, after=16).get_data(as_text=True))
+    assert [row[0] for row in body["rows"]] == [17, 18, 19, 20] and body["next_after"] is None
+
+@pytest.mark.parametrize("page_size", ["abc", -5, 0, True, [10], 2.5])
+def test_invalid_page_size_is_a_400(sqlite_app, page_size):
+    response = query(sqlite_app, order_by='id', page_size=page_size)
+    assert response.status_code == 400
+    assert "page_size" in response.get_json()["error"]
+
+def test_error_after_the_first_batch_closes_the_json_page(sqlite_app, monkeypatch):
+    def failing_batches(cursor, first_batch):
+        yield first_batch
+        raise sqlite3.OperationalError('disk I/O error')
+    monkeypatch.setattr(sqlite_app, 'iter_batches', failing_batches)
+    body = json.loads(query(sqlite_app, order_by='id', page_size=10).get_data(as_text=True))
+    assert len(body["rows"]) == 10
+    assert body["error"] == 'disk I/O error' and body["next_after"] is None
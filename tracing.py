@@ -0,0 +1,266 @@
+import contextvars
+import json
+import os
+import statistics
+import threading
+import time
+import uuid
+from collections import deque
+
+# CONSTANTS
+TRACING_MAX_SPANS = 100000 # Finished spans kept in memory for the summary
+
+# Lightweight tracing of the RAG pipeline: every stage (rewrite, embedding, search, rerank, generate...) is a span
+# with its wall time and attributes (tokens, retries, chunk id...), nested with the span active in the context.
+# When tracing is disabled span() returns a shared no-op span, so the instrumented code only pays a function call
+_tracer = None
+_current_span = contextvars.ContextVar('current_span', default=None)
+_stages_lock = threading.Lock() # The parent stages are updated from the threads of the re-ranker
+
+class Span:
+    def __init__(self, tracer, name, parent, activate, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.activate = activate
+        self.attributes = attributes
+        self.error = None
+        self.token = None
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        if self.activate:
+            self.token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if isinstance(exc, Exception):
+            self.error = f'{exc_type.__name__}: {exc}'
+        elif exc is not None:
+            # Cancelled task (speculative search) or generator closed before the end
+            self.attributes["cancelled"] = True
+        if self.token is not None:
+            try:
+                _current_span.reset(self.token)
+            except ValueError:
+                # A generator closed in a different context
+                pass
+        self.tracer.record(self)
+        return False
+
+    # Set attributes of the span
+    def set(self, **attributes):
+        for key, value in attributes.items():
+            self.attributes[key] = value
+
+    # Add numeric attributes to the existing ones (tokens and retries of several calls)
+    def add(self, **attributes):
+        for key, value in attributes.items():
+            self.attributes[key] = self.attributes.get(key, 0) + value
+
+    # Add numeric attributes to the span and to all its parents, so every stage includes the tokens of its calls
+    def add_to_stages(self, **attributes):
+        span = self
+        with _stages_lock:
+            while span is not None:
+                span.add(**attributes)
+                span = span.parent
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start_time, 6),
+            "duration_ms": round(self.duration * 1000, 3),
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+# Span returned when tracing is disabled
+class NoopSpan:
+    trace_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, **attributes):
+        pass
+
+    def add_to_stages(self, **attributes):
+        pass
+
+NOOP_SPAN = NoopSpan()
+
+# Collector of the finished spans, optionally appended as JSON lines to a file while they finish
+class Tracer:
+    def __init__(self, export_path=None, max_spans=TRACING_MAX_SPANS):
+        self.export_path = export_path
+        self.spans = deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+        self.export_file = open(export_path, 'a', encoding='utf-8') if export_path else None
+
+    def record(self, span):
+        data = span.to_dict()
+        with self.lock:
+            self.spans.append(data)
+            if self.export_file is not None:
+                self.export_file.write(json.dumps(data, ensure_ascii=False) + '\n')
+                self.export_file.flush()
+
+    def get_spans(self, trace_id=None):
+        with self.lock:
+            return [data for data in self.spans if trace_id is None or data["trace_id"] == trace_id]
+
+    # Write the spans in memory to a JSONL file
+    def export_jsonl(self, path, trace_id=None):
+        spans = self.get_spans(trace_id)
+        with open(path, 'w', encoding='utf-8') as f:
+            for data in spans:
+                f.write(json.dumps(data, ensure_ascii=False) + '\n')
+        return len(spans)
+
+    # Latency percentiles, tokens and retries of every stage
+    def summary(self, trace_id=None):
+        return summarize_spans(self.get_spans(trace_id))
+
+    def clear(self):
+        with self.lock:
+            self.spans.clear()
+
+    def close(self):
+        with self.lock:
+            if self.export_file is not None:
+                self.export_file.close()
+                self.export_file = None
+
+# Enable the tracing of the process, with an optional JSONL file to export the spans as they finish
+def enable_tracing(export_path=None, max_spans=TRACING_MAX_SPANS):
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+    _tracer = Tracer(export_path, max_spans)
+    return _tracer
+
+def disable_tracing():
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+    _tracer = None
+
+# Enable the tracing when RAG_TRACING=1, exporting to RAG_TRACING_EXPORT_PATH when it is set
+def configure_tracing():
+    if os.getenv('RAG_TRACING', '0').lower() in ('1', 'true', 'yes'):
+        if _tracer is None:
+            enable_tracing(os.getenv('RAG_TRACING_EXPORT_PATH') or None)
+    return _tracer
+
+def get_tracer():
+    return _tracer
+
+# Span of a stage, child of the span active in the context: with span("search", max_docs=10) as s: ...
+# activate=False does not make it the active span (for generators, which share the context of their caller)
+def span(name, activate=True, **attributes):
+    if _tracer is None:
+        return NOOP_SPAN
+    return Span(_tracer, name, _current_span.get(), activate, attributes)
+
+def current_span():
+    return _current_span.get() or NOOP_SPAN
+
+# Submit a function to an executor keeping the active span as parent of the spans created in the worker thread
+def submit_in_context(executor, fn, *args):
+    if _tracer is None:
+        return executor.submit(fn, *args)
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+# Run a coroutine in another event loop keeping the active span as parent of its spans
+def bind_context(coro):
+    parent = _current_span.get()
+    if _tracer is None or parent is None:
+        return coro
+
+    async def run():
+        _current_span.set(parent)
+        return await coro
+    return run()
+
+# Call the create method of an OpenAI SDK resource, recording the retries of the SDK in the active span and its parents
+def create_with_retries(resource, **kwargs):
+    if _tracer is None or not hasattr(resource, 'with_raw_response'):
+        return resource.create(**kwargs)
+    raw_response = resource.with_raw_response.create(**kwargs)
+    current_span().add_to_stages(retries=raw_response.retries_taken)
+    return raw_response.parse()
+
+async def create_with_retries_async(resource, **kwargs):
+    if _tracer is None or not hasattr(resource, 'with_raw_response'):
+        return await resource.create(**kwargs)
+    raw_response = await resource.with_raw_response.create(**kwargs)
+    current_span().add_to_stages(retries=raw_response.retries_taken)
+    return raw_response.parse()
+
+# Add the tokens of the usage of an OpenAI response to the active span and its parents
+def record_usage(response):
+    if _tracer is None:
+        return
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        current_span().add_to_stages(prompt_tokens=usage.prompt_tokens or 0,
+                                     completion_tokens=getattr(usage, 'completion_tokens', 0) or 0)
+
+# Percentile of a list of latencies
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+# Summary by stage: count, errors, p50/p95/p99/mean in milliseconds and total tokens, retries and hedges
+def summarize_spans(spans):
+    stages = {}
+    for data in spans:
+        stages.setdefault(data["name"], []).append(data)
+    summary = {}
+    for name, stage_spans in stages.items():
+        durations = [data["duration_ms"] for data in stage_spans]
+        summary[name] = {
+            "count": len(stage_spans),
+            "errors": sum(1 for data in stage_spans if data["error"] or data["attributes"].get("error")),
+            "p50_ms": percentile(durations, 50),
+            "p95_ms": percentile(durations, 95),
+            "p99_ms": percentile(durations, 99),
+            "mean_ms": round(statistics.mean(durations), 3),
+        }
+        for key in ("prompt_tokens", "completion_tokens", "retries", "hedges"):
+            total = sum(data["attributes"].get(key, 0) for data in stage_spans)
+            if total > 0:
+                summary[name][key] = total
+    return summary
+
+# Print the summary as a table
+def print_summary(summary):
+    print(f'{"stage":<20} {"count":>6} {"errors":>6} {"p50_ms":>9} {"p95_ms":>9} {"p99_ms":>9} {"prompt_tok":>10} {"compl_tok":>9} {"retries":>7} {"hedges":>6}')
+    for name, stats in sorted(summary.items(), key=lambda item: -item[1]["p50_ms"] * item[1]["count"]):
+        print(f'{name:<20} {stats["count"]:>6} {stats["errors"]:>6} {stats["p50_ms"]:>9.1f} {stats["p95_ms"]:>9.1f} {stats["p99_ms"]:>9.1f} '
+              f'{stats.get("prompt_tokens", 0):>10} {stats.get("completion_tokens", 0):>9} {stats.get("retries", 0):>7} {stats.get("hedges", 0):>6}')
+
+# Summarize a JSONL file of spans: python tracing.py spans.jsonl
+if __name__ == '__main__':
+    import sys
+
+    with open(sys.argv[1], 'r', encoding='utf-8') as f:
+        print_summary(summarize_spans([json.loads(line) for line in f if line.strip()]))